@@ -39,7 +39,8 @@ from .pointprocess import Synapse, PointProcess, StimIntElectrode
 from .recextelectrode import RecExtElectrode, RecMEAElectrode
 from .cell import Cell
 from .templatecell import TemplateCell
-from .network import NetworkCell, NetworkPopulation, Network
+from .network import NetworkCell, NetworkPopulation, Network, \
+    RoundRobinLoadBalancer, GreedyLoadBalancer
 from .test import _test as run_tests
 from .eegmegcalc import FourSphereVolumeConductor, InfiniteVolumeConductor, get_current_dipole_moment, MEG
 from . import lfpcalc
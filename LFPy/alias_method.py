@@ -32,20 +32,13 @@ def alias_method(idx, probs, nsyn):
     # Construct the table.
     J, q = alias_setup(probs)
      
-    #output array
-    spc = np.zeros(nsyn, dtype=int)
-    
     #prefetch random numbers, alias_draw needs nsyn x 2 numbers
     rands = np.random.rand(nsyn, 2)
     
     K = J.size 
-    # Generate variates using alias draw method
-    for nn in range(nsyn):
-        kk = np.floor(rands[nn, 0]*K).astype(int)
-        if rands[nn, 1] < q[kk]:
-            spc[nn] = idx[kk]
-        else:
-            spc[nn] = idx[J[kk]]
+    # Generate variates using alias draw method for all numbers at once
+    kk = np.floor(rands[:, 0]*K).astype(int)
+    spc = np.where(rands[:, 1] < q[kk], idx[kk], idx[J[kk]]).astype(int)
         
     return spc
 
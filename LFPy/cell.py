@@ -898,39 +898,85 @@ class Cell(object):
         >>> plt.hist(cell.zmid[idx], bins=bins, alpha=0.5)
         >>> plt.show()        
         """
-        poss_idx = self.get_idx(section=section, z_min=z_min, z_max=z_max)
         if nidx < 1:
             print('nidx < 1, returning empty array')
             return np.array([])
-        elif poss_idx.size == 0:
+        poss_idx, p = self.get_rand_idx_area_and_distribution_prob(
+            section=section, z_min=z_min, z_max=z_max, fun=fun,
+            funargs=funargs, funweights=funweights)
+        if poss_idx.size == 0:
             print('No possible segment idx match enquire! returning empty array')
             return np.array([])
         else:
-            p = self.area[poss_idx]
-            # scale with density function
-            if type(fun) in [list, tuple, np.ndarray]:
-                assert(type(funargs) in [list, tuple, np.ndarray])
-                assert(type(funweights) in [list, tuple, np.ndarray])
-                assert((len(fun) == len(funargs)) & (len(fun) == len(funweights)))
-                mod = np.zeros(poss_idx.shape)
-                for f, args, scl in zip(fun, funargs, funweights):
-                    df = f(**args)
-                    mod += df.pdf(x=self.zmid[poss_idx])*scl
-                p *= mod
-            else:
-                df = fun(**funargs)
-                p *= df.pdf(x=self.zmid[poss_idx])
-            # normalize
-            p /= p.sum()
             return alias_method(poss_idx, p, nidx)
 
+    def get_rand_idx_area_and_distribution_prob(self, section='allsec',
+                                                z_min=-1E6, z_max=1E6,
+                                                fun=scipy.stats.norm,
+                                                funargs=dict(loc=0, scale=100),
+                                                funweights=None):
+        """
+        Return segment indices in section and their probabilities
+        normalized to the membrane area of each segment multiplied by
+        the value of the probability density function of "fun", as used by
+        Cell.get_rand_idx_area_and_distribution_norm. Computing the table
+        once allows drawing many batches of indices with
+        LFPy.alias_method.alias_method(poss_idx, p, nidx).
+
+        Parameters
+        ----------
+        section: str
+            string matching a section-name
+        z_min: float
+            depth filter
+        z_max: float
+            depth filter
+        fun : function or iterable
+            iterable (list, tuple, numpy.array) of function, probability
+            distribution in scipy.stats module
+        funargs : dict or iterable
+            iterable (list, tuple, numpy.array) of dict, arguments to fun.pdf
+            method (e.g., w. keys 'loc' and 'scale')
+        funweights : None or iterable
+            iterable (list, tuple, numpy.array) of floats, scaling of each
+            individual fun (i.e., introduces layer specificity)
+
+        Returns
+        -------
+        poss_idx : ndarray
+            int segment indices
+        p : ndarray
+            probability of each segment in poss_idx, summing to one
+        """
+        poss_idx = self.get_idx(section=section, z_min=z_min, z_max=z_max)
+        if poss_idx.size == 0:
+            return poss_idx, np.array([])
+        p = self.area[poss_idx]
+        # scale with density function
+        if type(fun) in [list, tuple, np.ndarray]:
+            assert(type(funargs) in [list, tuple, np.ndarray])
+            assert(type(funweights) in [list, tuple, np.ndarray])
+            assert((len(fun) == len(funargs)) & (len(fun) == len(funweights)))
+            mod = np.zeros(poss_idx.shape)
+            for f, args, scl in zip(fun, funargs, funweights):
+                df = f(**args)
+                mod += df.pdf(x=self.zmid[poss_idx])*scl
+            p *= mod
+        else:
+            df = fun(**funargs)
+            p *= df.pdf(x=self.zmid[poss_idx])
+        # normalize
+        p /= p.sum()
+        return poss_idx, p
+
 
     def simulate(self, electrode=None, rec_imem=False, rec_vmem=False,
                  rec_ipas=False, rec_icap=False,
                  rec_current_dipole_moment=False,
                  rec_variables=[], variable_dt=False, atol=0.001,
                  to_memory=True, to_file=False, file_name=None,
-                 dotprodcoeffs=None, **kwargs):
+                 dotprodcoeffs=None, block_size=1,
+                 file_chunk_size=1024, file_compression=None, **kwargs):
         """
         This is the main function running the simulation of the NEURON model.
         Start NEURON simulation and record variables specified by arguments.
@@ -970,11 +1016,29 @@ class Cell(object):
         to_file : bool
             Only valid with electrode, save LFPs in hdf5 file format
         file_name : str
-            Name of hdf5 file, '.h5' is appended if it doesnt exist
+            Name of hdf5 file, '.h5' is appended if it doesnt exist. The file
+            contains one (n_contacts, n_timesteps) dataset per electrode and
+            dotprodcoeffs entry named 'electrode000', 'electrode001' etc.,
+            with contact locations as dataset attributes, and the times of
+            each timestep in dataset 't'
         dotprodcoeffs : list
-            List of N x Nseg ndarray. These arrays will at
-            every timestep be multiplied by the membrane currents.
+            List of N x Nseg ndarray or scipy.sparse matrices. These arrays
+            will at every timestep be multiplied by the membrane currents.
             Presumably useful for memory efficient csd or lfp calcs
+        block_size : int
+            Number of consecutive timesteps of membrane currents buffered
+            before computing LFPs etc. as one matrix-matrix product per
+            electrode and dotprodcoeffs entry. Values larger than one
+            (e.g., 100) speed up simulations with many electrode contacts
+            and segments at the cost of a (cell.totnsegs, block_size) buffer.
+            Defaults to 1
+        file_chunk_size : int
+            Only valid with to_file=True. Number of timesteps per HDF5 chunk.
+            Results are buffered in memory and written to file in blocks of
+            this many timesteps. Defaults to 1024
+        file_compression : None or str
+            Only valid with to_file=True. HDF5 compression filter applied to
+            output datasets, e.g., 'gzip' or 'lzf'. Defaults to None
 
         """
         for key in kwargs.keys():
@@ -993,6 +1057,11 @@ class Cell(object):
         except AttributeError as ae:
             raise Exception('neuron.h.CVode().use_fast_imem() method not found. Please update NEURON to v.7.4 or newer')
 
+        try:
+            assert(int(block_size) == block_size and block_size >= 1)
+        except AssertionError:
+            raise AssertionError('block_size must be a positive integer')
+
         if rec_imem:
             self._set_imem_recorders()
         if rec_vmem:
@@ -1019,7 +1088,10 @@ class Cell(object):
             _run_simulation_with_electrode(self, cvode, electrode, variable_dt, atol,
                                            to_memory, to_file, file_name,
                                            dotprodcoeffs,
-                                           rec_current_dipole_moment)
+                                           rec_current_dipole_moment,
+                                           block_size=int(block_size),
+                                           file_chunk_size=file_chunk_size,
+                                           file_compression=file_compression)
         # somatic trace
         if self.nsomasec >= 1:
             self.somav = np.array(self.somav)
@@ -1292,6 +1364,7 @@ class Cell(object):
 
     def strip_hoc_objects(self):
         """Destroy any NEURON hoc objects in the cell object"""
+        self._segment_index = None
         for varname in dir(self):
             if type(getattr(self, varname)) == type(neuron.h.List()):
                 setattr(self, varname, None)
@@ -1656,15 +1729,55 @@ class Cell(object):
             wrongidx = idx[np.where(idx >= self.totnsegs)]
             raise Exception('idx %s >= number of compartments' % str(wrongidx))
 
-        #create list of seg names:
-        allsegnames = []
-        segidx = 0
-        for sec in self.allseclist:
-            for seg in sec:
-                allsegnames.append((segidx, '%s' % sec.name(), seg.x))
-                segidx += 1
+        #look up seg names in cached segment index:
+        index = self._get_segment_index()
+        idx = np.array(idx).astype(int)
+        allsegnames = np.empty(idx.shape + (3, ), dtype=object)
+        allsegnames[..., 0] = idx.tolist()
+        allsegnames[..., 1] = index['secname'][index['sec_idx'][idx]]
+        allsegnames[..., 2] = index['x'][idx].tolist()
+
+        return allsegnames[0]
 
-        return np.array(allsegnames, dtype=object)[idx][0]
+    def _get_segment_index(self):
+        '''
+        Return cached lookup tables mapping segment indices to sections,
+        built on first use (and rebuilt if the number of segments changed).
+        The returned dict has keys:
+        ::
+
+            sec : list of neuron.h.Section
+                references to all sections in cell.allseclist
+            secname : ndarray, dtype object
+                name of each section
+            sec_range : ndarray, dtype int, shape (nsec, 2)
+                first and one past last segment index of each section
+            sec_idx : ndarray, dtype int
+                index into sec of each segment
+            x : ndarray, dtype float
+                relative position of each segment along its section
+        '''
+        index = getattr(self, '_segment_index', None)
+        if index is None or index['x'].size != self.totnsegs:
+            secs = []
+            secnames = []
+            sec_range = []
+            sec_idx = []
+            x = []
+            for i, sec in enumerate(self.allseclist):
+                secs.append(sec)
+                secnames.append('%s' % sec.name())
+                sec_range.append((len(x), len(x) + sec.nseg))
+                for seg in sec:
+                    sec_idx.append(i)
+                    x.append(seg.x)
+            index = dict(sec=secs,
+                         secname=np.array(secnames, dtype=object),
+                         sec_range=np.array(sec_range, dtype=int).reshape(-1, 2),
+                         sec_idx=np.array(sec_idx, dtype=int),
+                         x=np.array(x))
+            self._segment_index = index
+        return index
 
     def _collect_pt3d(self):
         """collect the pt3d info, for each section"""
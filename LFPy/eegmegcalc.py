@@ -45,6 +45,28 @@ class FourSphereVolumeConductor(object):
     rz : ndarray, dtype=float
         Shape (3, ) array containing the position of the current dipole in
         cartesian coordinates. Units of (µm).
+    tolerance : None or float
+        If None (default), the series over n are truncated after 99 terms.
+        Otherwise, the number of terms is chosen for each contact such that
+        the estimated truncation error of the series is below tolerance
+        times the sum of the absolute values of the included terms, see
+        attributes n_terms and truncation_error
+    max_terms : int
+        Largest number of terms of the series if tolerance is not None.
+        Contacts close to the dipole need the most terms
+
+    Attributes
+    ----------
+    n_terms : ndarray, dtype=int
+        Shape (n_contacts, ) array with the number of terms of the series
+        for each contact
+    truncation_error : None or ndarray, dtype=float
+        If tolerance is not None, shape (n_contacts, ) array with the
+        estimated truncation error of the potential per unit magnitude of
+        the radial or the tangential part of the current dipole moment, in
+        units of (mV/(nA*µm)). Estimated from the geometric decay of the
+        series coefficients, assuming the bounds abs(P_n) <= 1 and
+        abs(P_n^1) <= n on the Legendre functions
 
     Examples
     --------
@@ -65,7 +87,7 @@ class FourSphereVolumeConductor(object):
 
     """
 
-    def __init__(self, radii, sigmas, r, rz):
+    def __init__(self, radii, sigmas, r, rz, tolerance=None, max_terms=1000):
         """Initialize class FourSphereVolumeConductor"""
         self.r1 = radii[0]
         self.r2 = radii[1]
@@ -97,7 +119,26 @@ class FourSphereVolumeConductor(object):
         self.rz1 = self.rz / self.r1
         self.r = np.sqrt(np.sum(r ** 2, axis=1))
 
-    def calc_potential(self, p):
+        self.tolerance = tolerance
+        self.max_terms = max_terms
+
+        # the series coefficients and their sums at each contact only depend
+        # on radii, sigmas, r and rz, and are computed once
+        if tolerance is None:
+            self._n = np.arange(1, 100)
+        else:
+            self._n = np.arange(1, max_terms + 1)
+        self._calc_coefficients()
+        (self._rad_terms, self._tan_terms, self.n_terms,
+         error) = self._calc_series_terms(self.r, np.cos(self.calc_theta()),
+                                          np.zeros(self.r.size) + self.rz)
+        if tolerance is None:
+            self.truncation_error = None
+        else:
+            self.truncation_error = error / (4 * np.pi * self.sigma1 *
+                                             self.rz ** 2)
+
+    def calc_potential(self, p, chunk_size=None):
         """
         Return electric potential from current dipole moment p
 
@@ -106,6 +147,10 @@ class FourSphereVolumeConductor(object):
         p : ndarray, dtype=float
             Shape (n_timesteps, 3) array containing the x,y,z components of the
             current dipole moment in units of (nA*µm) for all timesteps
+        chunk_size : None or int
+            If not None, the potential is computed for chunks of chunk_size
+            timesteps at a time, bounding the size of temporary arrays to
+            (n_contacts, chunk_size) for long time series
 
         Returns
         -------
@@ -115,14 +160,87 @@ class FourSphereVolumeConductor(object):
             of (mV) for all timesteps of current dipole moment p
 
         """
-        p_rad, p_tan = self._decompose_dipole(p)
-        pot_rad = self._calc_rad_potential(p_rad)
-        pot_tan = self._calc_tan_potential(p_tan)
+        if chunk_size is None:
+            chunk_size = max(len(p), 1)
+        pot_tot = np.empty((len(self.r), len(p)))
+        for i in range(0, len(p), chunk_size):
+            p_rad, p_tan = self._decompose_dipole(p[i:i + chunk_size])
+            pot_tot[:, i:i + chunk_size] = self._calc_rad_potential(p_rad)
+            pot_tot[:, i:i + chunk_size] += self._calc_tan_potential(p_tan)
 
-        pot_tot = pot_rad + pot_tan
         mask = np.isnan(pot_tot)
         return np.ma.masked_array(pot_tot, mask=mask)
 
+    def calc_lead_field(self, dipole_locations, block_size=None):
+        """
+        Return the lead field of many current dipole locations, i.e., the
+        electric potential at the contact points per unit current dipole
+        moment in the x, y and z direction at each location. The series
+        coefficients are shared by all locations, and the series are summed
+        for blocks of dipole locations at once. If the attribute tolerance
+        is not None, the number of terms is chosen for each pair of contact
+        and dipole location.
+
+        Parameters
+        ----------
+        dipole_locations : ndarray, dtype=float
+            Shape (n_dipoles, 3) array containing the positions of the
+            current dipoles in cartesian coordinates in units of (µm).
+            Contacts must be farther away from the center than each dipole
+        block_size : None or int
+            Number of dipole locations handled at once, bounding the size
+            of temporary arrays to (n_contacts * block_size, n_terms). If
+            None, chosen such that temporary arrays hold about 1E7 elements
+
+        Returns
+        -------
+        lead_field : ndarray, dtype=float
+            Shape (n_contacts, n_dipoles, 3) array in units of (mV/(nA*µm)).
+            NaN for contacts closer to the center than the dipole
+
+        Examples
+        --------
+        Compute the summed potential of current dipole moments P of shape
+        (n_dipoles, n_timesteps, 3) at locations R of shape (n_dipoles, 3):
+
+        >>> lead_field = sphere_model.calc_lead_field(R)
+        >>> potential = np.einsum('mnk,ntk->mt', lead_field, P)
+        """
+        dipole_locations = np.array(dipole_locations, dtype=float
+                                    ).reshape(-1, 3)
+        n_dipoles = dipole_locations.shape[0]
+        n_contacts = self.r.size
+        if block_size is None:
+            block_size = max(1, int(1E7 // (n_contacts * self._n.size)))
+
+        lead_field = np.empty((n_contacts, n_dipoles, 3))
+        for i in range(0, n_dipoles, block_size):
+            locations = dipole_locations[i:i + block_size]
+            rz = np.sqrt(np.sum(locations ** 2, axis=1))
+            rz_unit = locations / rz[:, np.newaxis]
+            # polar angles and unit vectors of the projections of the
+            # contact locations onto the plane perpendicular to rz
+            r_dot_rz = np.dot(self.rxyz, rz_unit.T)
+            cos_theta = np.nan_to_num(r_dot_rz / self.r[:, np.newaxis])
+            rxy = (self.rxyz[:, np.newaxis, :] -
+                   r_dot_rz[:, :, np.newaxis] * rz_unit[np.newaxis, :, :])
+            rxy_norm = np.sqrt(np.sum(rxy ** 2, axis=2))
+            rxy_unit = rxy / np.where(rxy_norm > 0, rxy_norm,
+                                      1.)[:, :, np.newaxis]
+
+            rad_terms, tan_terms, _, _ = self._calc_series_terms(
+                np.repeat(self.r, rz.size), cos_theta.ravel(),
+                np.tile(rz, n_contacts))
+            rad_terms = rad_terms.reshape(n_contacts, rz.size, 1)
+            tan_terms = tan_terms.reshape(n_contacts, rz.size, 1)
+
+            # the potential of the radial part of p is proportional to p.rz,
+            # and of the tangential part to p.rxy
+            lead_field[:, i:i + block_size] = (
+                (rad_terms * rz_unit[np.newaxis] - tan_terms * rxy_unit) /
+                (4 * np.pi * self.sigma1 * rz[np.newaxis, :, np.newaxis]**2))
+        return lead_field
+
     def _decompose_dipole(self, p):
         """
         Decompose current dipole moment vector in radial and tangential terms
@@ -166,34 +284,9 @@ class FourSphereVolumeConductor(object):
         """
 
         p_tot = np.linalg.norm(p_rad, axis=1)
-        theta = self.calc_theta()
         s_vector = self._sign_rad_dipole(p_rad)
         phi_const = s_vector * p_tot / (4 * np.pi * self.sigma1 * self.rz ** 2)
-        n_terms = np.zeros((len(self.r), len(p_tot)))
-        for el_point in range(len(self.r)):
-            el_rad = self.r[el_point]
-            theta_point = theta[el_point]
-
-            if el_rad <= self.rz:
-                n_terms[el_point] = np.nan
-                UserWarning('Electrode must be farther away from brain center than dipole. r = %s, rz = %s', self.r, self.rz)
-            elif el_rad <= self.r1:
-                n_terms[el_point] = self._potential_brain_rad(el_rad,
-                                                             theta_point)
-            elif el_rad <= self.r2:
-                n_terms[el_point] = self._potential_csf_rad(el_rad,
-                                                           theta_point)
-            elif el_rad <= self.r3:
-                n_terms[el_point] = self._potential_skull_rad(el_rad,
-                                                             theta_point)
-            elif el_rad <= (self.r4):
-                n_terms[el_point] = self._potential_scalp_rad(el_rad,
-                                                             theta_point)
-            else:
-                n_terms[el_point] = 0.
-                UserWarning('Electrode located outside head model. Maximum r = %s µm.',
-                                 self.r4, '\n your r = ', self.r)
-        potential = phi_const * n_terms
+        potential = phi_const * self._rad_terms[:, np.newaxis]
         return potential
 
     def _calc_tan_potential(self, p_tan):
@@ -213,32 +306,162 @@ class FourSphereVolumeConductor(object):
             potential at n_contacts contact point(s) FourSphereVolumeConductor.r
             in units of (mV) for all timesteps of p_tan
         """
-        theta = self.calc_theta()
         phi = self.calc_phi(p_tan)
         p_tot = np.linalg.norm(p_tan, axis=1)
         phi_hom = - p_tot / (4 * np.pi * self.sigma1 * self.rz ** 2) * np.sin(phi)
-        n_terms = np.zeros((len(self.r), len(p_tot)))
-        for el_point in range(len(self.r)):
-            el_rad = self.r[el_point]
-            theta_point = theta[el_point]
-            if el_rad <= self.rz:
-                n_terms[el_point] = np.nan
-                UserWarning('Electrode must be farther away from brain center than dipole. r = %s, rz = %s', self.r, self.rz)
-            elif el_rad <= self.r1:
-                n_terms[el_point] = self._potential_brain_tan(el_rad, theta_point)
-            elif el_rad <= self.r2:
-                n_terms[el_point] = self._potential_csf_tan(el_rad, theta_point)
-            elif el_rad <= self.r3:
-                n_terms[el_point] = self._potential_skull_tan(el_rad, theta_point)
-            elif el_rad <= self.r4:
-                n_terms[el_point] = self._potential_scalp_tan(el_rad, theta_point)
-            else:
-                n_terms[el_point] = 0.
-                UserWarning('Electrode located outside head model. Maximum r = %s µm.',
-                                 self.r4, '\n your r = ', self.r)
-        potential = phi_hom * n_terms
+        potential = phi_hom * self._tan_terms[:, np.newaxis]
         return potential
 
+    def _calc_series_terms(self, r, cos_theta, rz):
+        """
+        Return the sums over n of the series for radial and tangential
+        dipoles at distance rz from the center for contact points at
+        distance r from the center and polar angle theta relative to the
+        dipole location, using the coefficients computed by
+        _calc_coefficients and Legendre functions evaluated for all
+        contact points at once
+
+        Parameters
+        ----------
+        r : ndarray, dtype=float
+            Shape (n_points, ) array with distances of contact points from
+            the center in units of (µm)
+        cos_theta : ndarray, dtype=float
+            Shape (n_points, ) array with cosines of the polar angles
+            between the contact point and dipole locations
+        rz : ndarray, dtype=float
+            Shape (n_points, ) array with distances of dipoles from the
+            center in units of (µm)
+
+        Returns
+        -------
+        rad_terms : ndarray, dtype=float
+            Shape (n_points, ) array with summation factors for
+            calculation of electrical potential from radial current dipole
+            moment. NaN for contacts closer to the center than the dipole,
+            and 0 for contacts outside the scalp (unitless)
+        tan_terms : ndarray, dtype=float
+            Shape (n_points, ) array with summation factors for
+            calculation of electrical potential from tangential current
+            dipole moment, NaN or 0 as rad_terms (unitless)
+        n_terms : ndarray, dtype=int
+            Shape (n_points, ) array with the number of terms of the series
+        error : ndarray, dtype=float
+            Shape (n_points, ) array with the estimated truncation error of
+            the series if tolerance is not None, otherwise NaN (unitless)
+        """
+        n = self._n
+        # shell of each contact: brain, csf, skull or scalp
+        radii = np.array([self.r1, self.r2, self.r3, self.r4])
+        shell = np.minimum(np.searchsorted(radii, r), 3)
+        inside = (r > rz) & (r <= self.r4)
+        outside = r > self.r4
+        r_i = radii[shell, np.newaxis]
+        r = np.where(inside, r, radii[shell])[:, np.newaxis]
+        rz1 = (rz / self.r1)[:, np.newaxis]
+
+        # coefficients c (r / r_i)**n + d (r'_i / r)**(n + 1) of each contact,
+        # with r'_i = rz in the brain and r'_i = r_i in the other shells.
+        # The stored coefficients are divided by (rz / r1)**(n + 1)
+        c = np.array([self._c1n, self._c2n, self._c3n, self._c4n])[shell]
+        d = np.array([np.ones(n.size), self._d2n, self._d3n,
+                      self._d4n])[shell]
+        # powers for n = 1, 2, ... as cumulative products
+        shape = (r.shape[0], n.size)
+        q_c = rz1 * r / r_i
+        q_d = rz1 * r_i / r
+        consts = (c * rz1 * np.cumprod(np.broadcast_to(q_c, shape), axis=1) +
+                  d * q_d * np.cumprod(np.broadcast_to(q_d, shape), axis=1))
+
+        if self.tolerance is None:
+            n_terms = np.zeros(r.shape[0], dtype=int) + n.size
+            error = np.zeros(r.shape[0]) + np.nan
+        else:
+            n_terms, error = self._truncate_series(consts)
+            n_terms[~inside] = 1
+            error[~inside] = 0.
+            # discard terms beyond the truncation of each contact
+            n_max = n_terms.max()
+            n = n[:n_max]
+            consts = np.where(n <= n_terms[:, np.newaxis],
+                              consts[:, :n_max], 0.)
+
+        P, P1 = _legendre(n.size, cos_theta)
+        rad_terms = np.einsum('ij,ji->i', n * consts, P)
+        tan_terms = np.einsum('ij,ji->i', consts, P1)
+
+        # electrode must be farther away from brain center than dipole, and
+        # inside the head model
+        rad_terms[~inside] = np.where(outside[~inside], 0., np.nan)
+        tan_terms[~inside] = np.where(outside[~inside], 0., np.nan)
+        error[~inside & ~outside] = np.nan
+        return rad_terms, tan_terms, n_terms, error
+
+    def _truncate_series(self, consts):
+        """
+        Return the number of terms of the series for each contact given the
+        attribute tolerance, and the estimated truncation errors.
+
+        The absolute values of the terms of both series are bounded by
+        a_n = n * abs(consts_n). Assuming that consts_n decays geometrically
+        with the largest ratio q of the last three coefficients, the
+        remaining terms after N terms sum to at most
+        a_N * q * (N + 1 - N * q) / (N * (1 - q)**2). The series are
+        truncated after the first N where this estimate is below tolerance
+        times the sum of a_n for n <= N, or after max_terms terms.
+
+        Parameters
+        ----------
+        consts : ndarray, dtype=float
+            Shape (n_contacts, n_terms) array with the coefficients of the
+            series for each contact
+
+        Returns
+        -------
+        n_terms : ndarray, dtype=int
+            Shape (n_contacts, ) array with the number of terms
+        error : ndarray, dtype=float
+            Shape (n_contacts, ) array with the estimated truncation error
+            of the series (unitless)
+        """
+        n = self._n
+        a = n * abs(consts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = abs(consts[:, 1:]) / abs(consts[:, :-1])
+        # coefficients that are zero have converged
+        ratio = np.nan_to_num(ratio)
+        q = np.zeros(consts.shape)
+        q[:, 1:] = ratio
+        q[:, 2:] = np.maximum(q[:, 2:], ratio[:, :-1])
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            error = np.where(q < 1, a * q * (n + 1 - n * q) /
+                             (n * (1 - q)**2), np.inf)
+        error[:, 0] = np.inf
+        error[a == 0] = 0.
+
+        converged = error <= self.tolerance * np.cumsum(a, axis=1)
+        converged[:, -1] = True
+        n_terms = converged.argmax(axis=1) + 1
+        return n_terms, error[np.arange(n_terms.size), n_terms - 1]
+
+    def _calc_coefficients(self):
+        """
+        Compute the coefficients of the series for n = 1, ..., 99 (or
+        max_terms if tolerance is not None) in each shell of the four-sphere
+        model once, and store them as attributes _c1n, _c2n, _d2n, _c3n,
+        _d3n, _c4n and _d4n. The coefficients are proportional to
+        (rz / r1)**(n + 1), and are stored divided by this factor such that
+        they apply to any dipole location
+        """
+        n = self._n
+        self._c1n = self._calc_c1n(n, rz1=1.)
+        self._c2n = self._calc_c2n(n, rz1=1.)
+        self._d2n = self._calc_d2n(n, self._c2n)
+        self._c3n = self._calc_c3n(n, rz1=1.)
+        self._d3n = self._calc_d3n(n, self._c3n)
+        self._c4n = self._calc_c4n(n, rz1=1.)
+        self._d4n = self._calc_d4n(n, self._c4n)
+
     def calc_theta(self):
         """
         Return polar angle(s) between rzloc and contact point location(s)
@@ -287,12 +510,8 @@ class FourSphereVolumeConductor(object):
                          axis=1).reshape(1, len(x)))
         cos_phi = np.nan_to_num(cos_phi)
         phi_temp = np.arccos(cos_phi) # nb: phi_temp is in range [0, pi]
-        phi = phi_temp
         range_test = np.dot(rxy, p_tan.T)  # if range_test < 0, phi > pi
-        for i in range(len(self.r)):
-            for j in range(len(p_tan)):
-                if range_test[i,j] < 0:
-                    phi[i,j] = 2*np.pi - phi_temp[i,j]
+        phi = np.where(range_test < 0, 2*np.pi - phi_temp, phi_temp)
         return phi
 
     def _sign_rad_dipole(self, p):
@@ -314,219 +533,11 @@ class FourSphereVolumeConductor(object):
             If radial part of p[i] points inwards, sign_vector[i] = -1.
 
         """
-        sign_vector = np.ones(len(p))
         radial_test = np.dot(p, self.rzloc) / (np.linalg.norm(p, axis=1) * self.rz)
-        for i in range(len(p)):
-            if np.abs(radial_test[i] + 1) < 10 ** -8:
-                sign_vector[i] = -1.
+        with np.errstate(invalid='ignore'):  # NaN for p = 0
+            sign_vector = np.where(np.abs(radial_test + 1) < 10 ** -8, -1., 1.)
         return sign_vector
 
-    def _potential_brain_rad(self, r, theta):
-        """
-        Return factor for calculation of potential in brain from rad. dipole
-
-        Parameters
-        ----------
-        r : float
-            Distance from origin to brain electrode location in units of (µm)
-        theta : float
-            Polar angle between brain electrode location and
-            dipole location vector rzloc in units of (radians)
-
-        Returns
-        -------
-        pot_sum : float
-            Summationfactor for calculation of electrical potential in brain
-            from radial current dipole moment. (unitless)
-        """
-        n = np.arange(1, 100)
-        c1n = self._calc_c1n(n)
-        consts = n*(c1n * (r / self.r1) ** n + (self.rz / r) ** (n + 1))
-        consts = np.insert(consts, 0, 0)
-        leg_consts = np.polynomial.legendre.Legendre(consts)
-        pot_sum = leg_consts(np.cos(theta))
-        return pot_sum
-
-    def _potential_csf_rad(self, r, theta):
-        """
-        Return factor for calculation of potential in CSF from rad. dipole
-
-        Parameters
-        ----------
-        r : float
-            Distance from origin to CSF electrode location in units of (µm)
-        theta : float
-            Polar angle between CSF electrode location and
-            dipole location vector rzloc in units of (radians)
-
-        Returns
-        -------
-        pot_sum : float
-            Summation factor for calculation of electrical potential in CSF
-            from radial current dipole moment. (unitless)
-        """
-        n = np.arange(1,100)
-        c2n = self._calc_c2n(n)
-        d2n = self._calc_d2n(n, c2n)
-        consts = n*(c2n * (r / self.r2) ** n + d2n * (self.r2 / r) ** (n + 1))
-        consts = np.insert(consts, 0, 0)
-        leg_consts = np.polynomial.legendre.Legendre(consts)
-        pot_sum = leg_consts(np.cos(theta))
-        return pot_sum
-
-    def _potential_skull_rad(self, r, theta):
-        """
-        Return factor for calculation of potential in skull from rad. dipole
-
-        Parameters
-        ----------
-        r : float
-            Distance from origin to skull electrode location in units of (µm)
-        theta : float
-            Polar angle between skull electrode location and
-            dipole location vector rzloc in units of (radians)
-
-        Returns
-        -------
-        pot_sum : float
-            Summation factor for calculation of electrical potential in skull
-            from radial current dipole moment. (unitless)
-        """
-        n = np.arange(1,100)
-        c3n = self._calc_c3n(n)
-        d3n = self._calc_d3n(n, c3n)
-        consts = n*(c3n * (r / self.r3) ** n + d3n * (self.r3 / r) ** (n + 1))
-        consts = np.insert(consts, 0, 0)
-        leg_consts = np.polynomial.legendre.Legendre(consts)
-        pot_sum = leg_consts(np.cos(theta))
-        return pot_sum
-
-    def _potential_scalp_rad(self, r, theta):
-        """
-        Return factor for calculation of potential in scalp from radial dipole
-
-        Parameters
-        ----------
-        r : float
-            Distance from origin to scalp electrode location in units of (µm)
-        theta : float
-            Polar angle between scalp electrode location and
-            dipole location vector rzloc in units of (radians)
-
-        Returns
-        -------
-        pot_sum : float
-            Summation factor for calculation of electrical potential in scalp
-            from radial current dipole moment. (unitless)
-        """
-        n = np.arange(1,100)
-        c4n = self._calc_c4n(n)
-        d4n = self._calc_d4n(n, c4n)
-        consts = n*(c4n * (r / self.r4) ** n + d4n * (self.r4 / r) ** (n + 1))
-        consts = np.insert(consts, 0, 0)
-        leg_consts = np.polynomial.legendre.Legendre(consts)
-        pot_sum = leg_consts(np.cos(theta))
-        return pot_sum
-
-    def _potential_brain_tan(self, r, theta):
-        """
-        Return factor for calculation of potential in brain from tan. dipole
-
-        Parameters
-        ----------
-        r : float
-            Distance from origin to brain electrode location in units of (µm)
-        theta : float
-            Polar angle between brain electrode location and
-            dipole location vector rzloc in units of (radians)
-
-        Returns
-        -------
-        pot_sum : float
-            Summation factor for calculation of electrical potential in brain
-            from tangential current dipole moment. (unitless)
-        """
-        n = np.arange(1,100)
-        c1n = self._calc_c1n(n)
-        consts = (c1n * (r / self.r1) ** n + (self.rz / r) ** (n + 1))
-        pot_sum = np.sum([c*lpmv(1, i, np.cos(theta)) for c,i in zip(consts,n)])
-        return pot_sum
-
-    def _potential_csf_tan(self, r, theta):
-        """
-        Return factor for calculation of potential in CSF from tan. dipole
-
-        Parameters
-        ----------
-        r : float
-            Distance from origin to CSF electrode location in units of (µm)
-        theta : float
-            Polar angle between CSF electrode location and
-            dipole location vector rzloc in units of (radians)
-
-        Returns
-        -------
-        pot_sum : float
-            Summation factor for calculation of electrical potential in CSF
-            from tangential current dipole moment. (unitless)
-        """
-        n = np.arange(1,100)
-        c2n = self._calc_c2n(n)
-        d2n = self._calc_d2n(n, c2n)
-        consts = c2n*(r/self.r2)**n + d2n*(self.r2/r)**(n+1)
-        pot_sum = np.sum([c*lpmv(1, i, np.cos(theta)) for c,i in zip(consts,n)])
-        return pot_sum
-
-    def _potential_skull_tan(self, r, theta):
-        """
-        Return factor for calculation of potential in skull from tan. dipole
-
-        Parameters
-        ----------
-        r : float
-            Distance from origin to skull electrode location in units of (µm)
-        theta : float
-            Polar angle between skull electrode location and
-            dipole location vector rzloc in units of (radians)
-
-        Returns
-        -------
-        pot_sum : float
-            Summation factor for calculation of electrical potential in skull
-            from tangential current dipole moment. (unitless)
-        """
-        n = np.arange(1,100)
-        c3n = self._calc_c3n(n)
-        d3n = self._calc_d3n(n, c3n)
-        consts = c3n*(r/self.r3)**n + d3n*(self.r3/r)**(n+1)
-        pot_sum = np.sum([c*lpmv(1, i, np.cos(theta)) for c,i in zip(consts,n)])
-        return pot_sum
-
-    def _potential_scalp_tan(self, r, theta):
-        """
-        Return factor for calculation of potential in scalp from tan. dipole
-
-        Parameters
-        ----------
-        r : float
-            Distance from origin to scalp electrode location in units of (µm)
-        theta : float
-            Polar angle between scalp electrode location and
-            dipole location vector rzloc in units of (radians)
-
-        Returns
-        -------
-        pot_sum : float
-            Summation factor for calculation of electrical potential in scalp
-            from tangential current dipole moment. (unitless)
-        """
-        n = np.arange(1,100)
-        c4n = self._calc_c4n(n)
-        d4n = self._calc_d4n(n, c4n)
-        consts = c4n*(r/self.r4)**n + d4n*(self.r4/r)**(n+1)
-        pot_sum = np.sum([c*lpmv(1, i, np.cos(theta)) for c,i in zip(consts,n)])
-        return pot_sum
-
     def _calc_vn(self, n):
         r_const = (self.r34 ** n - self.r43 ** (n + 1)) / ((n + 1) / n * self.r34 ** n + self.r43 ** (n + 1))
         v = (n / (n + 1) * self.sigma34 - r_const) / (self.sigma34 + r_const)
@@ -543,15 +554,19 @@ class FourSphereVolumeConductor(object):
         z = (self.r12 ** n - (n + 1) / n * yn * self.r21 ** (n + 1)) / (self.r12 ** n + yn * self.r21 ** (n + 1))
         return z
 
-    def _calc_c1n(self, n):
+    def _calc_c1n(self, n, rz1=None):
+        if rz1 is None:
+            rz1 = self.rz1
         zn = self._calc_zn(n)
-        c = ((n + 1) / n * self.sigma12 + zn) / (self.sigma12 - zn) * self.rz1**(n+1)
+        c = ((n + 1) / n * self.sigma12 + zn) / (self.sigma12 - zn) * rz1**(n+1)
         return c
 
-    def _calc_c2n(self, n):
+    def _calc_c2n(self, n, rz1=None):
+        if rz1 is None:
+            rz1 = self.rz1
         yn = self._calc_yn(n)
-        c1 = self._calc_c1n(n)
-        c2 = (c1 + self.rz1**(n+1)) / (self.r12 ** n + yn * self.r21 ** (n + 1))
+        c1 = self._calc_c1n(n, rz1)
+        c2 = (c1 + rz1**(n+1)) / (self.r12 ** n + yn * self.r21 ** (n + 1))
         return c2
 
     def _calc_d2n(self, n, c2):
@@ -559,9 +574,9 @@ class FourSphereVolumeConductor(object):
         d2 = yn * c2
         return d2
 
-    def _calc_c3n(self, n):
+    def _calc_c3n(self, n, rz1=None):
         vn = self._calc_vn(n)
-        c2 = self._calc_c2n(n)
+        c2 = self._calc_c2n(n, rz1)
         d2 = self._calc_d2n(n, c2)
         c3 = (c2 + d2) / (self.r23 ** n + vn * self.r32 ** (n + 1))
         return c3
@@ -571,8 +586,8 @@ class FourSphereVolumeConductor(object):
         d3 = vn * c3
         return d3
 
-    def _calc_c4n(self, n):
-        c3 = self._calc_c3n(n)
+    def _calc_c4n(self, n, rz1=None):
+        c3 = self._calc_c3n(n, rz1)
         d3 = self._calc_d3n(n, c3)
         c4 = (n + 1) / n * (c3 + d3) / ((n + 1) / n * self.r34 ** n + self.r43 ** (n + 1))
         return c4
@@ -582,6 +597,40 @@ class FourSphereVolumeConductor(object):
         return d4
 
 
+def _legendre(n_max, x):
+    """
+    Return Legendre polynomials and associated Legendre functions of order 1
+    for degrees n = 1, ..., n_max, computed with the three-term recurrences
+    for all arguments x at once
+
+    Parameters
+    ----------
+    n_max : int
+        Largest degree
+    x : ndarray, dtype=float
+        Shape (n_points, ) array of arguments in [-1, 1]
+
+    Returns
+    -------
+    P : ndarray, dtype=float
+        Shape (n_max, n_points) array with P_n(x)
+    P1 : ndarray, dtype=float
+        Shape (n_max, n_points) array with P_n^1(x), including the
+        Condon-Shortley phase as scipy.special.lpmv
+    """
+    P = np.empty((n_max + 1, x.size))
+    P1 = np.empty((n_max + 1, x.size))
+    P[0] = 1.
+    P1[0] = 0.
+    if n_max > 0:
+        P[1] = x
+        P1[1] = -np.sqrt(1 - x**2)
+    for n in range(1, n_max):
+        P[n + 1] = ((2 * n + 1) * x * P[n] - n * P[n - 1]) / (n + 1)
+        P1[n + 1] = ((2 * n + 1) * x * P1[n] - (n + 1) * P1[n - 1]) / n
+    return P[1:], P1[1:]
+
+
 class InfiniteVolumeConductor(object):
     """
     Main class for computing extracellular potentials with current dipole
@@ -822,3 +871,130 @@ class MEG(object):
                               R) / (4 * np.pi * np.sqrt((R**2).sum())**3)
 
         return H
+
+    def get_kernel(self, dipole_locations):
+        """
+        Return the geometry kernel between all sensor locations and many
+        dipole locations, which can be reused by calculate_H_multi
+
+        Parameters
+        ----------
+        dipole_locations : ndarray, dtype=float
+            shape (n_dipoles x 3) array with x,y,z-locations of dipoles in
+            units of (µm)
+
+        Returns
+        -------
+        ndarray, dtype=float
+            shape (n_locations x n_dipoles x 3) array with the vectors
+            :math:`\\mathbf{R} / (4 \\pi R^3)` from each dipole location to
+            each sensor location in units of (1/µm^2)
+
+        Raises
+        ------
+        AssertionError
+            If dimensionality of dipole_locations is wrong, or if a dipole
+            and sensor location are identical
+        """
+        try:
+            assert(dipole_locations.ndim == 2)
+        except AssertionError:
+            raise AssertionError('dipole_locations.ndim != 2')
+        try:
+            assert(dipole_locations.shape[1] == 3)
+        except AssertionError:
+            raise AssertionError('dipole_locations.shape[1] != 3')
+
+        R = (self.sensor_locations[:, np.newaxis, :] -
+             dipole_locations[np.newaxis, :, :])
+        R_norm = np.sqrt((R**2).sum(axis=2))
+        try:
+            assert(np.all(R_norm > 0))
+        except AssertionError:
+            raise AssertionError('Identical dipole and sensor location.')
+        return R / (4 * np.pi * R_norm[:, :, np.newaxis]**3)
+
+    def calculate_H_multi(self, current_dipole_moments, dipole_locations=None,
+                          kernel=None, summed=True, chunk_size=None):
+        """
+        Compute the magnetic field at all sensor locations from many current
+        dipole moments at different locations, e.g., the current dipole
+        moments of each cell in a network, with tensor contractions
+
+        Parameters
+        ----------
+        current_dipole_moments : ndarray, dtype=float
+            shape (n_dipoles x n_timesteps x 3) array with x,y,z-components
+            of current-dipole moment time series data of each dipole in
+            units of (nA µm)
+        dipole_locations : None or ndarray, dtype=float
+            shape (n_dipoles x 3) array with x,y,z-locations of dipoles in
+            units of (µm). Not used if kernel is not None
+        kernel : None or ndarray, dtype=float
+            kernel returned by MEG.get_kernel(dipole_locations), allowing
+            repeated calls to reuse it
+        summed : bool
+            if True, return the summed magnetic field of all dipoles,
+            otherwise the magnetic field of each dipole
+        chunk_size : None or int
+            if not None, the magnetic field is computed for chunks of
+            chunk_size timesteps at a time, bounding the size of temporary
+            arrays
+
+        Returns
+        -------
+        ndarray, dtype=float
+            if summed, shape (n_locations x n_timesteps x 3) array,
+            otherwise shape (n_locations x n_dipoles x n_timesteps x 3)
+            array with x,y,z-components of the magnetic field
+            :math:`\\mathbf{H}` in units of (nA/µm)
+
+        Raises
+        ------
+        AssertionError
+            If dimensionality of current_dipole_moments, dipole_locations
+            and/or kernel is wrong
+        """
+        try:
+            assert(current_dipole_moments.ndim == 3)
+        except AssertionError:
+            raise AssertionError('current_dipole_moments.ndim != 3')
+        try:
+            assert(current_dipole_moments.shape[2] == 3)
+        except AssertionError:
+            raise AssertionError('current_dipole_moments.shape[2] != 3')
+        if kernel is None:
+            kernel = self.get_kernel(dipole_locations)
+        n_dipoles, n_timesteps = current_dipole_moments.shape[:2]
+        try:
+            assert(kernel.shape == (self.sensor_locations.shape[0],
+                                    n_dipoles, 3))
+        except AssertionError:
+            raise AssertionError('kernel.shape != (n_locations, n_dipoles, 3)')
+
+        # the cross product p x K as a matrix acting on p, M[a, b] =
+        # sum_c eps[a, b, c] K[c]
+        eps = np.zeros((3, 3, 3))
+        eps[0, 1, 2] = eps[1, 2, 0] = eps[2, 0, 1] = 1.
+        eps[0, 2, 1] = eps[2, 1, 0] = eps[1, 0, 2] = -1.
+        M = np.einsum('abc,isc->isab', eps, kernel)
+
+        if chunk_size is None:
+            chunk_size = max(n_timesteps, 1)
+        if summed:
+            H = np.empty((kernel.shape[0], n_timesteps, 3))
+            # H[i, t, a] = sum_(s, b) M[i, s, a, b] p[s, t, b] as one matrix
+            # product
+            M = M.transpose(0, 2, 1, 3).reshape(kernel.shape[0] * 3, -1)
+        else:
+            H = np.empty((kernel.shape[0], n_dipoles, n_timesteps, 3))
+        for i in range(0, n_timesteps, chunk_size):
+            p = current_dipole_moments[:, i:i + chunk_size]
+            if summed:
+                H_chunk = np.dot(M, p.transpose(0, 2, 1).reshape(
+                    n_dipoles * 3, -1))
+                H[:, i:i + chunk_size] = H_chunk.reshape(
+                    kernel.shape[0], 3, -1).transpose(0, 2, 1)
+            else:
+                H[:, :, i:i + chunk_size] = np.einsum('isab,stb->ista', M, p)
+        return H
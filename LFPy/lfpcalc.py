@@ -16,6 +16,7 @@ GNU General Public License for more details.
 
 from __future__ import division
 import numpy as np
+import scipy.sparse as sp
 
 
 def return_dist_from_segments(xstart, ystart, zstart, xend, yend, zend, p):
@@ -57,87 +58,51 @@ def calc_lfp_linesource_anisotropic(cell, x, y, z, sigma, r_limit):
     r_limit : np.ndarray
         minimum distance to source current for each compartment
     """
+    a, b, c = _anisotropic_line_source_abc(cell, x, y, z, sigma, r_limit)
+    mapping = _anisotropic_line_source_cases(a, b, c)
 
-    #some variables for h, r2, r_soma calculations
-    xstart = cell.xstart
-    xend = cell.xend
-    ystart = cell.ystart
-    yend = cell.yend
-    zstart = cell.zstart
-    zend = cell.zend
-    l_vecs = np.array([xend - xstart,
-                      yend - ystart,
-                      zend - zstart])
-
-    pos = np.array([x, y, z])
-
-    rs, closest_points = return_dist_from_segments(xstart, ystart, zstart,
-                                                   xend, yend, zend, pos)
-
-    dx2 = (xend - xstart)**2
-    dy2 = (yend - ystart)**2
-    dz2 = (zend - zstart)**2
-    a = (sigma[1] * sigma[2] * dx2 +
-         sigma[0] * sigma[2] * dy2 +
-         sigma[0] * sigma[1] * dz2)
-
-    b = -2 * (sigma[1] * sigma[2] * (x - xstart) * (xend - xstart) +
-              sigma[0] * sigma[2] * (y - ystart) * (yend - ystart) +
-              sigma[0] * sigma[1] * (z - zstart) * (zend - zstart))
-    c = (sigma[1] * sigma[2] * (x - xstart)**2 +
-         sigma[0] * sigma[2] * (y - ystart)**2 +
-         sigma[0] * sigma[1] * (z - zstart)**2)
-
-    for idx in np.where(rs < r_limit)[0]:
-        r, closest_point, l_vec = rs[idx], closest_points[:, idx], l_vecs[:, idx]
-
-        p_ = pos.copy()
-        if np.abs(r) < 1e-12:
-            if np.abs(l_vec[0]) < 1e-12:
-                p_[0] += r_limit[idx]
-            elif np.abs(l_vec[1]) < 1e-12:
-                p_[1] += r_limit[idx]
-            elif np.abs(l_vec[2]) < 1e-12:
-                p_[2] += r_limit[idx]
-            else:
-                displace_vec = np.array([-l_vec[1], l_vec[0], 0])
-                displace_vec = displace_vec / np.sqrt(np.sum(displace_vec**2)) * r_limit[idx]
-                p_[:] += displace_vec
-        else:
-            p_[:] = pos + (pos - closest_point) * (r_limit[idx] - r) / r
-
-        if np.sqrt(np.sum((p_ - closest_point)**2)) - r_limit[idx] > 1e-9:
-            print(p_, closest_point)
-
-            raise RuntimeError("Segment adjustment not working")
-
-        b[idx] = -2 * (sigma[1] * sigma[2] * (p_[0] - xstart[idx]) * (xend[idx] - xstart[idx]) +
-                   sigma[0] * sigma[2] * (p_[1] - ystart[idx]) * (yend[idx] - ystart[idx]) +
-                   sigma[0] * sigma[1] * (p_[2] - zstart[idx]) * (zend[idx] - zstart[idx]))
-        c[idx] = (sigma[1] * sigma[2] * (p_[0] - xstart[idx])**2 +
-              sigma[0] * sigma[2] * (p_[1] - ystart[idx])**2 +
-              sigma[0] * sigma[1] * (p_[2] - zstart[idx])**2)
+    return 1 / (4 * np.pi) * mapping / np.sqrt(a)
 
-    [i] = np.where(np.abs(b) <= 1e-6)
-    [iia] = np.where(np.bitwise_and(np.abs(4 * a * c - b*b) < 1e-6, np.abs(a - c) < 1e-6))
-    [iib] = np.where(np.bitwise_and(np.abs(4 * a * c - b*b) < 1e-6, np.abs(a - c) >= 1e-6))
-    [iii] = np.where(np.bitwise_and(4 * a * c - b*b < -1e-6, np.abs(b) > 1e-6))
-    [iiii] = np.where(np.bitwise_and(4 * a * c - b*b > 1e-6, np.abs(b) > 1e-6))
 
-    if len(i) + len(iia) + len(iib) + len(iii) + len(iiii) != cell.totnsegs:
-        print(a, b, c)
-        print(i, iia, iib, iii, iiii)
-        raise RuntimeError
+def calc_lfp_linesource_anisotropic_batch(cell, x, y, z, sigma, r_limit,
+                                          contact_block_size=64):
+    """Calculate electric field potential using the line-source method, all
+    compartments treated as line sources, even soma, for many extracellular
+    positions at once. Equivalent to calling
+    calc_lfp_linesource_anisotropic() for each position.
 
-    mapping = np.zeros(cell.totnsegs)
-    mapping[i] = _anisotropic_line_source_case_i(a[i], c[i])
-    mapping[iia] = _anisotropic_line_source_case_iia(a[iia], c[iia])
-    mapping[iib] = _anisotropic_line_source_case_iib(a[iib], b[iib], c[iib])
-    mapping[iii] = _anisotropic_line_source_case_iii(a[iii], b[iii], c[iii])
-    mapping[iiii] = _anisotropic_line_source_case_iiii(a[iiii], b[iiii], c[iiii])
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma : array
+        extracellular conductivity [sigma_x, sigma_y, sigma_z]
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    contact_block_size : int
+        number of positions computed at once, bounding the size of
+        temporary arrays to (contact_block_size, n_segs)
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_positions, n_segs) array
+    """
+    x, y, z = _contact_columns(x, y, z)
 
-    if np.isnan(mapping).any():
-        raise RuntimeError("NaN")
+    a = _anisotropic_line_source_a(cell, sigma)
+    mapping = np.empty((x.shape[0], cell.totnsegs))
+    for j in range(0, x.shape[0], contact_block_size):
+        block = slice(j, j + contact_block_size)
+        _, b, c = _anisotropic_line_source_abc(cell, x[block], y[block],
+                                               z[block], sigma, r_limit)
+        mapping[block] = _anisotropic_line_source_cases(a, b, c)
 
     return 1 / (4 * np.pi) * mapping / np.sqrt(a)
 
@@ -161,75 +126,163 @@ def calc_lfp_soma_as_point_anisotropic(cell, x, y, z, sigma, r_limit):
     r_limit : np.ndarray
         minimum distance to source current for each compartment
     """
+    a, b, c = _anisotropic_line_source_abc(cell, x, y, z, sigma, r_limit)
+    mapping = _anisotropic_line_source_cases(a, b, c)
+    mapping /= np.sqrt(a)
 
-    xstart = cell.xstart
-    xend = cell.xend
-    ystart = cell.ystart
-    yend = cell.yend
-    zstart = cell.zstart
-    zend = cell.zend
-    l_vecs = np.array([xend - xstart, yend - ystart, zend - zstart])
-
-    pos = np.array([x, y, z])
-
-    rs, closest_points = return_dist_from_segments(xstart, ystart, zstart, xend, yend, zend, pos)
-
-    dx2 = (xend - xstart)**2
-    dy2 = (yend - ystart)**2
-    dz2 = (zend - zstart)**2
-    a = (sigma[1] * sigma[2] * dx2 +
-         sigma[0] * sigma[2] * dy2 +
-         sigma[0] * sigma[1] * dz2)
-
-    b = -2 * (sigma[1] * sigma[2] * (x - xstart) * (xend - xstart) +
-              sigma[0] * sigma[2] * (y - ystart) * (yend - ystart) +
-              sigma[0] * sigma[1] * (z - zstart) * (zend - zstart))
-    c = (sigma[1] * sigma[2] * (x - xstart)**2 +
-         sigma[0] * sigma[2] * (y - ystart)**2 +
-         sigma[0] * sigma[1] * (z - zstart)**2)
-
-    for idx in np.where(rs < r_limit)[0]:
-        r, closest_point, l_vec = rs[idx], closest_points[:, idx], l_vecs[:, idx]
-
-        p_ = pos.copy()
-        if np.abs(r) < 1e-12:
-            if np.abs(l_vec[0]) < 1e-12:
-                p_[0] += r_limit[idx]
-            elif np.abs(l_vec[1]) < 1e-12:
-                p_[1] += r_limit[idx]
-            elif np.abs(l_vec[2]) < 1e-12:
-                p_[2] += r_limit[idx]
-            else:
-                displace_vec = np.array([-l_vec[1], l_vec[0], 0])
-                displace_vec = displace_vec / np.sqrt(np.sum(displace_vec**2)) * r_limit[idx]
-                p_[:] += displace_vec
-        else:
-            p_[:] = pos + (pos - closest_point) * (r_limit[idx] - r) / r
+    # Treat soma as point source
+    mapping[0] = _anisotropic_soma_point(cell, x, y, z, sigma, r_limit)
 
-        if np.sqrt(np.sum((p_ - closest_point)**2)) - r_limit[idx] > 1e-9:
-            print(p_, closest_point)
+    return 1 / (4 * np.pi) * mapping
 
-            raise RuntimeError("Segment adjustment not working")
 
-        b[idx] = -2 * (sigma[1] * sigma[2] * (p_[0] - xstart[idx]) * (xend[idx] - xstart[idx]) +
-                   sigma[0] * sigma[2] * (p_[1] - ystart[idx]) * (yend[idx] - ystart[idx]) +
-                   sigma[0] * sigma[1] * (p_[2] - zstart[idx]) * (zend[idx] - zstart[idx]))
-        c[idx] = (sigma[1] * sigma[2] * (p_[0] - xstart[idx])**2 +
-              sigma[0] * sigma[2] * (p_[1] - ystart[idx])**2 +
-              sigma[0] * sigma[1] * (p_[2] - zstart[idx])**2)
+def calc_lfp_soma_as_point_anisotropic_batch(cell, x, y, z, sigma, r_limit,
+                                             contact_block_size=64):
+    """Calculate electric field potential, soma is treated as point source, all
+    compartments except soma are treated as line sources, for many
+    extracellular positions at once. Equivalent to calling
+    calc_lfp_soma_as_point_anisotropic() for each position.
 
-    [i] = np.where(np.abs(b) <= 1e-6)
-    [iia] = np.where(np.bitwise_and(np.abs(4 * a * c - b*b) < 1e-6, np.abs(a - c) < 1e-6))
-    [iib] = np.where(np.bitwise_and(np.abs(4 * a * c - b*b) < 1e-6, np.abs(a - c) >= 1e-6))
-    [iii] = np.where(np.bitwise_and(4 * a * c - b*b < -1e-6, np.abs(b) > 1e-6))
-    [iiii] = np.where(np.bitwise_and(4 * a * c - b*b > 1e-6, np.abs(b) > 1e-6))
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma : array
+        extracellular conductivity [sigma_x, sigma_y, sigma_z]
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    contact_block_size : int
+        number of positions computed at once, bounding the size of
+        temporary arrays to (contact_block_size, n_segs)
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_positions, n_segs) array
+    """
+    x, y, z = _contact_columns(x, y, z)
+
+    a = _anisotropic_line_source_a(cell, sigma)
+    mapping = np.empty((x.shape[0], cell.totnsegs))
+    for j in range(0, x.shape[0], contact_block_size):
+        block = slice(j, j + contact_block_size)
+        _, b, c = _anisotropic_line_source_abc(cell, x[block], y[block],
+                                               z[block], sigma, r_limit)
+        mapping[block] = _anisotropic_line_source_cases(a, b, c)
+    mapping /= np.sqrt(a)
+
+    # Treat soma as point source
+    mapping[:, 0] = _anisotropic_soma_point(cell, x[:, 0], y[:, 0], z[:, 0],
+                                            sigma, r_limit)
+
+    return 1 / (4 * np.pi) * mapping
+
+
+def _anisotropic_line_source_abc(cell, x, y, z, sigma, r_limit):
+    """Returns the coefficients a, b, c of the anisotropic line-source
+    equation for extracellular positions x, y, z (scalars, or arrays of
+    shape (n_positions, 1)) and every segment. Positions closer than r_limit
+    to a segment are for that segment displaced to a distance of r_limit,
+    away from the closest point on the segment"""
+    xstart = cell.xstart
+    ystart = cell.ystart
+    zstart = cell.zstart
+    l_x = cell.xend - xstart
+    l_y = cell.yend - ystart
+    l_z = cell.zend - zstart
+
+    # closest point on each segment, and distance to it
+    u = ((x - xstart) * l_x + (y - ystart) * l_y + (z - zstart) * l_z) / (
+        l_x*l_x + l_y*l_y + l_z*l_z)
+    u = np.clip(u, 0., 1.)
+    closest_x = xstart + u * l_x
+    closest_y = ystart + u * l_y
+    closest_z = zstart + u * l_z
+    dx = x - closest_x
+    dy = y - closest_y
+    dz = z - closest_z
+    rs = np.sqrt(dx*dx + dy*dy + dz*dz)
+
+    # (displaced) position of the contact point relative to each segment
+    p_x = x + np.zeros(rs.shape)
+    p_y = y + np.zeros(rs.shape)
+    p_z = z + np.zeros(rs.shape)
+    r_limit = r_limit + np.zeros(rs.shape)
+    close = rs < r_limit
+    if close.any():
+        # move away from the segment along the line through the closest point
+        off = close & (np.abs(rs) >= 1e-12)
+        p_x[off] += dx[off] * (r_limit[off] - rs[off]) / rs[off]
+        p_y[off] += dy[off] * (r_limit[off] - rs[off]) / rs[off]
+        p_z[off] += dz[off] * (r_limit[off] - rs[off]) / rs[off]
+
+        # on the segment, move orthogonally to the segment
+        on = close & (np.abs(rs) < 1e-12)
+        l_x_ = l_x + np.zeros(rs.shape)
+        l_y_ = l_y + np.zeros(rs.shape)
+        l_z_ = l_z + np.zeros(rs.shape)
+        on_x = on & (np.abs(l_x_) < 1e-12)
+        on_y = on & ~on_x & (np.abs(l_y_) < 1e-12)
+        on_z = on & ~on_x & ~on_y & (np.abs(l_z_) < 1e-12)
+        on_xy = on & ~on_x & ~on_y & ~on_z
+        p_x[on_x] += r_limit[on_x]
+        p_y[on_y] += r_limit[on_y]
+        p_z[on_z] += r_limit[on_z]
+        norm = np.sqrt(l_x_[on_xy]**2 + l_y_[on_xy]**2)
+        p_x[on_xy] += -l_y_[on_xy] / norm * r_limit[on_xy]
+        p_y[on_xy] += l_x_[on_xy] / norm * r_limit[on_xy]
+
+        if (np.sqrt((p_x[close] - closest_x[close])**2 +
+                    (p_y[close] - closest_y[close])**2 +
+                    (p_z[close] - closest_z[close])**2)
+                - r_limit[close] > 1e-9).any():
+            raise RuntimeError("Segment adjustment not working")
 
-    if len(i) + len(iia) + len(iib) + len(iii) + len(iiii) != cell.totnsegs:
+    a = _anisotropic_line_source_a(cell, sigma)
+    b = -2 * (sigma[1] * sigma[2] * (p_x - xstart) * l_x +
+              sigma[0] * sigma[2] * (p_y - ystart) * l_y +
+              sigma[0] * sigma[1] * (p_z - zstart) * l_z)
+    c = (sigma[1] * sigma[2] * (p_x - xstart)**2 +
+         sigma[0] * sigma[2] * (p_y - ystart)**2 +
+         sigma[0] * sigma[1] * (p_z - zstart)**2)
+    return a, b, c
+
+
+def _anisotropic_line_source_a(cell, sigma):
+    """Returns the coefficient a of the anisotropic line-source equation for
+    every segment, which does not depend on the extracellular position"""
+    l_x = cell.xend - cell.xstart
+    l_y = cell.yend - cell.ystart
+    l_z = cell.zend - cell.zstart
+    return (sigma[1] * sigma[2] * l_x**2 +
+            sigma[0] * sigma[2] * l_y**2 +
+            sigma[0] * sigma[1] * l_z**2)
+
+
+def _anisotropic_line_source_cases(a, b, c):
+    """Returns the anisotropic line-source contributions (before scaling by
+    1 / (4 pi sqrt(a))) given the coefficients a, b, c, treating each of the
+    cases i, iia, iib, iii, iiii separately"""
+    a = a + np.zeros(b.shape)
+    d = 4 * a * c - b*b
+    i = np.abs(b) <= 1e-6
+    iia = (np.abs(d) < 1e-6) & (np.abs(a - c) < 1e-6)
+    iib = (np.abs(d) < 1e-6) & (np.abs(a - c) >= 1e-6)
+    iii = (d < -1e-6) & (np.abs(b) > 1e-6)
+    iiii = (d > 1e-6) & (np.abs(b) > 1e-6)
+
+    if i.sum() + iia.sum() + iib.sum() + iii.sum() + iiii.sum() != b.size:
         print(a, b, c)
         print(i, iia, iib, iii, iiii)
         raise RuntimeError
 
-    mapping = np.zeros(cell.totnsegs)
+    mapping = np.zeros(b.shape)
     mapping[i] = _anisotropic_line_source_case_i(a[i], c[i])
     mapping[iia] = _anisotropic_line_source_case_iia(a[iia], c[iia])
     mapping[iib] = _anisotropic_line_source_case_iib(a[iib], b[iib], c[iib])
@@ -239,34 +292,34 @@ def calc_lfp_soma_as_point_anisotropic(cell, x, y, z, sigma, r_limit):
     if np.isnan(mapping).any():
         raise RuntimeError("NaN")
 
-    mapping /= np.sqrt(a)
+    return mapping
 
-    # Treat soma as point source
+
+def _anisotropic_soma_point(cell, x, y, z, sigma, r_limit):
+    """Returns the anisotropic point-source contribution (before scaling by
+    1 / (4 pi)) of the soma segment at extracellular positions x, y, z"""
     dx2_soma = (cell.xmid[0] - x)**2
     dy2_soma = (cell.ymid[0] - y)**2
     dz2_soma = (cell.zmid[0] - z)**2
 
     r2_soma = dx2_soma + dy2_soma + dz2_soma
 
-    if np.abs(r2_soma) < 1e-6:
-        dx2_soma += 0.001
-        r2_soma += 0.001
-
+    too_close = np.abs(r2_soma) < 1e-6
+    dx2_soma = np.where(too_close, dx2_soma + 0.001, dx2_soma)
+    r2_soma = np.where(too_close, r2_soma + 0.001, r2_soma)
 
-    if r2_soma < r_limit[0]**2:
-        # For anisotropic media, the direction in which to move points matter.
-        # Radial distance between point source and electrode is scaled to r_limit
-        r2_scale_factor = r_limit[0]*r_limit[0] / r2_soma
-        dx2_soma *= r2_scale_factor
-        dy2_soma *= r2_scale_factor
-        dz2_soma *= r2_scale_factor
+    # For anisotropic media, the direction in which to move points matter.
+    # Radial distance between point source and electrode is scaled to r_limit
+    r2_scale_factor = np.where(r2_soma < r_limit[0]**2,
+                               r_limit[0]*r_limit[0] / r2_soma, 1.)
+    dx2_soma = dx2_soma * r2_scale_factor
+    dy2_soma = dy2_soma * r2_scale_factor
+    dz2_soma = dz2_soma * r2_scale_factor
 
-    mapping[0] = 1/np.sqrt(sigma[1] * sigma[2] * dx2_soma
+    return 1/np.sqrt(sigma[1] * sigma[2] * dx2_soma
                     + sigma[0] * sigma[2] * dy2_soma
                     + sigma[0] * sigma[1] * dz2_soma)
 
-    return 1 / (4 * np.pi) * mapping
-
 
 def _anisotropic_line_source_case_i(a, c):
     return np.log(np.sqrt(a / c) + np.sqrt(a / c + 1))
@@ -421,6 +474,529 @@ def calc_lfp_soma_as_point(cell, x, y, z, sigma, r_limit):
     return 1 / (4 * np.pi * sigma * deltaS) * mapping
 
 
+def calc_lfp_linesource_batch(cell, x, y, z, sigma, r_limit,
+                              contact_block_size=64):
+    """Calculate electric field potential using the line-source method, all
+    compartments treated as line sources, including soma, for many
+    extracellular positions at once. Equivalent to calling
+    calc_lfp_linesource() for each position.
+
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell like instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma : float
+        extracellular conductivity
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    contact_block_size : int
+        number of positions computed at once, bounding the size of
+        temporary arrays to (contact_block_size, n_segs)
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_positions, n_segs) array
+    """
+    x, y, z = _contact_columns(x, y, z)
+    return _linesource_batch(x, y, z, cell.xstart, cell.ystart, cell.zstart,
+                             cell.xend, cell.yend, cell.zend, sigma, r_limit,
+                             contact_block_size)
+
+
+def _linesource_batch(x, y, z, xstart, ystart, zstart, xend, yend, zend,
+                      sigma, r_limit, contact_block_size):
+    """Line-source mapping between segments with the given start and end
+    points and positions x, y, z of shape (n_positions, 1)"""
+    #some variables for h, r2 calculations that are common to all positions
+    dx = xend - xstart
+    dy = yend - ystart
+    dz = zend - zstart
+    deltaS = _deltaS_calc(xstart, xend, ystart, yend, zstart, zend)
+    r_limit2 = r_limit*r_limit
+
+    mapping = np.zeros((x.shape[0], deltaS.size))
+    for j in range(0, x.shape[0], contact_block_size):
+        block = slice(j, j + contact_block_size)
+        h = ((x[block] - xend) * dx + (y[block] - yend) * dy +
+             (z[block] - zend) * dz) / deltaS
+        r2 = abs((x[block] - xend)**2 + (y[block] - yend)**2 +
+                 (z[block] - zend)**2 - h**2)
+        r2 = np.where(r2 < r_limit2, r_limit2, r2)
+        mapping[block] = _linesource_calc_cases(h, h + deltaS, r2)
+
+    return 1 / (4 * np.pi * sigma * deltaS) * mapping
+
+
+def calc_lfp_linesource_multipole(cell, x, y, z, sigma, r_limit,
+                                  multipole_tolerance=1E-2, **kwargs):
+    """Calculate electric field potential using the line-source method close
+    to each cell, and a multipole expansion of each cell far away from it,
+    see calc_lfp_linesource_multipole_batch()
+
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell like instance
+    x : float
+        extracellular position, x-axis
+    y : float
+        extracellular position, y-axis
+    z : float
+        extracellular position, z-axis
+    sigma : float
+        extracellular conductivity
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    multipole_tolerance : float
+        bound on the truncation error of the multipole expansion, relative
+        to the bound on the dipole term
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_segs, ) array
+    """
+    return calc_lfp_linesource_multipole_batch(
+        cell, x, y, z, sigma, r_limit,
+        multipole_tolerance=multipole_tolerance)[0]
+
+
+def calc_lfp_linesource_multipole_batch(cell, x, y, z, sigma, r_limit,
+                                        multipole_tolerance=1E-2,
+                                        contact_block_size=64, **kwargs):
+    """Calculate electric field potential using the line-source method close
+    to each cell, and a multipole expansion of each cell far away from it,
+    for many extracellular positions at once, see
+    calc_lfp_linesource_multipole_factored()
+
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell like instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma : float
+        extracellular conductivity
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    multipole_tolerance : float
+        bound on the truncation error of the multipole expansion, relative
+        to the bound on the dipole term
+    contact_block_size : int
+        number of positions computed at once with the line-source method
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_positions, n_segs) array
+    """
+    near, far, moments = calc_lfp_linesource_multipole_factored(
+        cell, x, y, z, sigma, r_limit,
+        multipole_tolerance=multipole_tolerance,
+        contact_block_size=contact_block_size)
+    return near.toarray() + far.dot(moments).toarray()
+
+
+def calc_lfp_linesource_multipole_factored(cell, x, y, z, sigma, r_limit,
+                                           multipole_tolerance=1E-2,
+                                           contact_block_size=64, **kwargs):
+    """Calculate the mapping between transmembrane currents and electric
+    field potential at many extracellular positions using the line-source
+    method close to each cell, and a multipole expansion of each cell far
+    away from it.
+
+    Segments are grouped by cell according to the attribute cellidx of cell
+    if it exists (e.g., the DummyCell of LFPy.Network), otherwise all
+    segments belong to one cell. Each cell is expanded around the center c
+    of the bounding box of its segments, and contained in a sphere of
+    radius a around c. For positions at distance R > a from c where
+    (a/R)**2 / (1 - a/R) <= multipole_tolerance, the potential of the cell
+    is computed from its monopole, dipole and quadrupole terms. The
+    truncation error is then bounded by multipole_tolerance times
+    sum(abs(I)) * a / (4 * pi * sigma * R**2), the bound on the dipole term.
+    At all other positions the line-source method is used.
+
+    The mapping is returned in factored form, such that the potential is
+    near.dot(I) + far.dot(moments.dot(I)) for transmembrane currents I, as
+    for calc_lfp_linesource_octree(). Far away from the cells, the factors
+    hold 10 elements per position and cell, and 10 per segment, instead of
+    one per position and segment, such that storing and applying the
+    mapping is cheaper than the dense mapping for more than about 10
+    positions.
+
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell like instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma : float
+        extracellular conductivity
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    multipole_tolerance : float
+        bound on the truncation error of the multipole expansion, relative
+        to the bound on the dipole term
+    contact_block_size : int
+        number of positions computed at once with the line-source method
+
+    Returns
+    -------
+    near : scipy.sparse.csr_matrix
+        shape (n_positions, n_segs) line-source mapping of segments of
+        cells close to each position
+    far : scipy.sparse.csr_matrix
+        shape (n_positions, 10 * n_cells) mapping from multipole moments of
+        cells to potential
+    moments : scipy.sparse.csr_matrix
+        shape (10 * n_cells, n_segs) mapping from transmembrane currents to
+        monopole, dipole and quadrupole moments of cells, see
+        _multipole_moments()
+    """
+    x, y, z = _contact_columns(x, y, z)
+    positions = np.c_[x, y, z]
+    start = np.c_[cell.xstart, cell.ystart, cell.zstart]
+    end = np.c_[cell.xend, cell.yend, cell.zend]
+    r_limit = np.ones(start.shape[0]) * r_limit
+    nsegs = start.shape[0]
+
+    # indices of the segments of each cell
+    if getattr(cell, 'cellidx', None) is not None:
+        order = np.argsort(cell.cellidx, kind='mergesort')
+        _, bounds = np.unique(cell.cellidx[order], return_index=True)
+        groups = np.split(order, bounds[1:])
+    else:
+        groups = [np.arange(nsegs)]
+
+    near = ([], [], [])
+    far = ([], [], [])
+    moments = ([], [], [])
+    ncells = 0 # number of cells with multipole contributions
+    for idx in groups:
+        if idx.size == 0:
+            continue
+        points = np.r_[start[idx], end[idx]]
+        center = (points.min(axis=0) + points.max(axis=0)) / 2
+        a = np.sqrt(((points - center)**2).sum(axis=1)).max()
+        R = np.sqrt(((positions - center)**2).sum(axis=1))
+        with np.errstate(divide='ignore'):
+            t = a / R
+        isfar = (t < 1) & (t * t <= multipole_tolerance * (1 - t))
+
+        if isfar.any():
+            rows = np.where(isfar)[0]
+            cols = 10 * ncells + np.arange(10)
+            G = _multipole_kernel(positions[isfar] - center, sigma)
+            far[0].append(np.repeat(rows, 10))
+            far[1].append(np.tile(cols, rows.size))
+            far[2].append(G.ravel())
+            T = _multipole_moments(start[idx] - center, end[idx] - center)
+            moments[0].append(np.repeat(cols, idx.size))
+            moments[1].append(np.tile(idx, 10))
+            moments[2].append(T.ravel())
+            ncells += 1
+        if not isfar.all():
+            rows = np.where(~isfar)[0]
+            M = _linesource_batch(x[rows], y[rows], z[rows],
+                                  start[idx, 0], start[idx, 1], start[idx, 2],
+                                  end[idx, 0], end[idx, 1], end[idx, 2],
+                                  sigma, r_limit[idx], contact_block_size)
+            near[0].append(np.repeat(rows, idx.size))
+            near[1].append(np.tile(idx, rows.size))
+            near[2].append(M.ravel())
+
+    return (_coo_to_csr(near, (positions.shape[0], nsegs)),
+            _coo_to_csr(far, (positions.shape[0], 10 * ncells)),
+            _coo_to_csr(moments, (10 * ncells, nsegs)))
+
+
+def calc_lfp_linesource_octree(cell, x, y, z, sigma, r_limit,
+                               multipole_tolerance=1E-2, leaf_size=32,
+                               contact_block_size=64, **kwargs):
+    """Calculate the mapping between transmembrane currents and electric
+    field potential at many extracellular positions with a Barnes-Hut type
+    octree summation over all segments of cell.
+
+    Segments are split recursively into octants of the bounding box of
+    their midpoints until each leaf node contains at most leaf_size
+    segments. Each node is contained in a sphere of radius a around the
+    center c of the bounding box of its segments. Starting from the root
+    node, the contribution of a node to a position at distance R from c is
+    computed from the monopole, dipole and quadrupole terms of its segments
+    if R > a and (a/R)**2 / (1 - a/R) <= multipole_tolerance (see
+    calc_lfp_linesource_multipole_batch), otherwise from its children, or
+    with the line-source method for leaf nodes.
+
+    The mapping is returned in factored form, such that the potential is
+    near.dot(I) + far.dot(moments.dot(I)) for transmembrane currents I.
+    Both the number of nonzero elements and the cost of computing the
+    factors scale as O(n_positions * log(n_segs) + n_segs * log(n_segs))
+    for large, spatially extended populations of cells.
+
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell like instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma : float
+        extracellular conductivity
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    multipole_tolerance : float
+        bound on the truncation error of the multipole expansion of each
+        node, relative to the bound on its dipole term
+    leaf_size : int
+        maximum number of segments of leaf nodes
+    contact_block_size : int
+        number of positions computed at once with the line-source method
+
+    Returns
+    -------
+    near : scipy.sparse.csr_matrix
+        shape (n_positions, n_segs) line-source mapping of nearby segments
+    far : scipy.sparse.csr_matrix
+        shape (n_positions, 10 * n_nodes) mapping from multipole moments of
+        nodes to potential
+    moments : scipy.sparse.csr_matrix
+        shape (10 * n_nodes, n_segs) mapping from transmembrane currents to
+        monopole, dipole and quadrupole moments of nodes, see
+        _multipole_moments()
+    """
+    x, y, z = _contact_columns(x, y, z)
+    positions = np.c_[x, y, z]
+    start = np.c_[cell.xstart, cell.ystart, cell.zstart]
+    end = np.c_[cell.xend, cell.yend, cell.zend]
+    r_limit = np.ones(start.shape[0]) * r_limit
+    nsegs = start.shape[0]
+
+    near = ([], [], [])
+    far = ([], [], [])
+    moments = ([], [], [])
+    nnodes = 0 # number of nodes with multipole contributions
+    if nsegs > 0:
+        nodes = _octree_nodes(start, end, leaf_size)
+        stack = [(0, np.arange(positions.shape[0]))]
+        while stack:
+            k, contacts = stack.pop()
+            idx, children = nodes[k]
+            s, e = start[idx], end[idx]
+            center = (np.minimum(s.min(axis=0), e.min(axis=0)) +
+                      np.maximum(s.max(axis=0), e.max(axis=0))) / 2
+            a = np.sqrt(max(((s - center)**2).sum(axis=1).max(),
+                            ((e - center)**2).sum(axis=1).max()))
+            R = np.sqrt(((positions[contacts] - center)**2).sum(axis=1))
+            with np.errstate(divide='ignore'):
+                t = a / R
+            isfar = (t < 1) & (t * t <= multipole_tolerance * (1 - t))
+
+            if isfar.any():
+                cols = 10 * nnodes + np.arange(10)
+                G = _multipole_kernel(positions[contacts[isfar]] - center,
+                                      sigma)
+                far[0].append(np.repeat(contacts[isfar], 10))
+                far[1].append(np.tile(cols, isfar.sum()))
+                far[2].append(G.ravel())
+                T = _multipole_moments(s - center, e - center)
+                moments[0].append(np.repeat(cols, idx.size))
+                moments[1].append(np.tile(idx, 10))
+                moments[2].append(T.ravel())
+                nnodes += 1
+
+            contacts = contacts[~isfar]
+            if contacts.size == 0:
+                continue
+            if children:
+                stack += [(child, contacts) for child in children]
+            else:
+                M = _linesource_batch(x[contacts], y[contacts], z[contacts],
+                                      start[idx, 0], start[idx, 1],
+                                      start[idx, 2], end[idx, 0],
+                                      end[idx, 1], end[idx, 2], sigma,
+                                      r_limit[idx], contact_block_size)
+                near[0].append(np.repeat(contacts, idx.size))
+                near[1].append(np.tile(idx, contacts.size))
+                near[2].append(M.ravel())
+
+    return (_coo_to_csr(near, (positions.shape[0], nsegs)),
+            _coo_to_csr(far, (positions.shape[0], 10 * nnodes)),
+            _coo_to_csr(moments, (10 * nnodes, nsegs)))
+
+
+def _coo_to_csr(coo, shape):
+    """Return scipy.sparse.csr_matrix with shape from lists of row indices,
+    column indices and values"""
+    if len(coo[0]) == 0:
+        return sp.csr_matrix(shape)
+    return sp.csr_matrix((np.concatenate(coo[2]),
+                          (np.concatenate(coo[0]), np.concatenate(coo[1]))),
+                         shape=shape)
+
+
+def _octree_nodes(start, end, leaf_size):
+    """Split segments with start and end points recursively into octants of
+    the bounding box of their midpoints. Returns list of [idx, children],
+    with indices idx of the segments of each node and list of indices of
+    its child nodes, empty for leaf nodes. The first node is the root."""
+    mid = (start + end) / 2
+    nodes = [[np.arange(mid.shape[0]), []]]
+    i = 0
+    while i < len(nodes):
+        idx = nodes[i][0]
+        lo = mid[idx].min(axis=0)
+        hi = mid[idx].max(axis=0)
+        if idx.size > leaf_size and np.any(hi > lo):
+            octant = np.dot(mid[idx] > (lo + hi) / 2, [1, 2, 4])
+            for o in np.unique(octant):
+                nodes[i][1].append(len(nodes))
+                nodes.append([idx[octant == o], []])
+        i += 1
+    return nodes
+
+
+def _multipole_moments(start, end):
+    """Return shape (10, n_segs) array T mapping transmembrane currents I of
+    line source segments with start and end points relative to the expansion
+    center to the monopole, dipole and quadrupole moments T.dot(I). The
+    quadrupole moments are the components (xx, yy, zz, xy, xz, yz) of
+    3 * S - trace(S) * eye(3), with S = m m^T + dr dr^T / 12 for segment
+    midpoint m and dr = end - start."""
+    m = (start + end) / 2
+    dr = end - start
+    # index pairs of the quadrupole components
+    i, j = [0, 1, 2, 0, 0, 1], [0, 1, 2, 1, 2, 2]
+    T = np.empty((10, m.shape[0]))
+    T[0] = 1
+    T[1:4] = m.T
+    T[4:] = 3 * (m[:, i] * m[:, j] + dr[:, i] * dr[:, j] / 12).T
+    T[4:7] -= ((m**2).sum(axis=1) + (dr**2).sum(axis=1) / 12)
+    return T
+
+
+def _multipole_kernel(r, sigma):
+    """Return shape (n_positions, 10) array G of potentials per unit
+    monopole, dipole and quadrupole moment (see _multipole_moments) at
+    positions r relative to the expansion center"""
+    R = np.sqrt((r**2).sum(axis=1))
+    n = r / R[:, np.newaxis]
+    G = np.empty((r.shape[0], 10))
+    G[:, 0] = 1 / R
+    G[:, 1:4] = n / (R**2)[:, np.newaxis]
+    G[:, 4:] = n[:, [0, 1, 2, 0, 0, 1]] * n[:, [0, 1, 2, 1, 2, 2]]
+    G[:, 4:] *= (np.array([1, 1, 1, 2, 2, 2]) / (2 * R**3)[:, np.newaxis])
+    return G * (1 / (4 * np.pi * sigma))
+
+
+def calc_lfp_soma_as_point_batch(cell, x, y, z, sigma, r_limit,
+                                 contact_block_size=64):
+    """Calculate electric field potential using the line-source method,
+    soma is treated as point/sphere source, for many extracellular positions
+    at once. Equivalent to calling calc_lfp_soma_as_point() for each
+    position.
+
+    Parameters
+    ----------
+    cell: obj
+        `LFPy.Cell` or `LFPy.TemplateCell` like instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma : float
+        extracellular conductivity in S/m
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment.
+    contact_block_size : int
+        number of positions computed at once, bounding the size of
+        temporary arrays to (contact_block_size, n_segs)
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_positions, n_segs) array
+    """
+    x, y, z = _contact_columns(x, y, z)
+
+    #some variables for h, r2, r_soma calculations common to all positions
+    xend = cell.xend
+    yend = cell.yend
+    zend = cell.zend
+    dx = xend - cell.xstart
+    dy = yend - cell.ystart
+    dz = zend - cell.zstart
+    deltaS = _deltaS_calc(cell.xstart, xend, cell.ystart, yend,
+                          cell.zstart, zend)
+    r_limit2 = r_limit*r_limit
+
+    r_soma = _r_soma_calc(cell.xmid[0], cell.ymid[0], cell.zmid[0],
+                          x[:, 0], y[:, 0], z[:, 0])
+    for r in r_soma[r_soma < r_limit[0]]:
+        print('Adjusting r-distance to soma segment from %g to %g'
+                % (r, r_limit[0]))
+    r_soma[r_soma < r_limit[0]] = r_limit[0]
+
+    mapping = np.zeros((x.shape[0], deltaS.size))
+    for j in range(0, x.shape[0], contact_block_size):
+        block = slice(j, j + contact_block_size)
+        # Ensuring that soma is not treated as line-source
+        h = ((x[block] - xend[1:]) * dx[1:] + (y[block] - yend[1:]) * dy[1:] +
+             (z[block] - zend[1:]) * dz[1:]) / deltaS[1:]
+        r2 = abs((x[block] - xend[1:])**2 + (y[block] - yend[1:])**2 +
+                 (z[block] - zend[1:])**2 - h**2)
+        r2 = np.where(r2 < r_limit2[1:], r_limit2[1:], r2)
+        mapping[block, 1:] = _linesource_calc_cases(h, h + deltaS[1:], r2)
+    mapping[:, 0] = 1 / r_soma
+    deltaS[0] = 1.
+
+    return 1 / (4 * np.pi * sigma * deltaS) * mapping
+
+
+def _contact_columns(x, y, z):
+    """Return extracellular positions as column vectors of shape
+    (n_positions, 1) for broadcasting against segment arrays"""
+    x = np.asarray(x, dtype=float).reshape((-1, 1))
+    y = np.asarray(y, dtype=float).reshape((-1, 1))
+    z = np.asarray(z, dtype=float).reshape((-1, 1))
+    return x, y, z
+
+
+def _linesource_calc_cases(h, l, r2):
+    """Returns linesource contributions for arrays h, l, r2 of any shape.
+
+    Cases i (h < 0, l < 0), ii (h < 0, l >= 0) and iii (h >= 0, l >= 0) of
+    calc_lfp_linesource() all equal log(A / B) with
+    A = sqrt(l**2 + r2) + l and B = sqrt(h**2 + r2) + h, where A and B are
+    computed as r2 / (sqrt(l**2 + r2) - l) for l < 0 and
+    r2 / (sqrt(h**2 + r2) - h) for h < 0 to avoid cancellation, allowing all
+    cases to be computed without indexing."""
+    sl = np.sqrt(l*l + r2)
+    sh = np.sqrt(h*h + r2)
+    A = np.where(l < 0, r2 / (sl - l), sl + l)
+    B = np.where(h < 0, r2 / (sh - h), sh + h)
+    return np.log(A / B)
+
+
 def _linesource_calc_case1(l_i, r2_i, h_i):
     """Calculates linesource contribution for case i"""
     bb = np.sqrt(h_i*h_i + r2_i) - h_i
@@ -499,6 +1075,48 @@ def calc_lfp_pointsource(cell, x, y, z, sigma, r_limit):
     return mapping
 
 
+def calc_lfp_pointsource_batch(cell, x, y, z, sigma, r_limit,
+                               contact_block_size=64):
+    """Calculate extracellular potentials using the point-source
+    equation on all compartments for many extracellular positions at once.
+    Equivalent to calling calc_lfp_pointsource() for each position.
+
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell like instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma : float
+        extracellular conductivity
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    contact_block_size : int
+        number of positions computed at once, bounding the size of
+        temporary arrays to (contact_block_size, n_segs)
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_positions, n_segs) array
+    """
+    x, y, z = _contact_columns(x, y, z)
+    r_limit2 = r_limit*r_limit
+
+    mapping = np.empty((x.shape[0], cell.xmid.size))
+    for j in range(0, x.shape[0], contact_block_size):
+        block = slice(j, j + contact_block_size)
+        r2 = ((cell.xmid - x[block])**2 + (cell.ymid - y[block])**2 +
+              (cell.zmid - z[block])**2)
+        r2 = np.where(r2 < r_limit2, r_limit2, r2)
+        mapping[block] = 1 / (4 * np.pi * sigma * np.sqrt(r2))
+    return mapping
+
+
 def calc_lfp_pointsource_anisotropic(cell, x, y, z, sigma, r_limit):
     """Calculate extracellular potentials using the anisotropic point-source
     equation on all compartments
@@ -545,6 +1163,63 @@ def calc_lfp_pointsource_anisotropic(cell, x, y, z, sigma, r_limit):
     return mapping
 
 
+def calc_lfp_pointsource_anisotropic_batch(cell, x, y, z, sigma, r_limit,
+                                           contact_block_size=64):
+    """Calculate extracellular potentials using the anisotropic point-source
+    equation on all compartments for many extracellular positions at once.
+    Equivalent to calling calc_lfp_pointsource_anisotropic() for each
+    position.
+
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma : array
+        extracellular conductivity in [x,y,z]-direction
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    contact_block_size : int
+        number of positions computed at once, bounding the size of
+        temporary arrays to (contact_block_size, n_segs)
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_positions, n_segs) array
+    """
+    x, y, z = _contact_columns(x, y, z)
+    r_limit2 = r_limit*r_limit
+
+    mapping = np.empty((x.shape[0], cell.xmid.size))
+    for j in range(0, x.shape[0], contact_block_size):
+        block = slice(j, j + contact_block_size)
+        dx2 = (cell.xmid - x[block])**2
+        dy2 = (cell.ymid - y[block])**2
+        dz2 = (cell.zmid - z[block])**2
+
+        r2 = dx2 + dy2 + dz2
+        too_close = np.abs(r2) < 1e-6
+        dx2 = np.where(too_close, dx2 + 0.001, dx2)
+        r2 = np.where(too_close, r2 + 0.001, r2)
+
+        # Radial distance between point source and electrode is scaled to
+        # r_limit
+        r2_scale_factor = np.where(r2 < r_limit2, r_limit2 / r2, 1.)
+
+        sigma_r = np.sqrt(sigma[1] * sigma[2] * dx2 * r2_scale_factor
+                        + sigma[0] * sigma[2] * dy2 * r2_scale_factor
+                        + sigma[0] * sigma[1] * dz2 * r2_scale_factor)
+
+        mapping[block] = 1 / (4 * np.pi * sigma_r)
+    return mapping
+
+
 def _check_rlimit_point(r2, r_limit):
     """Correct r2 so that r2 >= r_limit**2 for all values"""
     inds = r2 < r_limit*r_limit
@@ -553,7 +1228,8 @@ def _check_rlimit_point(r2, r_limit):
 
 
 def calc_lfp_pointsource_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
-                             steps, h, r_limit, **kwargs):
+                             steps, h, r_limit, tolerance=None,
+                             accelerate=False, return_error=False, **kwargs):
     """Calculate extracellular potentials using the point-source
     equation on all compartments for in vitro Microelectrode Array (MEA) slices
 
@@ -580,39 +1256,92 @@ def calc_lfp_pointsource_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
         Slice thickness in um.
     r_limit : np.ndarray
         minimum distance to source current for each compartment
+    tolerance : None or float
+        if not None, terminate the image series once the estimated
+        truncation error of every element is below tolerance relative to the
+        element, or after steps terms
+    accelerate : bool
+        if True, apply Aitken's delta-squared extrapolation to the partial
+        sums of the image series
+    return_error : bool
+        if True, also return the estimated truncation error of each element
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_segs, ) array
+    error : np.ndarray
+        shape (n_segs, ) array with estimated truncation error of each
+        element of mapping. Only returned if return_error is True
     """
+    mapping, error = _pointsource_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
+                                      steps, h, r_limit, tolerance, accelerate)
+    if return_error:
+        return mapping, error
+    return mapping
 
-    dx2 = (x - cell.xmid)**2
-    dy2 = (y - cell.ymid)**2
-    dz2 = (z - cell.zmid)**2
-
-    dL2 = dx2 + dy2
-    inds = np.where(dL2 + dz2 < r_limit*r_limit)[0]
-    dL2[inds] = r_limit[inds]*r_limit[inds] - dz2[inds]
-
-    def _omega(dz):
-        return 1/np.sqrt(dL2 + dz*dz)
-
-    WTS = (sigma_T - sigma_S)/(sigma_T + sigma_S)
-    WTG = (sigma_T - sigma_G)/(sigma_T + sigma_G)
-
-    mapping = _omega(z - cell.zmid)
-    mapping += (WTS * _omega(z + cell.zmid - 2*h) +
-                WTG * _omega(z + cell.zmid))
 
-    n = np.arange(1, steps)
-    a = (WTS*WTG)**n[:, None] * (WTS * _omega(z + cell.zmid - 2*(n[:, None] + 1)*h) +
-                                 WTG * _omega(z + cell.zmid + 2*n[:, None]*h) +
-                                 _omega(z - cell.zmid + 2*n[:, None]*h) +
-                                 _omega(z - cell.zmid - 2*n[:, None]*h))
-    mapping += np.sum(a, axis=0)
-    mapping *= 1/(4*np.pi*sigma_T)
+def calc_lfp_pointsource_moi_batch(cell, x, y, z, sigma_T, sigma_S, sigma_G,
+                                   steps, h, r_limit, tolerance=None,
+                                   accelerate=False, return_error=False,
+                                   contact_block_size=64, **kwargs):
+    """Calculate extracellular potentials using the point-source
+    equation on all compartments for in vitro Microelectrode Array (MEA) slices
+    for many extracellular positions at once. Equivalent to calling
+    calc_lfp_pointsource_moi() for each position.
 
-    return mapping
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell like instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma_T : float
+        extracellular conductivity in tissue slice
+    sigma_G : float
+        Conductivity of MEA glass electrode plane.
+        Should normally be zero for MEA set up.
+    sigma_S : float
+        Conductivity of saline bath that tissue slice is immersed in
+    steps : int
+        Number of steps to average over the in technically infinite sum
+    h : float
+        Slice thickness in um.
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    tolerance : None or float
+        if not None, terminate the image series once the estimated
+        truncation error of every element is below tolerance relative to the
+        element, or after steps terms
+    accelerate : bool
+        if True, apply Aitken's delta-squared extrapolation to the partial
+        sums of the image series
+    return_error : bool
+        if True, also return the estimated truncation error of each element
+    contact_block_size : int
+        number of positions computed at once, bounding the size of
+        temporary arrays to (contact_block_size, n_segs)
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_positions, n_segs) array
+    error : np.ndarray
+        shape (n_positions, n_segs) array with estimated truncation error of
+        each element of mapping. Only returned if return_error is True
+    """
+    return _moi_batch(_pointsource_moi, cell, x, y, z, sigma_T, sigma_S,
+                      sigma_G, steps, h, r_limit, tolerance, accelerate,
+                      return_error, contact_block_size)
 
 
 def calc_lfp_linesource_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
-                             steps, h, r_limit, **kwargs):
+                             steps, h, r_limit, tolerance=None,
+                             accelerate=False, return_error=False, **kwargs):
     """Calculate extracellular potentials using the line-source
     equation on all compartments for in vitro Microelectrode Array (MEA) slices
 
@@ -640,75 +1369,93 @@ def calc_lfp_linesource_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
         Slice thickness in um.
     r_limit : np.ndarray
         minimum distance to source current for each compartment
+    tolerance : None or float
+        if not None, terminate the image series once the estimated
+        truncation error of every element is below tolerance relative to the
+        element, or after steps terms
+    accelerate : bool
+        if True, apply Aitken's delta-squared extrapolation to the partial
+        sums of the image series
+    return_error : bool
+        if True, also return the estimated truncation error of each element
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_segs, ) array
+    error : np.ndarray
+        shape (n_segs, ) array with estimated truncation error of each
+        element of mapping. Only returned if return_error is True
     """
+    mapping, error = _linesource_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
+                                     steps, h, r_limit, tolerance, accelerate)
+    if return_error:
+        return mapping, error
+    return mapping
 
-    if np.abs(z) > 1e-9:
-        raise RuntimeError("This method can only handle electrodes "
-                           "at the MEA plane z=0")
-    if np.abs(sigma_G) > 1e-9:
-        raise RuntimeError("This method can only handle sigma_G=0, i.e.,"
-                           "a non-conducting MEA glass electrode plane.")
-
-    xstart = cell.xstart
-    xend = cell.xend
-    ystart = cell.ystart
-    yend = cell.yend
-    zstart = cell.zstart
-    zend = cell.zend
-    x0, y0, z0 = cell.xstart, cell.ystart, cell.zstart
-    x1, y1, z1 = cell.xend, cell.yend, cell.zend
-
-    pos = np.array([x, y, z])
-    rs, closest_points = return_dist_from_segments(xstart, ystart, zstart,
-                                                   xend, yend, zend, pos)
-    z0_ = z0.copy()
-    z0_[np.where(rs < r_limit)] = r_limit[np.where(rs < r_limit)]
-
-    ds = _deltaS_calc(xstart, xend, ystart, yend, zstart, zend)
-    factor_a = ds*ds
-    dx = x1 - x0
-    dy = y1 - y0
-    dz = z1 - z0
-    a_x = x - x0
-    a_y = y - y0
-    W = (sigma_T - sigma_S)/(sigma_T + sigma_S)
-    num = np.zeros(factor_a.shape)
-    den = np.zeros(factor_a.shape)
-
-    def _omega(a_z):
-        #See Rottman integration formula 46) page 137 for explanation
-
-        factor_b = - a_x*dx - a_y*dy - a_z*dz
-        factor_c = a_x*a_x + a_y*a_y + a_z*a_z
-        b_2_ac = factor_b*factor_b - factor_a * factor_c
-
-        case1_idxs = np.where(np.abs(b_2_ac) <= 1e-12)
-        case2_idxs = np.where(np.abs(b_2_ac) > 1e-12)
-
-        if not len(case1_idxs) == 0:
-            num[case1_idxs] = factor_a[case1_idxs] + factor_b[case1_idxs]
-            den[case1_idxs] = factor_b[case1_idxs]
-        if not len(case2_idxs) == 0:
-            num[case2_idxs] = (factor_a[case2_idxs] + factor_b[case2_idxs] +
-                               ds[case2_idxs]*np.sqrt(factor_a[case2_idxs] +
-                               2*factor_b[case2_idxs] + factor_c[case2_idxs]))
-            den[case2_idxs] = (factor_b[case2_idxs] +
-                               ds[case2_idxs]*np.sqrt(factor_c[case2_idxs]))
-        return np.log(num/den)
-
-    mapping = _omega(-z0_)
-    n = 1
-    while n < steps:
-        mapping += W**n * (_omega(2*n*h - z0_) + _omega(-2*n*h - z0_))
-        n += 1
 
-    mapping *= 2/(4*np.pi*sigma_T * ds)
+def calc_lfp_linesource_moi_batch(cell, x, y, z, sigma_T, sigma_S, sigma_G,
+                                  steps, h, r_limit, tolerance=None,
+                                  accelerate=False, return_error=False,
+                                  contact_block_size=64, **kwargs):
+    """Calculate extracellular potentials using the line-source
+    equation on all compartments for in vitro Microelectrode Array (MEA) slices
+    for many extracellular positions at once. Equivalent to calling
+    calc_lfp_linesource_moi() for each position.
 
-    return mapping
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell like instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma_T : float
+        extracellular conductivity in tissue slice
+    sigma_G : float
+        Conductivity of MEA glass electrode plane.
+        Should normally be zero for MEA set up, and for this method,
+        only zero valued sigma_G is supported.
+    sigma_S : float
+        Conductivity of saline bath that tissue slice is immersed in
+    steps : int
+        Number of steps to average over the in technically infinite sum
+    h : float
+        Slice thickness in um.
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    tolerance : None or float
+        if not None, terminate the image series once the estimated
+        truncation error of every element is below tolerance relative to the
+        element, or after steps terms
+    accelerate : bool
+        if True, apply Aitken's delta-squared extrapolation to the partial
+        sums of the image series
+    return_error : bool
+        if True, also return the estimated truncation error of each element
+    contact_block_size : int
+        number of positions computed at once, bounding the size of
+        temporary arrays to (contact_block_size, n_segs)
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_positions, n_segs) array
+    error : np.ndarray
+        shape (n_positions, n_segs) array with estimated truncation error of
+        each element of mapping. Only returned if return_error is True
+    """
+    return _moi_batch(_linesource_moi, cell, x, y, z, sigma_T, sigma_S,
+                      sigma_G, steps, h, r_limit, tolerance, accelerate,
+                      return_error, contact_block_size)
 
 
 def calc_lfp_soma_as_point_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
-                             steps, h, r_limit, **kwargs):
+                             steps, h, r_limit, tolerance=None,
+                             accelerate=False, return_error=False, **kwargs):
     """Calculate extracellular potentials for in vitro
     Microelectrode Array (MEA) slices, where soma (compartment zero) is
     treated as a point source, and all other compartments as line sources.
@@ -737,31 +1484,227 @@ def calc_lfp_soma_as_point_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
         Slice thickness in um.
     r_limit : np.ndarray
         minimum distance to source current for each compartment
+    tolerance : None or float
+        if not None, terminate the image series once the estimated
+        truncation error of every element is below tolerance relative to the
+        element, or after steps terms
+    accelerate : bool
+        if True, apply Aitken's delta-squared extrapolation to the partial
+        sums of the image series
+    return_error : bool
+        if True, also return the estimated truncation error of each element
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_segs, ) array
+    error : np.ndarray
+        shape (n_segs, ) array with estimated truncation error of each
+        element of mapping. Only returned if return_error is True
     """
+    mapping, error = _soma_as_point_moi(cell, x, y, z, sigma_T, sigma_S,
+                                        sigma_G, steps, h, r_limit, tolerance,
+                                        accelerate)
+    if return_error:
+        return mapping, error
+    return mapping
 
-    if np.abs(z) > 1e-9:
+
+def calc_lfp_soma_as_point_moi_batch(cell, x, y, z, sigma_T, sigma_S, sigma_G,
+                                     steps, h, r_limit, tolerance=None,
+                                     accelerate=False, return_error=False,
+                                     contact_block_size=64, **kwargs):
+    """Calculate extracellular potentials for in vitro
+    Microelectrode Array (MEA) slices, where soma (compartment zero) is
+    treated as a point source, and all other compartments as line sources,
+    for many extracellular positions at once. Equivalent to calling
+    calc_lfp_soma_as_point_moi() for each position.
+
+    Parameters
+    ----------
+    cell: obj
+        LFPy.Cell or LFPy.TemplateCell like instance
+    x : np.ndarray
+        extracellular positions, x-axis
+    y : np.ndarray
+        extracellular positions, y-axis
+    z : np.ndarray
+        extracellular positions, z-axis
+    sigma_T : float
+        extracellular conductivity in tissue slice
+    sigma_G : float
+        Conductivity of MEA glass electrode plane.
+        Should normally be zero for MEA set up, and for this method,
+        only zero valued sigma_G is supported.
+    sigma_S : float
+        Conductivity of saline bath that tissue slice is immersed in
+    steps : int
+        Number of steps to average over the in technically infinite sum
+    h : float
+        Slice thickness in um.
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    tolerance : None or float
+        if not None, terminate the image series once the estimated
+        truncation error of every element is below tolerance relative to the
+        element, or after steps terms
+    accelerate : bool
+        if True, apply Aitken's delta-squared extrapolation to the partial
+        sums of the image series
+    return_error : bool
+        if True, also return the estimated truncation error of each element
+    contact_block_size : int
+        number of positions computed at once, bounding the size of
+        temporary arrays to (contact_block_size, n_segs)
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_positions, n_segs) array
+    error : np.ndarray
+        shape (n_positions, n_segs) array with estimated truncation error of
+        each element of mapping. Only returned if return_error is True
+    """
+    return _moi_batch(_soma_as_point_moi, cell, x, y, z, sigma_T, sigma_S,
+                      sigma_G, steps, h, r_limit, tolerance, accelerate,
+                      return_error, contact_block_size)
+
+
+def _moi_batch(moi_method, cell, x, y, z, sigma_T, sigma_S, sigma_G, steps, h,
+               r_limit, tolerance, accelerate, return_error,
+               contact_block_size):
+    """Apply moi_method to blocks of contact_block_size positions"""
+    x, y, z = _contact_columns(x, y, z)
+
+    mapping = np.empty((x.shape[0], cell.totnsegs))
+    error = np.empty((x.shape[0], cell.totnsegs))
+    for j in range(0, x.shape[0], contact_block_size):
+        block = slice(j, j + contact_block_size)
+        mapping[block], error[block] = moi_method(cell, x[block], y[block],
+                                                  z[block], sigma_T, sigma_S,
+                                                  sigma_G, steps, h, r_limit,
+                                                  tolerance, accelerate)
+    if return_error:
+        return mapping, error
+    return mapping
+
+
+def _sum_image_series(first, term, steps, ratio, tolerance=None,
+                      accelerate=False):
+    """Sum the method of images series first + sum_{n=1}^{steps-1} term(n)
+    element-wise, where the terms are bounded by ratio**n times a factor that
+    decreases with n.
+
+    Without acceleration, the truncation error after n terms is estimated
+    by the bound abs(term(n)) * ratio / (1 - ratio) of the remaining terms.
+    With acceleration, Aitken's delta-squared extrapolation
+    S_n + t_n * r_n / (1 - r_n), with r_n = t_n / t_{n-1}, is applied to the
+    partial sums S_n, and the error is estimated as the change of the
+    extrapolated sum over the last term.
+
+    Parameters
+    ----------
+    first : np.ndarray
+        zeroth term of the series
+    term : function
+        term(n) returns the n-th term of the series of same shape as first
+    steps : int
+        maximum number of terms (including the zeroth term)
+    ratio : float
+        bound for the ratio of consecutive terms
+    tolerance : None or float
+        if not None, stop once the estimated error of every element is below
+        tolerance relative to the element
+    accelerate : bool
+        if True, apply Aitken's delta-squared extrapolation
+
+    Returns
+    -------
+    mapping : np.ndarray
+        the (extrapolated) sum of the series
+    error : np.ndarray
+        estimated truncation error of each element of mapping
+    """
+    if ratio < 1:
+        bound = ratio / (1 - ratio)
+    else:
+        bound = np.inf
+    mapping = first
+    result = mapping
+    error = np.zeros(mapping.shape)
+    t_prev = None
+    for n in range(1, steps):
+        t = term(n)
+        mapping = mapping + t
+        if accelerate and t_prev is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = t / t_prev
+            r = np.where(np.isfinite(r) & (np.abs(r) < 1), r, 0.)
+            extrapolated = mapping + t * r / (1 - r)
+            error = np.abs(extrapolated - result)
+            result = extrapolated
+        else:
+            with np.errstate(invalid='ignore'):
+                error = np.abs(t) * bound
+            result = mapping
+        t_prev = t
+        if tolerance is not None and np.all(error <= tolerance *
+                                            np.abs(result)):
+            break
+    return result, error
+
+
+def _pointsource_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G, steps, h,
+                     r_limit, tolerance=None, accelerate=False):
+    """Returns point-source MoI mapping and truncation error for positions
+    x, y, z (scalars, or arrays of shape (n_positions, 1))"""
+    dx2 = (x - cell.xmid)**2
+    dy2 = (y - cell.ymid)**2
+    dz2 = (z - cell.zmid)**2
+
+    dL2 = dx2 + dy2
+    dL2 = np.where(dL2 + dz2 < r_limit*r_limit, r_limit*r_limit - dz2, dL2)
+
+    def _omega(dz):
+        return 1/np.sqrt(dL2 + dz*dz)
+
+    WTS = (sigma_T - sigma_S)/(sigma_T + sigma_S)
+    WTG = (sigma_T - sigma_G)/(sigma_T + sigma_G)
+
+    mapping = _omega(z - cell.zmid)
+    mapping += (WTS * _omega(z + cell.zmid - 2*h) +
+                WTG * _omega(z + cell.zmid))
+
+    def term(n):
+        return (WTS*WTG)**n * (WTS * _omega(z + cell.zmid - 2*(n + 1)*h) +
+                               WTG * _omega(z + cell.zmid + 2*n*h) +
+                               _omega(z - cell.zmid + 2*n*h) +
+                               _omega(z - cell.zmid - 2*n*h))
+
+    mapping, error = _sum_image_series(mapping, term, steps,
+                                       np.abs(WTS*WTG), tolerance, accelerate)
+
+    return mapping * (1/(4*np.pi*sigma_T)), error * (1/(4*np.pi*sigma_T))
+
+
+def _linesource_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G, steps, h,
+                    r_limit, tolerance=None, accelerate=False):
+    """Returns line-source MoI mapping and truncation error for positions
+    x, y, z (scalars, or arrays of shape (n_positions, 1))"""
+    if np.any(np.abs(z) > 1e-9):
         raise RuntimeError("This method can only handle electrodes "
                            "at the MEA plane z=0")
     if np.abs(sigma_G) > 1e-9:
         raise RuntimeError("This method can only handle sigma_G=0, i.e.,"
                            "a non-conducting MEA glass electrode plane.")
 
-    xstart = cell.xstart
-    xend = cell.xend
-    ystart = cell.ystart
-    yend = cell.yend
-    zstart = cell.zstart
-    zend = cell.zend
     x0, y0, z0 = cell.xstart, cell.ystart, cell.zstart
     x1, y1, z1 = cell.xend, cell.yend, cell.zend
 
-    pos = np.array([x, y, z])
-    rs, closest_points = return_dist_from_segments(xstart, ystart, zstart,
-                                                   xend, yend, zend, pos)
-    z0_ = z0
-    z0_[np.where(rs < r_limit)] = r_limit
+    rs = _segment_distances(cell, x, y, z)
+    z0_ = np.where(rs < r_limit, r_limit, z0)
 
-    ds = _deltaS_calc(xstart, xend, ystart, yend, zstart, zend)
+    ds = _deltaS_calc(x0, x1, y0, y1, z0, z1)
     factor_a = ds*ds
     dx = x1 - x0
     dy = y1 - y0
@@ -769,8 +1712,6 @@ def calc_lfp_soma_as_point_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
     a_x = x - x0
     a_y = y - y0
     W = (sigma_T - sigma_S)/(sigma_T + sigma_S)
-    num = np.zeros(factor_a.shape)
-    den = np.zeros(factor_a.shape)
 
     def _omega(a_z):
         #See Rottman integration formula 46) page 137 for explanation
@@ -779,27 +1720,30 @@ def calc_lfp_soma_as_point_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
         factor_c = a_x*a_x + a_y*a_y + a_z*a_z
         b_2_ac = factor_b*factor_b - factor_a * factor_c
 
-        case1_idxs = np.where(np.abs(b_2_ac) <= 1e-12)
-        case2_idxs = np.where(np.abs(b_2_ac) > 1e-12)
-
-        if not len(case1_idxs) == 0:
-            num[case1_idxs] = factor_a[case1_idxs] + factor_b[case1_idxs]
-            den[case1_idxs] = factor_b[case1_idxs]
-        if not len(case2_idxs) == 0:
-            num[case2_idxs] = (factor_a[case2_idxs] + factor_b[case2_idxs] +
-                               ds[case2_idxs]*np.sqrt(factor_a[case2_idxs] +
-                               2*factor_b[case2_idxs] + factor_c[case2_idxs]))
-            den[case2_idxs] = (factor_b[case2_idxs] +
-                               ds[case2_idxs]*np.sqrt(factor_c[case2_idxs]))
+        case1 = np.abs(b_2_ac) <= 1e-12
+        num = np.where(case1, factor_a + factor_b,
+                       factor_a + factor_b +
+                       ds*np.sqrt(factor_a + 2*factor_b + factor_c))
+        den = np.where(case1, factor_b, factor_b + ds*np.sqrt(factor_c))
         return np.log(num/den)
 
-    mapping = _omega(-z0_)
-    n = 1
-    while n < steps:
-        mapping += W**n * (_omega(2*n*h - z0) + _omega(-2*n*h - z0))
-        n += 1
+    def term(n):
+        return W**n * (_omega(2*n*h - z0_) + _omega(-2*n*h - z0_))
+
+    mapping, error = _sum_image_series(_omega(-z0_), term, steps, np.abs(W),
+                                       tolerance, accelerate)
 
-    mapping *= 2/(4*np.pi*sigma_T * ds)
+    return (mapping * (2/(4*np.pi*sigma_T * ds)),
+            error * (2/(4*np.pi*sigma_T * ds)))
+
+
+def _soma_as_point_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G, steps, h,
+                       r_limit, tolerance=None, accelerate=False):
+    """Returns MoI mapping, with soma as point source and all other
+    compartments as line sources, and truncation error for positions
+    x, y, z (scalars, or arrays of shape (n_positions, 1))"""
+    mapping, error = _linesource_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
+                                     steps, h, r_limit, tolerance, accelerate)
 
     # NOW DOING SOMA
     dx2 = (x - cell.xmid[:1])**2
@@ -807,21 +1751,41 @@ def calc_lfp_soma_as_point_moi(cell, x, y, z, sigma_T, sigma_S, sigma_G,
     dz2 = (z - cell.zmid[:1])**2
 
     dL2 = dx2 + dy2
-    inds = np.where(dL2 + dz2 < r_limit[0]*r_limit[0])[0]
-    dL2[inds] = r_limit[inds]*r_limit[inds] - dz2[inds]
+    dL2 = np.where(dL2 + dz2 < r_limit[0]*r_limit[0],
+                   r_limit[0]*r_limit[0] - dz2, dL2)
 
     def _omega(dz):
         return 1/np.sqrt(dL2 + dz*dz)
 
-    mapping[0] = _omega(z - cell.zmid[:1])
-    mapping[0] += (W * _omega(cell.zmid[:1] - 2*h) +
-                       _omega(cell.zmid[:1]))
+    W = (sigma_T - sigma_S)/(sigma_T + sigma_S)
+
+    soma = _omega(z - cell.zmid[:1])
+    soma += (W * _omega(cell.zmid[:1] - 2*h) +
+                 _omega(cell.zmid[:1]))
+
+    def term(n):
+        return W**n * (W * _omega(+ cell.zmid[:1] - 2*(n + 1)*h) +
+                       2 * _omega(+ cell.zmid[:1] + 2*n*h) +
+                           _omega(+ cell.zmid[:1] - 2*n*h))
+
+    soma, soma_error = _sum_image_series(soma, term, steps, np.abs(W),
+                                         tolerance, accelerate)
+
+    mapping[..., :1] = soma * (1/(4*np.pi*sigma_T))
+    error[..., :1] = soma_error * (1/(4*np.pi*sigma_T))
+
+    return mapping, error
 
-    n = np.arange(1, steps)
-    a = (W)**n[:, None] * (W * _omega(+ cell.zmid[:1] - 2*(n[:, None] + 1)*h) +
-                           2 * _omega(+ cell.zmid[:1] + 2*n[:, None]*h) +
-                               _omega(+ cell.zmid[:1] - 2*n[:, None]*h))
-    mapping[0] += np.sum(a, axis=0)
-    mapping[0] *= 1/(4*np.pi*sigma_T)
 
-    return mapping
\ No newline at end of file
+def _segment_distances(cell, x, y, z):
+    """Returns shortest distance between positions x, y, z (scalars, or
+    arrays of shape (n_positions, 1)) and each segment"""
+    l_x = cell.xend - cell.xstart
+    l_y = cell.yend - cell.ystart
+    l_z = cell.zend - cell.zstart
+    u = ((x - cell.xstart) * l_x + (y - cell.ystart) * l_y +
+         (z - cell.zstart) * l_z) / (l_x*l_x + l_y*l_y + l_z*l_z)
+    u = np.clip(u, 0., 1.)
+    return np.sqrt((x - cell.xstart - u * l_x)**2 +
+                   (y - cell.ystart - u * l_y)**2 +
+                   (z - cell.zstart - u * l_z)**2)
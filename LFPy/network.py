@@ -18,12 +18,16 @@ GNU General Public License for more details.
 from __future__ import division
 import numpy as np
 import os
+import heapq
 import scipy.stats as stats
 import json
 import h5py
 from mpi4py import MPI
 import neuron
 from .templatecell import TemplateCell
+from .run_simulation import _get_segment_ptrvector
+from .tools import StreamWriter
+from .alias_method import alias_method
 
 # set up MPI environment
 COMM = MPI.COMM_WORLD
@@ -153,9 +157,9 @@ class NetworkCell(TemplateCell):
             self.somav.record(sec(0.5)._ref_v)
 
 
-    def create_synapse(self, cell, sec, x=0.5, syntype=neuron.h.ExpSyn,
+    def create_synapse(self, cell, sec=None, x=0.5, syntype=neuron.h.ExpSyn,
                        synparams=dict(tau=2., e=0.),
-                       assert_syn_values=False):
+                       assert_syn_values=False, idx=None):
         """
         Create synapse object of type syntype on sec(x) of cell and
         append to list cell.netconsynapses
@@ -167,9 +171,9 @@ class NetworkCell(TemplateCell):
         cell : object
             instantiation of class NetworkCell or similar
         sec : neuron.h.Section object,
-            section reference on cell
+            section reference on cell. Ignored if idx is not None
         x : float in [0, 1],
-            relative position along section
+            relative position along section. Ignored if idx is not None
         syntype : hoc.HocObject
             NEURON synapse model reference, e.g., neuron.h.ExpSyn
         synparams : dict
@@ -179,11 +183,23 @@ class NetworkCell(TemplateCell):
         assert_syn_values : bool
             if True, raise AssertionError if synapse attribute values do not
             match the values in the synparams dictionary
+        idx : int or None
+            segment index on cell. If not None, sec and x are looked up in
+            the cached segment index of cell
 
         Raises
         ------
         AssertionError
         """
+        if idx is not None:
+            index = cell._get_segment_index()
+            sec = index['sec'][index['sec_idx'][idx]]
+            x = index['x'][idx]
+        try:
+            assert sec is not None
+        except AssertionError:
+            raise AssertionError('either sec or idx must be given')
+
         # create a synapse object on the target cell
         syn = syntype(x, sec=sec)
         if hasattr(syn, 'setRNG'):
@@ -245,7 +261,7 @@ class DummyCell(object):
                  xstart=np.array([]), xmid=np.array([]), xend=np.array([]),
                  ystart=np.array([]), ymid=np.array([]), yend=np.array([]),
                  zstart=np.array([]), zmid=np.array([]), zend=np.array([]),
-                 diam=np.array([]), area=np.array([])):
+                 diam=np.array([]), area=np.array([]), cellidx=None):
         """
         Dummy Cell object initialized with all attributes needed for LFP
         calculations using the LFPy.RecExtElectrode class and methods. This cell
@@ -270,6 +286,10 @@ class DummyCell(object):
             array of length totnsegs with segment diameters
         area : ndarray
             array of segment surface areas
+        cellidx : None or ndarray
+            array of length totnsegs with the index of the cell each segment
+            belongs to, used by RecExtElectrode methods
+            'linesource+multipole'
         """
         # set attributes
         self.totnsegs = totnsegs
@@ -285,13 +305,116 @@ class DummyCell(object):
         self.zend = zend
         self.diam = diam
         self.area = area
+        self.cellidx = cellidx
+
+
+class RoundRobinLoadBalancer(object):
+    """
+    Load balancing strategy assigning cell gids to RANKs in a round-robin
+    fashion, i.e., the cell with a given gid is created on RANK gid % SIZE.
+    Cell weights are ignored.
+
+    Parameters
+    ----------
+    size : int
+        number of RANKs. Default is MPI.COMM_WORLD.Get_size()
+    """
+    weight = None
+
+    def __init__(self, size=SIZE):
+        self.size = size
+
+    def assign(self, gids, weights=None):
+        """
+        Assign each gid to a RANK
+
+        Parameters
+        ----------
+        gids : array_like
+            int cell gids
+        weights : None
+            unused
+
+        Returns
+        -------
+        ranks : ndarray
+            RANK of each gid
+        """
+        return np.asarray(gids, dtype=int) % self.size
+
+
+class GreedyLoadBalancer(object):
+    """
+    Load balancing strategy assigning cell gids to RANKs by greedy bin
+    packing: cells are sorted by decreasing weight, and each cell is placed on
+    the RANK with the smallest accumulated load. Loads are accumulated across
+    all populations assigned by the same instance, so that populations with
+    different cell complexities are distributed evenly over RANKs.
+
+    The assignment is deterministic, hence identical on every RANK given
+    identical weights.
+
+    Parameters
+    ----------
+    size : int
+        number of RANKs. Default is MPI.COMM_WORLD.Get_size()
+    weight : str
+        cell weights used by NetworkPopulation unless given explicitly.
+        Only 'nsegs', the number of segments of each cell, is supported.
+        Default is 'nsegs'
+
+    Attributes
+    ----------
+    loads : ndarray
+        accumulated weight of cells assigned to each RANK
+    """
+    def __init__(self, size=SIZE, weight='nsegs'):
+        try:
+            assert weight == 'nsegs'
+        except AssertionError:
+            raise AssertionError("weight must be 'nsegs', "
+                                 "got {}".format(weight))
+        self.size = size
+        self.weight = weight
+        self.loads = np.zeros(size)
+
+    def assign(self, gids, weights):
+        """
+        Assign each gid to a RANK, accumulating the weights in self.loads
+
+        Parameters
+        ----------
+        gids : array_like
+            int cell gids
+        weights : float or array_like
+            weight of each cell
+
+        Returns
+        -------
+        ranks : ndarray
+            RANK of each gid
+        """
+        gids = np.asarray(gids, dtype=int)
+        weights = np.broadcast_to(np.asarray(weights, dtype=float),
+                                  gids.shape)
+        ranks = np.empty(gids.size, dtype=int)
+        heap = [(load, rank) for rank, load in enumerate(self.loads)]
+        heapq.heapify(heap)
+        for i in np.argsort(-weights, kind='mergesort'):
+            load, rank = heapq.heappop(heap)
+            ranks[i] = rank
+            heapq.heappush(heap, (load + weights[i], rank))
+        for load, rank in heap:
+            self.loads[rank] = load
+        return ranks
 
 
 class NetworkPopulation(object):
     def __init__(self, CWD=None, CELLPATH=None, first_gid=0, Cell=NetworkCell, POP_SIZE=4, name='L5PC',
                  cell_args=dict(), pop_args=dict(),
                  rotation_args=dict(),
-                 OUTPUTPATH='example_parallel_network'):
+                 OUTPUTPATH='example_parallel_network',
+                 load_balancer=None, cell_weight=None):
         """
         NetworkPopulation class representing a group of Cell objects distributed
         across RANKs.
@@ -323,6 +446,17 @@ class NetworkPopulation(object):
             method.
         OUTPUTPATH : str
             path to output file destination
+        load_balancer : object or None
+            load balancing strategy with a weight attribute and an
+            assign(gids, weights) method returning the RANK of each gid, e.g.,
+            RoundRobinLoadBalancer or GreedyLoadBalancer. If None (default),
+            gids are assigned round-robin
+        cell_weight : float, array_like or None
+            weight of each cell passed to load_balancer. If None (default)
+            and load_balancer.weight is 'nsegs', the first cell of the
+            population is created on the RANK with the smallest load in
+            load_balancer.loads, and its number of segments is broadcast
+            and used as the weight of every cell
         """
         # set class attributes
         self.CWD = CWD
@@ -346,16 +480,26 @@ class NetworkPopulation(object):
         self.spike_vectors = []
 
         # set up population of cells on this RANK
-        self.gids = [(i+first_gid) for i in range(POP_SIZE) if (i+first_gid) % SIZE == RANK]
-
-        # we have to enter the cell's corresponding file directory to
-        # create cell because how EPFL set their code up
-        if CWD is not None:
-            os.chdir(os.path.join(CWD, CELLPATH, self.name))
-            self.cells = [Cell(**cell_args) for gid in self.gids]
-            os.chdir(CWD)
+        if load_balancer is None:
+            load_balancer = RoundRobinLoadBalancer()
+        gids = np.arange(POP_SIZE) + first_gid
+        self.cells = []
+        if (cell_weight is None and load_balancer.weight == 'nsegs' and
+                POP_SIZE > 0):
+            # the first cell is assigned before its weight is known, and
+            # created on its RANK which broadcasts its number of segments
+            first_rank = load_balancer.assign(gids[:1], 0.)[0]
+            if RANK == first_rank:
+                self.cells = self._create_cells(1)
+                cell_weight = float(self.cells[0].totnsegs)
+            cell_weight = COMM.bcast(cell_weight, root=first_rank)
+            load_balancer.loads[first_rank] += cell_weight
+            ranks = np.r_[first_rank,
+                          load_balancer.assign(gids[1:], cell_weight)]
         else:
-            self.cells = [Cell(**cell_args) for gid in self.gids]
+            ranks = load_balancer.assign(gids, cell_weight)
+        self.gids = [int(gid) for gid in gids[ranks == RANK]]
+        self.cells += self._create_cells(len(self.gids) - len(self.cells))
         # position each cell's soma in space
         self.soma_pos = self.draw_rand_pos(POP_SIZE=len(self.gids), **pop_args)
         for i, cell in enumerate(self.cells):
@@ -409,6 +553,31 @@ class NetworkPopulation(object):
         COMM.Barrier()
 
 
+    def _create_cells(self, n):
+        """
+        Return list of n new cells of this population
+
+        Parameters
+        ----------
+        n : int
+            number of cells
+
+        Returns
+        -------
+        cells : list
+            list of Cell objects
+        """
+        # we have to enter the cell's corresponding file directory to
+        # create cell because how EPFL set their code up
+        if self.CWD is not None:
+            os.chdir(os.path.join(self.CWD, self.CELLPATH, self.name))
+            cells = [self.Cell(**self.cell_args) for i in range(n)]
+            os.chdir(self.CWD)
+        else:
+            cells = [self.Cell(**self.cell_args) for i in range(n)]
+        return cells
+
+
     def draw_rand_pos(self, POP_SIZE, radius, loc, scale):
         """
         Draw some random location for POP_SIZE cells within radius radius,
@@ -459,7 +628,7 @@ class NetworkPopulation(object):
 class Network(object):
     def __init__(self, dt=0.1, tstart=0., tstop=1000., v_init=-65., celsius=6.3,
                  OUTPUTPATH='example_parallel_network',
-                 verbose=False):
+                 verbose=False, load_balancer=None):
         """
         Network class, creating distributed populations of cells of
         type Cell and handling connections between cells in the respective
@@ -482,6 +651,11 @@ class Network(object):
             argument.
         verbose : bool
             if True, print out misc. messages
+        load_balancer : object or None
+            load balancing strategy assigning the gids of all populations to
+            RANKs, e.g., LFPy.network.GreedyLoadBalancer() for bin packing
+            of cells weighted by segment count. If None (default), gids are
+            assigned round-robin using LFPy.network.RoundRobinLoadBalancer
 
 
         """
@@ -493,6 +667,9 @@ class Network(object):
         self.celsius = celsius
         self.OUTPUTPATH = OUTPUTPATH
         self.verbose = verbose
+        if load_balancer is None:
+            load_balancer = RoundRobinLoadBalancer()
+        self.load_balancer = load_balancer
 
         # we need NEURON's ParallelContext for communicating NetCon events
         self.pc = neuron.h.ParallelContext()
@@ -514,7 +691,7 @@ class Network(object):
     def create_population(self, CWD=None, CELLPATH=None, Cell=NetworkCell,
                           POP_SIZE=4, name='L5PC',
                           cell_args=dict(), pop_args=dict(),
-                          rotation_args=dict()):
+                          rotation_args=dict(), cell_weight=None):
         """
         Create and append a distributed POP_SIZE-sized population of cells of
         type Cell with the corresponding name. Cell-object references, gids on
@@ -543,6 +720,10 @@ class Network(object):
             { 'x' : np.pi/2, 'y' : 0 }. Can only have the keys 'x' and 'y'.
             Cells are randomly rotated around z-axis using the Cell.set_rotation
             method.
+        cell_weight : float, array_like or None
+            weight of each cell used by Network.load_balancer. If None
+            (default), weights are computed according to
+            Network.load_balancer.weight, see NetworkPopulation
 
         """
         try:
@@ -562,7 +743,9 @@ class Network(object):
                                 POP_SIZE=POP_SIZE, name=name,
                                 cell_args=cell_args, pop_args=pop_args,
                                 rotation_args=rotation_args,
-                                OUTPUTPATH=self.OUTPUTPATH)
+                                OUTPUTPATH=self.OUTPUTPATH,
+                                load_balancer=self.load_balancer,
+                                cell_weight=cell_weight)
 
         # associate gids of cells on this RANK such that NEURON can look up
         # at which RANK different cells are created when connecting the network
@@ -681,14 +864,24 @@ class Network(object):
             minimum delay in multiples of dt
         multapsefun : function or None
             function reference, e.g., numpy.random.normal used to draw a number
-            of synapses for a cell-to-cell connection. If None, draw only one
-            connection
+            of synapses for a cell-to-cell connection. If it accepts the size
+            keyword argument, the synapse counts of all connections onto a
+            cell are drawn at once, otherwise it is called once per
+            connection. If None, draw only one connection
         multapseargs : dict
             arguments passed to multapsefun
         syn_pos_args : dict
             arguments passed to inherited LFPy.Cell method
-            NetworkCell.get_rand_idx_area_and_distribution_norm to find
-            synapse locations.
+            NetworkCell.get_rand_idx_area_and_distribution_prob to find
+            synapse locations. The segment probabilities are computed once
+            per postsynaptic cell, and synapse locations, weights and delays
+            of all its connections are drawn in one batch.
+
+        Notes
+        -----
+        As random numbers are drawn in batches per postsynaptic cell, the
+        connectivity resulting from a given random seed differs from LFPy
+        versions drawing numbers for one connection at a time.
         """
         # set up connections from all cells in presynaptic to post across RANKs
         n0 = self.populations[pre].first_gid
@@ -705,63 +898,75 @@ class Network(object):
 
         # keep track of synapse positions for this connect
         # call on this rank such that these can be communicated and stored
-        syn_idx_pos = []
+        syn_dtype = [('gid', 'i8'), ('x', float), ('y', float), ('z', float)]
+        syn_idx_pos = [np.empty(0, dtype=syn_dtype)]
 
         # iterate over gids on this RANK and create connections
         for i, (post_gid, cell) in enumerate(zip(self.populations[post].gids, self.populations[post].cells)):
             # do NOT iterate over all possible presynaptic neurons
-            for pre_gid in pre_gids[connectivity[:, i]]:
-                # assess number of synapses
-                if multapsefun is None:
-                    nidx = 1
-                else:
-                    nidx = 0
-                    j = 0
-                    while nidx <= 0 and j < 1000:
-                        nidx = int(multapsefun(**multapseargs))
-                        j += 1
-                    if j == 1000:
-                        raise Exception('change multapseargs as no positive synapse count was found in 1000 trials')
-
-                # print('connecting cell {} to cell {} with {} synapses on RANK {}'.format(pre_gid, post_gid, nidx, RANK))
-
-                # find synapse locations and corresponding section names
-                idxs = cell.get_rand_idx_area_and_distribution_norm(nidx=nidx, **syn_pos_args)
-                secs = cell.get_idx_name(idxs)
-
-                # draw weights
-                weights = weightfun(size=nidx, **weightargs)
-                # redraw weights less that minweight
-                while np.any(weights < minweight):
-                    j = weights < minweight
-                    weights[j] = weightfun(size=j.sum(), **weightargs)
-
-                # draw delays
-                delays = delayfun(size=nidx, **delayargs)
-                # redraw delays shorter than mindelay
-                while np.any(delays < mindelay):
-                    j = delays < mindelay
-                    delays[j] = delayfun(size=j.sum(), **delayargs)
-
-                for i, ((idx, secname, x), weight, delay) in enumerate(zip(secs, weights, delays)):
-                    cell.create_synapse(cell,
-                                        # TODO: Find neater way of accessing Section reference, this seems slow
-                                        sec=list(cell.allseclist)[np.where(np.array(cell.allsecnames)==secname)[0][0]],
-                                        x=x, syntype=syntype,
-                                        synparams=synparams)
-                    # connect up NetCon object
-                    nc = self.pc.gid_connect(pre_gid, cell.netconsynapses[-1])
-                    nc.weight[0] = weight
-                    nc.delay = delays[i]
-                    self.netconlist.append(nc)
-
-                    # store also synapse indices allowing for computing LFPs from syn.i
-                    cell.synidx.append(idx)
-
-                    # store gid and xyz-coordinate of synapse positions
-                    syn_idx_pos.append((cell.gid, cell.xmid[idx], cell.ymid[idx], cell.zmid[idx]))
-
-                syncount += nidx
+            conn_gids = pre_gids[connectivity[:, i]]
+            if conn_gids.size == 0:
+                continue
+
+            # assess number of synapses of every connection
+            if multapsefun is None:
+                nidx = np.ones(conn_gids.size, dtype=int)
+            else:
+                nidx = np.zeros(conn_gids.size, dtype=int)
+                j = 0
+                while np.any(nidx <= 0) and j < 1000:
+                    k = nidx <= 0
+                    nidx[k] = _draw_multapses(multapsefun, multapseargs,
+                                              k.sum())
+                    j += 1
+                if j == 1000:
+                    raise Exception('change multapseargs as no positive synapse count was found in 1000 trials')
+
+            # find all synapse locations of this cell from one table of
+            # segment probabilities
+            poss_idx, p = cell.get_rand_idx_area_and_distribution_prob(**syn_pos_args)
+            if poss_idx.size == 0:
+                raise Exception('No possible segment idx match syn_pos_args on cell with gid {}'.format(post_gid))
+            idxs = alias_method(poss_idx, p, nidx.sum())
+            syn_gids = np.repeat(conn_gids, nidx)
+
+            # draw weights
+            weights = weightfun(size=idxs.size, **weightargs)
+            # redraw weights less that minweight
+            while np.any(weights < minweight):
+                j = weights < minweight
+                weights[j] = weightfun(size=j.sum(), **weightargs)
+
+            # draw delays
+            delays = delayfun(size=idxs.size, **delayargs)
+            # redraw delays shorter than mindelay
+            while np.any(delays < mindelay):
+                j = delays < mindelay
+                delays[j] = delayfun(size=j.sum(), **delayargs)
+
+            # instantiate synapses and NetCon objects, looking up sections
+            # in the cached segment index of the cell
+            for idx, pre_gid, weight, delay in zip(idxs, syn_gids, weights, delays):
+                cell.create_synapse(cell, idx=idx, syntype=syntype,
+                                    synparams=synparams)
+                # connect up NetCon object
+                nc = self.pc.gid_connect(int(pre_gid), cell.netconsynapses[-1])
+                nc.weight[0] = weight
+                nc.delay = delay
+                self.netconlist.append(nc)
+
+                # store also synapse indices allowing for computing LFPs from syn.i
+                cell.synidx.append(idx)
+
+            # store gid and xyz-coordinate of synapse positions
+            pos = np.empty(idxs.size, dtype=syn_dtype)
+            pos['gid'] = cell.gid
+            pos['x'] = cell.xmid[idxs]
+            pos['y'] = cell.ymid[idxs]
+            pos['z'] = cell.zmid[idxs]
+            syn_idx_pos.append(pos)
+
+            syncount += idxs.size
 
         conncount = COMM.reduce(conncount, op=MPI.SUM, root=0)
         syncount = COMM.reduce(syncount, op=MPI.SUM, root=0)
@@ -774,18 +979,10 @@ class Network(object):
             syncount = None
 
 
-        # gather and write syn_idx_pos data
+        # gather and write syn_idx_pos data as structured array
+        syn_idx_pos = np.concatenate(syn_idx_pos)
         if RANK == 0:
-            synData = flattenlist(COMM.gather(syn_idx_pos))
-
-            # convert to structured array
-            dtype = [('gid', 'i8'), ('x', float), ('y', float), ('z', float)]
-            synDataArray = np.empty((len(synData), ), dtype=dtype)
-            for i, (gid, x, y, z) in enumerate(synData):
-                synDataArray[i]['gid'] = gid
-                synDataArray[i]['x'] = x
-                synDataArray[i]['y'] = y
-                synDataArray[i]['z'] = z
+            synDataArray = np.concatenate(COMM.gather(syn_idx_pos))
             # Dump to hdf5 file, append to file if entry exists
             f = h5py.File(os.path.join(self.OUTPUTPATH,
                                        'synapse_positions.h5'))
@@ -812,7 +1009,8 @@ class Network(object):
                  rec_pop_contributions=False,
                  rec_variables=[], variable_dt=False, atol=0.001,
                  to_memory=True, to_file=False, file_name=None,
-                 dotprodcoeffs=None, **kwargs):
+                 dotprodcoeffs=None, block_size=1, file_chunk_size=1024,
+                 file_compression=None, **kwargs):
         """
         This is the main function running the simulation of the network model.
 
@@ -846,11 +1044,33 @@ class Network(object):
         variable_dt: boolean, using variable timestep in NEURON
         atol:       absolute tolerance used with NEURON variable timestep
         to_memory:  only valid with electrode, store lfp in -> electrode.LFP
-        to_file:    only valid with electrode, save LFPs in hdf5 file format
-        file_name:  name of hdf5 file, '.h5' is appended if it doesnt exist
+        to_file:    only valid with electrode, save LFPs in hdf5 file format.
+                    Contributions are streamed to file during the simulation
+                    by each RANK, and summed up into file_name on RANK 0
+                    afterwards. The merge is serial: RANK 0 reads every
+                    per-RANK file while the other RANKs wait, so it takes time
+                    proportional to the number of RANKs times the size of the
+                    output. With to_memory=False, no LFPs or current-dipole
+                    moments are kept in memory and None is returned in their
+                    place.
+        file_name:  name of hdf5 file, '.h5' is appended if it doesnt exist.
+                    Required if to_file is True
         dotprodcoeffs :  list of N x Nseg ndarray. These arrays will at
                     every timestep be multiplied by the membrane currents.
                     Presumably useful for memory efficient csd or lfp calcs
+        block_size : int
+            number of consecutive timesteps of transmembrane currents buffered
+            before computing extracellular potentials etc. as one
+            matrix-matrix product per electrode. Values larger than one
+            (e.g., 100) speed up simulations with many electrode contacts
+            and segments at the cost of a (totnsegs, block_size) buffer on
+            each RANK. Defaults to 1
+        file_chunk_size : int
+            number of timesteps per HDF5 chunk and per write to file if
+            to_file is True. Defaults to 1024
+        file_compression : None or str
+            HDF5 compression filter, e.g., 'gzip' or 'lzf' if to_file is True.
+            Defaults to None
         **kwargs :  keyword argument dict values passed along to function
                     _run_simulation_with_electrode(), containing some or all of
                     the boolean flags: use_ipas, use_icap, use_isyn
@@ -863,7 +1083,12 @@ class Network(object):
             'times'. Each item is a nested list of len(Npop) times N_X where N_X
             is the corresponding population size. Each entry is a np.ndarray
             containing the spike times of each cell in the nested list in item
-            'gids'
+            'gids'. The same spike times are also provided in compressed
+            sparse row form under keys 'offsets' and 'flat_times', lists of
+            len(Npop) with int64 arrays of length N_X + 1 and float64 arrays,
+            respectively, so that the spike times of cell j in population i are
+            flat_times[i][offsets[i][j]:offsets[i][j+1]]. Only RANK 0 receives
+            the spike times, other RANKs get None.
         OUTPUT : list of ndarray
             if parameters electrode is not None and/or dotprodcoeffs is not
             None, contains the
@@ -921,6 +1146,9 @@ class Network(object):
                             dotprodcoeffs=dotprodcoeffs,
                             rec_current_dipole_moment=rec_current_dipole_moment,
                             rec_pop_contributions=rec_pop_contributions,
+                            block_size=block_size,
+                            file_chunk_size=file_chunk_size,
+                            file_compression=file_compression,
                             **kwargs)
 
         for name in self.population_names:
@@ -944,39 +1172,42 @@ class Network(object):
                 if len(rec_variables) > 0:
                     cell._collect_rec_variables(rec_variables)
 
-        # Collect spike trains across all RANKs to RANK 0
-        for name in self.population_names:
-            population = self.populations[name]
-            for i in range(len(population.spike_vectors)):
-                population.spike_vectors[i] = np.array(population.spike_vectors[i])
+        # Collect spike trains across all RANKs to RANK 0 as flat arrays
         if RANK == 0:
             times = []
             gids = []
-            for i, name in enumerate(self.population_names):
-                times.append([])
-                gids.append([])
-                times[i] += [x for x in self.populations[name].spike_vectors]
-                gids[i] += [x for x in self.populations[name].gids]
-                for j in range(1, SIZE):
-                    times[i] += COMM.recv(source=j, tag=13)
-                    gids[i] += COMM.recv(source=j, tag=14)
+            offsets = []
+            flat_times = []
         else:
             times = None
             gids = None
-            for name in self.population_names:
-                COMM.send([x for x in self.populations[name].spike_vectors],
-                    dest=0, tag=13)
-                COMM.send([x for x in self.populations[name].gids],
-                    dest=0, tag=14)
+            offsets = None
+            flat_times = None
+        for name in self.population_names:
+            population = self.populations[name]
+            for i in range(len(population.spike_vectors)):
+                population.spike_vectors[i] = np.array(population.spike_vectors[i])
+            spikes = _gather_spikes(population.gids, population.spike_vectors)
+            if RANK == 0:
+                gids_pop, offsets_pop, times_pop = spikes
+                gids.append(gids_pop.tolist())
+                times.append([times_pop[offsets_pop[j]:offsets_pop[j+1]]
+                              for j in range(gids_pop.size)])
+                offsets.append(offsets_pop)
+                flat_times.append(times_pop)
 
         if electrode is None and dotprodcoeffs is None and not rec_current_dipole_moment and not rec_pop_contributions:
-            return dict(times=times, gids=gids)
+            return dict(times=times, gids=gids, offsets=offsets,
+                        flat_times=flat_times)
         else:
             # communicate and sum up LFPs and dipole moments:
-            for i in range(len(LFP)):
-                LFP[i] = ReduceStructArray(LFP[i])
-            P = ReduceStructArray(P)
-            return dict(times=times, gids=gids), LFP, P
+            if LFP is not None:
+                for i in range(len(LFP)):
+                    LFP[i] = ReduceStructArray(LFP[i], in_place=True)
+            if P is not None:
+                P = ReduceStructArray(P, in_place=True)
+            return dict(times=times, gids=gids, offsets=offsets,
+                        flat_times=flat_times), LFP, P
 
 
     def _create_network_dummycell(self):
@@ -996,40 +1227,27 @@ class Network(object):
         nsegs = np.array(nsegs, dtype=int)
 
         totnsegs = nsegs.sum()
-        imem = np.eye(totnsegs)
-        xstart = np.array([])
-        xmid = np.array([])
-        xend = np.array([])
-        ystart = np.array([])
-        ymid = np.array([])
-        yend = np.array([])
-        zstart = np.array([])
-        zmid = np.array([])
-        zend = np.array([])
-        diam = np.array([])
-        area = np.array([])
 
+        # fill in preallocated arrays with the geometry of all cells, ordered
+        # by population. The DummyCell is only used to compute mappings between
+        # transmembrane currents and extracellular potentials etc., hence its
+        # imem attribute is left empty.
+        attrs = ['xstart', 'xmid', 'xend', 'ystart', 'ymid', 'yend',
+                 'zstart', 'zmid', 'zend', 'diam', 'area']
+        geometry = dict([(attr, np.empty(totnsegs)) for attr in attrs])
+        geometry['cellidx'] = np.empty(totnsegs, dtype=int)
+        i = 0 # counter
+        j = 0 # cell counter
         for name in self.population_names:
             for cell in self.populations[name].cells:
-                xstart = np.r_[xstart, cell.xstart]
-                ystart = np.r_[ystart, cell.ystart]
-                zstart = np.r_[zstart, cell.zstart]
-                xmid = np.r_[xmid, cell.xmid]
-                ymid = np.r_[ymid, cell.ymid]
-                zmid = np.r_[zmid, cell.zmid]
-                xend = np.r_[xend, cell.xend]
-                yend = np.r_[yend, cell.yend]
-                zend = np.r_[zend, cell.zend]
-                diam = np.r_[diam, cell.diam]
-                area = np.r_[area, cell.area]
+                for attr in attrs:
+                    geometry[attr][i:i+cell.totnsegs] = getattr(cell, attr)
+                geometry['cellidx'][i:i+cell.totnsegs] = j
+                i += cell.totnsegs
+                j += 1
 
         # return number of segments per population and DummyCell object
-        return nsegs, DummyCell(totnsegs,
-                         imem,
-                         xstart, xmid, xend,
-                         ystart, ymid, yend,
-                         zstart, zmid, zend,
-                         diam, area)
+        return nsegs, DummyCell(totnsegs=totnsegs, **geometry)
 
 
 def _run_simulation(network, cvode, variable_dt=False, atol=0.001):
@@ -1099,7 +1317,10 @@ def _run_simulation_with_electrode(network, cvode,
                                    rec_current_dipole_moment=False,
                                    use_ipas=False, use_icap=False,
                                    use_isyn=False,
-                                   rec_pop_contributions=False
+                                   rec_pop_contributions=False,
+                                   block_size=1,
+                                   file_chunk_size=1024,
+                                   file_compression=None
                                    ):
     """
     Running the actual simulation in NEURON.
@@ -1125,10 +1346,16 @@ def _run_simulation_with_electrode(network, cvode,
         default is False
     file_name : str
         If to_file is True, file which extracellular potentials will be written
-        to. The file format is HDF5
+        to. The file format is HDF5. Each RANK streams its contributions to a
+        separate file, which are summed into <file_name> on RANK 0 at the end
+        of the simulation, see _merge_rank_files. Datasets are named 'electrode000/imem',
+        'electrode000/<population name>' etc. with shape
+        (n_contacts, n_timesteps), and 'current_dipole_moment/<population name>'
+        with shape (3, n_timesteps)
     dotprodcoeffs : None or list of ndarrays
         Each element in list is a mapping of transmembrane currents to a measure
-        on the form :math:`V = \mathbf{C} \cdot \mathbf{I}`
+        on the form :math:`V = \mathbf{C} \cdot \mathbf{I}`. Mappings may be
+        scipy.sparse matrices, e.g., as set up by electrodes with a cutoff
     rec_current_dipole_moment : bool
         if True, compute and store the total current-dipole moment per time
         step as the sum over each individual population
@@ -1147,22 +1374,35 @@ def _run_simulation_with_electrode(network, cvode,
     rec_pop_contributions : bool
         if True, compute and return single-population contributions to the
         extracellular potential during each time step of the simulation
+    block_size : int
+        number of consecutive timesteps of transmembrane currents buffered
+        before computing extracellular potentials etc. as one matrix-matrix
+        product per element in dotprodcoeffs
+    file_chunk_size : int
+        number of timesteps per HDF5 chunk and per write to file if to_file
+        is True
+    file_compression : None or str
+        HDF5 compression filter (e.g., 'gzip' or 'lzf') if to_file is True
 
     Returns
     -------
-    RESULTS : list
+    RESULTS : list or None
         ordered according to [electrode, ... dotprodcoeffs, ...], each element
         being the superimposed contribution to i.e., the extracellular potential
         at each timestep from all cell objects on this particular RANK.
         Thus, no single-cell contributions to the LFP
-        are returned.
-    DIPOLE_MOMENT : ndarray
+        are returned. None if to_memory is False
+    DIPOLE_MOMENT : ndarray or None
         Shape (n_timesteps, 3) array containing the x,y,z-components of the
         current-dipole moment summed up over contributions from cells across
-        all populations on this MPI RANK.
+        all populations on this MPI RANK. None if to_memory or
+        rec_current_dipole_moment is False
 
 
     """
+    if to_file and file_name is None:
+        raise ValueError('to_file is True, but no file_name was given')
+
     try:
         import h5py
     except ImportError:
@@ -1274,200 +1514,391 @@ def _run_simulation_with_electrode(network, cvode,
 
     # container for electric current dipole moment for the individual
     # populations captured inside the DummyCell instance
-    if rec_current_dipole_moment:
+    if rec_current_dipole_moment and to_memory:
         DIPOLE_MOMENT = np.zeros((int(network.tstop / network.dt) + 1, 3),
             dtype=list(zip(network.population_names, [np.float]*len(network.population_names))))
     else:
         DIPOLE_MOMENT = None
 
-    #LFPs for each electrode will be put here during simulations
+    # number of timesteps for which extracellular potentials etc. are computed
+    ntsteps = int(network.tstop / network.dt) + 1
+
+    # contributions from each RANK are streamed in time blocks to a separate
+    # file, and summed into file_name once the simulation has finished
     if to_file:
-        raise NotImplementedError('to_file arg implementation not yet tested')
         #ensure right ending:
         if file_name.split('.')[-1] != 'h5':
             file_name += '.h5'
-        el_LFP_file = h5py.File(file_name, 'w')
-        i = 0
-        for coeffs in dotprodcoeffs:
-            el_LFP_file['electrode{:03d}'.format(i)] = np.zeros((coeffs.shape[0],
-                                int(cell.tstop / cell.dt + 1)))
-            i += 1
-
-    # temp vector to store membrane currents at each timestep:
-    imem = np.zeros(network_dummycell.totnsegs, dtype=dtype)
+        if SIZE > 1:
+            rank_file_name = _get_rank_file_name(file_name, RANK)
+        else:
+            rank_file_name = file_name
+        el_LFP_file = StreamWriter(rank_file_name, ntsteps=ntsteps,
+                                   dt=network.dt, chunk_size=file_chunk_size,
+                                   compression=file_compression)
+        for j, coeffs in enumerate(dotprodcoeffs):
+            for name, _ in dtype:
+                el_LFP_file.create_dataset(
+                    'electrode{:03d}/{}'.format(j, name), coeffs.shape[0])
+        if rec_current_dipole_moment:
+            for name in network.population_names:
+                el_LFP_file.create_dataset(
+                    'current_dipole_moment/{}'.format(name), 3)
+
+    # temp arrays to store membrane currents of block_size consecutive
+    # timesteps, allowing each mapping to be applied to all of them in one
+    # matrix-matrix product. Plain C-contiguous float64 arrays are used, as
+    # column slices of fields of a structured array would be copied before
+    # every product:
+    buffer_names = ['imem']
+    if use_ipas: buffer_names += ['ipas']
+    if use_icap: buffer_names += ['icap']
+    if use_isyn: buffer_names += ['isyn_e', 'isyn_i']
+    buffers = {name: np.zeros((network_dummycell.totnsegs, block_size))
+               for name in buffer_names}
+    k = 0
+
+    # bind pointers to the currents of every segment across cells, such that
+    # these can be gathered with a single call on each timestep
+    imem_ptrvec, imem_vec = _get_segment_ptrvector(cells, '_ref_i_membrane_')
+    if use_ipas:
+        ipas_ptrvec, ipas_vec = _get_segment_ptrvector(cells, '_ref_i_pas')
+    if use_icap:
+        icap_ptrvec, icap_vec = _get_segment_ptrvector(cells, '_ref_i_cap')
+
+    # segment areas scaling membrane current densities to currents
+    if use_ipas or use_icap:
+        area = network_dummycell.area[:, np.newaxis] * 1E-2
 
     # create a 2D array representation of segment midpoints for dot product
     # with transmembrane currents when computing dipole moment
     if rec_current_dipole_moment:
         midpoints = np.c_[network_dummycell.xmid, network_dummycell.ymid, network_dummycell.zmid]
 
-    #run fadvance until time limit, and calculate LFPs for each timestep
+    #run fadvance until time limit, and calculate LFPs for each timestep,
+    #including the timestep after the final fadvance()
     tstep = 0
-    while neuron.h.t < network.tstop:
-        if neuron.h.t >= 0:
-            i = 0
-            totnsegs = 0
+    while True:
+        if neuron.h.t >= 0 and tstep < ntsteps:
+            imem_ptrvec.gather(imem_vec)
+            buffers['imem'][:, k] = imem_vec.as_numpy()
+            if use_ipas:
+                ipas_ptrvec.gather(ipas_vec)
+                buffers['ipas'][:, k] = ipas_vec.as_numpy()
+            if use_icap:
+                icap_ptrvec.gather(icap_vec)
+                buffers['icap'][:, k] = icap_vec.as_numpy()
             if use_isyn:
-                imem['isyn_e'] = 0. # need to reset these for every iteration
-                imem['isyn_i'] = 0. # because we sum over synapses
-            for cell in cells:
-                for sec in cell.allseclist:
-                    for seg in sec:
-                        imem['imem'][i] = seg.i_membrane_
-                        if use_ipas:
-                            imem['ipas'][i] = seg.i_pas
-                        if use_icap:
-                            imem['icap'][i] = seg.i_cap
-                        i += 1
-
-                if use_isyn:
+                buffers['isyn_e'][:, k] = 0. # need to reset these for every iteration
+                buffers['isyn_i'][:, k] = 0. # because we sum over synapses
+                totnsegs = 0
+                for cell in cells:
                     for idx, syn in zip(cell.synidx, cell.netconsynapses):
                         if hasattr(syn, 'e') and syn.e > -50:
-                            imem['isyn_e'][idx+totnsegs] += syn.i
+                            buffers['isyn_e'][idx+totnsegs, k] += syn.i
                         else:
-                            imem['isyn_i'][idx+totnsegs] += syn.i
-
-                totnsegs += cell.totnsegs
-
-            if to_memory:
-                for j, coeffs in enumerate(dotprodcoeffs):
-                    RESULTS[j]['imem'][:, tstep] = np.dot(coeffs, imem['imem'])
-                    if use_ipas:
-                        RESULTS[j]['ipas'][:, tstep] = np.dot(coeffs, imem['ipas'] * network_dummycell.area * 1E-2)
-                    if use_icap:
-                        RESULTS[j]['icap'][:, tstep] = np.dot(coeffs, imem['icap'] * network_dummycell.area * 1E-2)
-                    if use_isyn:
-                        RESULTS[j]['isyn_e'][:, tstep] = np.dot(coeffs, imem['isyn_e'])
-                        RESULTS[j]['isyn_i'][:, tstep] = np.dot(coeffs, imem['isyn_i'])
-                if rec_current_dipole_moment:
-                    k = 0 # counter
-                    for nsegs, name in zip(population_nsegs, network.population_names):
-                        cellinds = np.arange(k, k+nsegs)
-                        DIPOLE_MOMENT[name][tstep, ] = np.dot(imem['imem'][cellinds, ], midpoints[cellinds, ])
-                        k += nsegs
+                            buffers['isyn_i'][idx+totnsegs, k] += syn.i
+                    totnsegs += cell.totnsegs
+            k += 1
+            tstep += 1
+
+        final = neuron.h.t >= network.tstop
 
+        # compute extracellular potentials etc. for all buffered timesteps
+        if k == block_size or (final and k > 0):
+            for j, coeffs in enumerate(dotprodcoeffs):
+                LFP = dict(imem=coeffs.dot(buffers['imem'][:, :k]))
+                if use_ipas:
+                    LFP['ipas'] = coeffs.dot(buffers['ipas'][:, :k] * area)
+                if use_icap:
+                    LFP['icap'] = coeffs.dot(buffers['icap'][:, :k] * area)
+                if use_isyn:
+                    LFP['isyn_e'] = coeffs.dot(buffers['isyn_e'][:, :k])
+                    LFP['isyn_i'] = coeffs.dot(buffers['isyn_i'][:, :k])
                 if rec_pop_contributions:
-                    k = 0 # counter
+                    i = 0 # counter
                     for nsegs, name in zip(population_nsegs, network.population_names):
-                        cellinds = np.arange(k, k+nsegs)
-                        RESULTS[j][name][:, tstep] = np.dot(coeffs[:, cellinds], imem['imem'][cellinds, ])
-                        k += nsegs
+                        LFP[name] = coeffs[:, i:i+nsegs].dot(buffers['imem'][i:i+nsegs, :k])
+                        i += nsegs
+                for name, data in LFP.items():
+                    if to_memory:
+                        RESULTS[j][name][:, tstep-k:tstep] = data
+                    if to_file:
+                        el_LFP_file.write('electrode{:03d}/{}'.format(j, name), data)
 
-            if to_file:
-                for j, coeffs in enumerate(dotprodcoeffs):
-                    el_LFP_file['electrode{:03d}'.format(j)
-                                ][:, tstep] = np.dot(coeffs, imem['imem'])
+            if rec_current_dipole_moment:
+                i = 0 # counter
+                for nsegs, name in zip(population_nsegs, network.population_names):
+                    P = np.dot(buffers['imem'][i:i+nsegs, :k].T, midpoints[i:i+nsegs, ])
+                    if to_memory:
+                        DIPOLE_MOMENT[name][tstep-k:tstep, ] = P
+                    if to_file:
+                        el_LFP_file.write('current_dipole_moment/{}'.format(name), P.T)
+                    i += nsegs
+            k = 0
+
+        if final:
+            break
 
-            tstep += 1
         neuron.h.fadvance()
         if neuron.h.t % 100. == 0.:
             if RANK == 0:
                 print('t = {} ms'.format(neuron.h.t))
 
 
-    try:
-        #calculate LFP after final fadvance()
-        i = 0
-        totnsegs = 0
-        if use_isyn:
-            imem['isyn_e'] = 0. # need to reset these for every iteration because we sum over synapses
-            imem['isyn_i'] = 0.
-        for cell in cells:
-            for sec in cell.allseclist:
-                for seg in sec:
-                    imem['imem'][i] = seg.i_membrane_
-                    if use_ipas:
-                        imem['ipas'][i] = seg.i_pas
-                    if use_icap:
-                        imem['icap'][i] = seg.i_cap
-                    i += 1
+    if to_file:
+        el_LFP_file.close()
+        # sum up contributions from all RANKs
+        if SIZE > 1:
+            COMM.Barrier()
+            if RANK == 0:
+                _merge_rank_files([_get_rank_file_name(file_name, i)
+                                   for i in range(SIZE)], file_name)
+            COMM.Barrier()
 
-            if use_isyn:
-                for idx, syn in zip(cell.synidx, cell.netconsynapses):
-                    if hasattr(syn, 'e') and syn.e > -50:
-                        imem['isyn_e'][idx+totnsegs] += syn.i
-                    else:
-                        imem['isyn_i'][idx+totnsegs] += syn.i
+    # Final step, put LFPs in the electrode object, superimpose if necessary
+    # If electrode.perCellLFP, store individual LFPs
+    if to_memory:
+        # return the electrode.LFP
+        return RESULTS, DIPOLE_MOMENT
+    else:
+        return None, None
 
-            totnsegs += cell.totnsegs
 
-        if to_memory:
-            for j, coeffs in enumerate(dotprodcoeffs):
-                RESULTS[j]['imem'][:, tstep] = np.dot(coeffs, imem['imem'])
-                if use_ipas:
-                    RESULTS[j]['ipas'][:, tstep] = np.dot(coeffs, imem['ipas'] * network_dummycell.area * 1E-2)
-                if use_icap:
-                    RESULTS[j]['icap'][:, tstep] = np.dot(coeffs, imem['icap'] * network_dummycell.area * 1E-2)
-                if use_isyn:
-                    RESULTS[j]['isyn_e'][:, tstep] = np.dot(coeffs, imem['isyn_e'])
-                    RESULTS[j]['isyn_i'][:, tstep] = np.dot(coeffs, imem['isyn_i'])
-            if rec_current_dipole_moment:
-                k = 0 # counter
-                for nsegs, name in zip(population_nsegs, network.population_names):
-                    cellinds = np.arange(k, k+nsegs)
-                    DIPOLE_MOMENT[name][tstep, ] = np.dot(imem['imem'][cellinds, ], midpoints[cellinds, ])
-                    k += nsegs
+def _get_rank_file_name(file_name, rank):
+    """
+    Return name of file containing the contributions from MPI RANK rank
+    to the output file file_name, e.g., 'LFP_RANK001.h5' for 'LFP.h5'
+    """
+    return '{}_RANK{:03d}.h5'.format(file_name[:-3], rank)
 
-            if rec_pop_contributions:
-                k = 0 # counter
-                for nsegs, name in zip(population_nsegs, network.population_names):
-                    cellinds = np.arange(k, k+nsegs)
-                    RESULTS[j][name][:, tstep] = np.dot(coeffs[:, cellinds], imem['imem'][cellinds, ])
-                    k += nsegs
 
+def _merge_rank_files(file_names, file_name):
+    """
+    Sum up every dataset across the per-RANK HDF5 files file_names and write
+    the result to file_name, one chunk of timesteps at the time. Dataset
+    layout, HDF5 chunking, compression and attributes are preserved, and the
+    per-RANK files are deleted afterwards.
 
-        if to_file:
-            for j, coeffs in enumerate(dotprodcoeffs):
-                el_LFP_file['electrode{:03d}'.format(j)
-                            ][:, tstep] = np.dot(coeffs, imem['imem'])
+    The merge runs serially on the calling RANK. It reads len(file_names)
+    times and writes once the size of the output file, holding one chunk of
+    timesteps per file in memory, and the disk temporarily holds
+    len(file_names) + 1 copies of the output.
+
+    Parameters
+    ----------
+    file_names : list of str
+        paths to HDF5 files written by each RANK with identical layout
+    file_name : str
+        path to output HDF5 file
+    """
+    fs = [h5py.File(fname, 'r') for fname in file_names]
+    f = h5py.File(file_name, 'w')
+    for key, value in fs[0].attrs.items():
+        f.attrs[key] = value
+    f['t'] = fs[0]['t'][()]
+
+    # list every dataset but the time array
+    names = []
+    def get_dataset_names(name, obj):
+        if isinstance(obj, h5py.Dataset) and name != 't':
+            names.append(name)
+    fs[0].visititems(get_dataset_names)
+
+    for name in names:
+        src = fs[0][name]
+        dset = f.create_dataset(name, shape=src.shape, dtype=src.dtype,
+                                chunks=src.chunks,
+                                compression=src.compression,
+                                compression_opts=src.compression_opts)
+        for key, value in src.attrs.items():
+            dset.attrs[key] = value
+        chunk_size = src.chunks[-1] if src.chunks is not None else src.shape[-1]
+        for i in range(0, src.shape[-1], chunk_size):
+            data = fs[0][name][:, i:i+chunk_size]
+            for f_rank in fs[1:]:
+                data += f_rank[name][:, i:i+chunk_size]
+            dset[:, i:i+chunk_size] = data
+
+    f.close()
+    for f_rank, fname in zip(fs, file_names):
+        f_rank.close()
+        os.remove(fname)
+
+
+def _draw_multapses(multapsefun, multapseargs, size):
+    """
+    Draw size synapse counts using multapsefun, calling it once with keyword
+    argument size if supported, or otherwise once per synapse count
 
-    except IndexError:
-        pass
+    Parameters
+    ----------
+    multapsefun : function
+        function, e.g., numpy.random.normal
+    multapseargs : dict
+        arguments passed to multapsefun
+    size : int
+        number of synapse counts
 
+    Returns
+    -------
+    nidx : ndarray
+        int synapse counts
+    """
+    try:
+        nidx = multapsefun(size=size, **multapseargs)
+    except TypeError:
+        nidx = [multapsefun(**multapseargs) for i in range(size)]
+    return np.array([int(n) for n in np.ravel(nidx)], dtype=int)
 
-    # Final step, put LFPs in the electrode object, superimpose if necessary
-    # If electrode.perCellLFP, store individual LFPs
-    if to_memory:
-        # return the electrode.LFP
-        return RESULTS, DIPOLE_MOMENT
 
-    if to_file:
-        el_LFP_file.close()
-        return
+def _gather_spikes(gids, spike_vectors):
+    """
+    Gather spike times of cells distributed across RANKs on RANK 0 using
+    MPI Gatherv on contiguous buffers rather than pickled lists.
+
+    Parameters
+    ----------
+    gids : array_like
+        int cell gids on this RANK
+    spike_vectors : list of ndarray
+        spike times of each cell on this RANK in the order of gids
+
+    Returns
+    -------
+    gids : ndarray
+        int64 gids of all cells ordered by RANK (RANK 0 only, otherwise None)
+    offsets : ndarray
+        int64 array of length len(gids) + 1 so that the spike times of cell
+        gids[j] are times[offsets[j]:offsets[j+1]] (RANK 0 only)
+    times : ndarray
+        float64 spike times of all cells (RANK 0 only)
+    """
+    gids = np.asarray(gids, dtype=np.int64).ravel()
+    counts = np.array([np.size(x) for x in spike_vectors], dtype=np.int64)
+    if len(spike_vectors) > 0:
+        times = np.concatenate([np.asarray(x, dtype=np.float64).ravel()
+                                for x in spike_vectors])
+    else:
+        times = np.zeros(0, dtype=np.float64)
+
+    # number of cells and spikes per RANK
+    sizes = COMM.gather([gids.size, times.size], root=0)
+    if RANK == 0:
+        sizes = np.array(sizes, dtype=np.int64).reshape((-1, 2))
+        n_cells = sizes[:, 0]
+        n_spikes = sizes[:, 1]
+        gids_all = np.empty(n_cells.sum(), dtype=np.int64)
+        counts_all = np.empty(n_cells.sum(), dtype=np.int64)
+        times_all = np.empty(n_spikes.sum(), dtype=np.float64)
+        cell_displ = np.r_[0, np.cumsum(n_cells)[:-1]]
+        spike_displ = np.r_[0, np.cumsum(n_spikes)[:-1]]
+        gids_recv = [gids_all, (n_cells, cell_displ), MPI.INT64_T]
+        counts_recv = [counts_all, (n_cells, cell_displ), MPI.INT64_T]
+        times_recv = [times_all, (n_spikes, spike_displ), MPI.DOUBLE]
+    else:
+        gids_recv = None
+        counts_recv = None
+        times_recv = None
+    COMM.Gatherv([gids, MPI.INT64_T], gids_recv, root=0)
+    COMM.Gatherv([counts, MPI.INT64_T], counts_recv, root=0)
+    COMM.Gatherv([times, MPI.DOUBLE], times_recv, root=0)
 
+    if RANK == 0:
+        offsets = np.zeros(counts_all.size + 1, dtype=np.int64)
+        np.cumsum(counts_all, out=offsets[1:])
+        return gids_all, offsets, times_all
+    else:
+        return None, None, None
 
-def ReduceStructArray(sendbuf, op=MPI.SUM):
+
+def ReduceStructArray(sendbuf, op=MPI.SUM, mode='Reduce', in_place=False,
+                      chunk_size=2**26):
     """
     simplify MPI Reduce for structured ndarrays with floating point numbers
 
+    All fields are packed into one contiguous float64 buffer (a view of
+    sendbuf if its fields already are packed float64) that is reduced with
+    one collective operation per chunk using MPI.IN_PLACE.
+
     Parameters
     ----------
     sendbuf : structured ndarray
         Array data to be reduced (default: summed)
     op : mpi4py.MPI.Op object
         MPI_Reduce function. Default is mpi4py.MPI.SUM
+    mode : str
+        'Reduce': the result is returned on RANK 0 only (None elsewhere),
+        'Allreduce': the result is returned on every RANK,
+        'Reduce_scatter': the result is split along the first axis of
+        sendbuf, and each RANK returns its own block.
+        Default is 'Reduce'
+    in_place : bool
+        if True, the reduced values are written into sendbuf whenever it
+        can be viewed as a float64 buffer, avoiding a second array of the
+        same size. Default is False
+    chunk_size : int
+        maximum number of float64 values reduced per collective call, so
+        that message sizes stay below the 2 GB limit of MPI int counts.
+        Default is 2**26 (512 MB)
+
+    Returns
+    -------
+    reduced : structured ndarray or None
+        Array with float64 fields, see parameter mode.
     """
+    try:
+        assert mode in ['Reduce', 'Allreduce', 'Reduce_scatter']
+    except AssertionError:
+        raise AssertionError("mode must be 'Reduce', 'Allreduce' or "
+                             "'Reduce_scatter', got {}".format(mode))
     if RANK == 0:
         shape = sendbuf.shape
         dtype_names = sendbuf.dtype.names
     else:
         shape = None
         dtype_names = None
-    shape = COMM.bcast(shape)
-    dtype_names = COMM.bcast(dtype_names)
-
-    if RANK == 0:
-        reduced = np.zeros(shape,
-                           dtype=list(zip(dtype_names,
-                                     ['f8' for i in range(len(dtype_names))])))
+    shape, dtype_names = COMM.bcast((shape, dtype_names))
+    dtype = np.dtype(list(zip(dtype_names,
+                              ['f8' for i in range(len(dtype_names))])))
+
+    # pack all fields in one contiguous float64 buffer
+    if sendbuf.dtype == dtype and sendbuf.flags['C_CONTIGUOUS']:
+        buf = sendbuf.reshape(-1).view(np.float64)
+        if not in_place and (mode != 'Reduce' or RANK == 0):
+            buf = buf.copy()
     else:
-        reduced = None
-    for name in dtype_names:
-        if RANK == 0:
-            recvbuf = np.zeros(shape)
+        packed = np.empty(shape, dtype=dtype)
+        for name in dtype_names:
+            packed[name] = sendbuf[name]
+        buf = packed.reshape(-1).view(np.float64)
+
+    if mode == 'Reduce_scatter':
+        # split records along the first axis between RANKs
+        nrows = shape[0] if len(shape) > 0 else 1
+        rowsize = buf.size // nrows if nrows > 0 else 0
+        rows = np.array([x.size for x in
+                         np.array_split(np.arange(nrows), SIZE)])
+        counts = rows * rowsize
+        displs = np.r_[0, np.cumsum(counts)[:-1]]
+        recvbuf = np.empty(counts[RANK])
+        for lo in range(0, max(counts.max(), 1), chunk_size):
+            sub_counts = np.clip(counts - lo, 0, chunk_size)
+            send = np.concatenate([buf[d + lo:d + lo + c]
+                                   for d, c in zip(displs, sub_counts)])
+            COMM.Reduce_scatter(send, recvbuf[lo:lo + sub_counts[RANK]],
+                                recvcounts=sub_counts, op=op)
+        return recvbuf.view(dtype).reshape((rows[RANK], ) + tuple(shape[1:]))
+
+    for lo in range(0, buf.size, chunk_size):
+        chunk = buf[lo:lo + chunk_size]
+        if mode == 'Allreduce':
+            COMM.Allreduce(MPI.IN_PLACE, chunk, op=op)
+        elif RANK == 0:
+            COMM.Reduce(MPI.IN_PLACE, chunk, op=op, root=0)
         else:
-            recvbuf = None
-        COMM.Reduce(np.array(sendbuf[name]), recvbuf, op=op, root=0)
-        if RANK == 0:
-            reduced[name] = recvbuf
-    return reduced
+            COMM.Reduce(chunk, None, op=op, root=0)
+
+    if mode == 'Reduce' and RANK != 0:
+        return None
+    return buf.view(dtype).reshape(shape)
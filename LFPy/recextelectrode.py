@@ -15,11 +15,18 @@ GNU General Public License for more details.
 """
 
 from __future__ import division
+import os
 import sys
+import shutil
+import tempfile
 import warnings
+import multiprocessing
 import numpy as np
+import scipy.sparse as sp
 from . import lfpcalc, tools
 
+_golden_ratio = (1 + np.sqrt(5)) / 2
+
 class RecExtElectrode:
     """class RecExtElectrode
 
@@ -48,10 +55,36 @@ class RecExtElectrode:
     contact_shape : str
         'circle'/'square' (default 'circle') defines the contact point shape
         If 'circle' r is the radius, if 'square' r is the side length
+    quadrature : str
+        'random'/'fibonacci' (default 'random') defines the placement of the
+        n points on each contact surface. If 'random', points are uniformly
+        distributed at random, see seedvalue. If 'fibonacci', points are
+        placed deterministically and evenly on a Fibonacci (sunflower)
+        spiral for circles or a Fibonacci lattice for squares
     method : str
         switch between the assumption of 'linesource', 'pointsource',
         'soma_as_point' to represent each compartment when computing
-        extracellular potentials
+        extracellular potentials. 'linesource+multipole' uses 'linesource'
+        close to each cell, and a multipole expansion (monopole, dipole and
+        quadrupole) of each cell far away from it. Unless cutoff_distance or
+        cutoff_rtol is set, the mapping is then an OctreeMapping instance
+        holding the expansion in factored form, see
+        lfpcalc.calc_lfp_linesource_multipole_factored. 'linesource+octree'
+        sums over a hierarchical clustering of all segments, using multipole
+        expansions of well-separated clusters and 'linesource' otherwise.
+        The mapping is then an OctreeMapping instance in factored form,
+        whose size and cost of computing and applying scale near-linearly
+        with the number of segments, see
+        lfpcalc.calc_lfp_linesource_octree
+    multipole_tolerance : float
+        if method is 'linesource+multipole' or 'linesource+octree', bound on
+        the truncation error of the multipole expansion relative to the
+        bound on the dipole term, see
+        lfpcalc.calc_lfp_linesource_multipole_batch. Smaller values use
+        the expansion only further away from each cell or cluster
+    octree_leaf_size : int
+        if method is 'linesource+octree', maximum number of segments of
+        the smallest clusters
     from_file : bool
         if True, load cell object from file
     cellfile : str
@@ -59,7 +92,32 @@ class RecExtElectrode:
     verbose : bool
         Flag for verbose output, i.e., print more information
     seedvalue : int
-        random seed when finding random position on contact with r > 0
+        random seed when finding random position on contact with r > 0.
+        If not None, the same points are used for every contact
+    cutoff_distance : None or float
+        if not None, discard the contributions of segments further away than
+        cutoff_distance (um) from each contact, measured as the shortest
+        distance between the contact point and each segment minus the
+        radius of the circle circumscribing the contact surface (if r is
+        set). The mapping is computed in blocks of contacts keeping only the
+        remaining contributions, and the attribute mapping is a
+        scipy.sparse.csr_matrix
+    cutoff_rtol : None or float
+        if not None, discard contributions to each contact that are smaller
+        in magnitude than cutoff_rtol times the largest contribution to the
+        same contact. The attribute mapping is then a scipy.sparse.csr_matrix
+    mapping_cache : None or LFPy.tools.MappingCache
+        if not None, calc_mapping reuses mappings stored in mapping_cache for
+        identical cell geometries and electrode parameters, and stores newly
+        computed mappings in it. Mappings of contacts with random positions
+        for the n-point average (quadrature 'random' and seedvalue None) and
+        OctreeMapping instances are not cached
+    n_workers : None or int
+        if larger than 1, calc_mapping computes the mapping of blocks of
+        contact points in parallel in a pool of n_workers processes. The
+        cell geometry and the mapping are shared with the processes
+        through memory-mapped temporary files. Not used when the mapping is
+        an OctreeMapping instance
 
     Examples
     --------
@@ -168,10 +226,13 @@ class RecExtElectrode:
 
     def __init__(self, cell=None, sigma=0.3,
                  x=np.array([0]), y=np.array([0]), z=np.array([0]),
-                 N=None, r=None, n=None, contact_shape='circle', r_z=None,
-                 perCellLFP=False, method='linesource',
+                 N=None, r=None, n=None, contact_shape='circle',
+                 quadrature='random', r_z=None, perCellLFP=False,
+                 method='linesource', multipole_tolerance=1E-2,
+                 octree_leaf_size=32,
                  from_file=False, cellfile=None, verbose=False,
-                 seedvalue=None, **kwargs):
+                 seedvalue=None, cutoff_distance=None, cutoff_rtol=None,
+                 mapping_cache=None, n_workers=None, **kwargs):
         """Initialize RecExtElectrode class"""
 
         self.sigma = sigma
@@ -233,12 +294,22 @@ class RecExtElectrode:
             raise ValueError('The contact_shape argument must be either: '
                              'None, \'circle\', \'square\'')
 
+        if quadrature in ['random', 'fibonacci']:
+            self.quadrature = quadrature
+        else:
+            raise ValueError('The quadrature argument must be either: '
+                             '\'random\', \'fibonacci\'')
+
         self.r_z = r_z
         self.perCellLFP = perCellLFP
 
         self.method = method
         self.verbose = verbose
         self.seedvalue = seedvalue
+        self.cutoff_distance = cutoff_distance
+        self.cutoff_rtol = cutoff_rtol
+        self.mapping_cache = mapping_cache
+        self.n_workers = n_workers
 
         self.kwargs = kwargs
 
@@ -260,27 +331,63 @@ class RecExtElectrode:
         if cell is not None:
             self.set_cell(cell)
 
+        # lfp_method_batch, if not None, computes the mapping for all contact
+        # points at once. lfp_method_kwargs are additional keyword arguments
+        # to both
+        self.lfp_method_batch = None
+        self.lfp_method_kwargs = {}
         if method == 'soma_as_point':
             if self.anisotropic:
                 self.lfp_method = lfpcalc.calc_lfp_soma_as_point_anisotropic
+                self.lfp_method_batch = lfpcalc.calc_lfp_soma_as_point_anisotropic_batch
             else:
                 self.lfp_method = lfpcalc.calc_lfp_soma_as_point
+                self.lfp_method_batch = lfpcalc.calc_lfp_soma_as_point_batch
         elif method == 'som_as_point':
             raise RuntimeError('The method "som_as_point" is deprecated.'
                                      'Use "soma_as_point" instead')
         elif method == 'linesource':
             if self.anisotropic:
                 self.lfp_method = lfpcalc.calc_lfp_linesource_anisotropic
+                self.lfp_method_batch = lfpcalc.calc_lfp_linesource_anisotropic_batch
             else:
                 self.lfp_method = lfpcalc.calc_lfp_linesource
+                self.lfp_method_batch = lfpcalc.calc_lfp_linesource_batch
+        elif method == 'linesource+multipole':
+            if self.anisotropic:
+                raise NotImplementedError("The method 'linesource+multipole' "
+                                          "is only supported for isotropic "
+                                          "conductivity")
+            self.lfp_method = lfpcalc.calc_lfp_linesource_multipole
+            self.lfp_method_batch = lfpcalc.calc_lfp_linesource_multipole_batch
+            self.lfp_method_kwargs = {
+                'multipole_tolerance' : multipole_tolerance}
+        elif method == 'linesource+octree':
+            if self.anisotropic:
+                raise NotImplementedError("The method 'linesource+octree' "
+                                          "is only supported for isotropic "
+                                          "conductivity")
+            if cutoff_distance is not None or cutoff_rtol is not None:
+                raise ValueError("cutoff_distance and cutoff_rtol are not "
+                                 "supported with method 'linesource+octree'")
+            # the octree is used for the full mapping, lfp_method and
+            # lfp_method_batch treat each cell as one cluster
+            self.lfp_method = lfpcalc.calc_lfp_linesource_multipole
+            self.lfp_method_batch = lfpcalc.calc_lfp_linesource_multipole_batch
+            self.lfp_method_kwargs = {
+                'multipole_tolerance' : multipole_tolerance,
+                'leaf_size' : octree_leaf_size}
         elif method == 'pointsource':
             if self.anisotropic:
                 self.lfp_method = lfpcalc.calc_lfp_pointsource_anisotropic
+                self.lfp_method_batch = lfpcalc.calc_lfp_pointsource_anisotropic_batch
             else:
                 self.lfp_method = lfpcalc.calc_lfp_pointsource
+                self.lfp_method_batch = lfpcalc.calc_lfp_pointsource_batch
         else:
             raise ValueError("LFP method not recognized. "
-                             "Should be 'soma_as_point', 'linesource' "
+                             "Should be 'soma_as_point', 'linesource', "
+                             "'linesource+multipole', 'linesource+octree' "
                              "or 'pointsource'")
 
     def set_cell(self, cell):
@@ -299,7 +406,52 @@ class RecExtElectrode:
         self.cell = cell
         if self.cell is not None:
             self.r_limit = self.cell.diam/2
-            self.mapping = np.zeros((self.x.size, len(cell.xmid)))
+            if self._use_cutoff():
+                self.mapping = sp.csr_matrix((self.x.size, len(cell.xmid)))
+            else:
+                self.mapping = np.zeros((self.x.size, len(cell.xmid)))
+
+    def _use_cutoff(self):
+        """Return True if cutoff_distance or cutoff_rtol is set"""
+        return (getattr(self, 'cutoff_distance', None) is not None or
+                getattr(self, 'cutoff_rtol', None) is not None)
+
+    def _use_factored_mapping(self):
+        """Return True if the mapping is an OctreeMapping instance in
+        factored form, i.e., for method 'linesource+octree', and for method
+        'linesource+multipole' unless cutoff_distance or cutoff_rtol is set"""
+        return (self.method == 'linesource+octree' or
+                (self.method == 'linesource+multipole' and
+                 not self._use_cutoff()))
+
+    def _open_mapping_pool(self):
+        """Create the pool of n_workers processes sharing the cell geometry
+        used by _calc_batch for all blocks of contacts, if n_workers is
+        larger than 1"""
+        self._mapping_pool = None
+        if (self.n_workers is not None and self.n_workers > 1 and
+                self.lfp_method_batch is not None and
+                not self._use_factored_mapping()):
+            self._mapping_pool = _MappingPool(self.lfp_method_batch,
+                                              self.cell, self.sigma,
+                                              self.r_limit, self.n_workers)
+
+    def _close_mapping_pool(self):
+        """Stop the pool of processes created by _open_mapping_pool"""
+        if getattr(self, '_mapping_pool', None) is not None:
+            self._mapping_pool.close()
+        self._mapping_pool = None
+
+    def _calc_factored_mapping(self, x, y, z, **kwargs):
+        """Return the factors near, far, moments of the mapping of positions
+        x, y, z, see lfpcalc.calc_lfp_linesource_octree and
+        lfpcalc.calc_lfp_linesource_multipole_factored"""
+        if self.method == 'linesource+octree':
+            lfp_method = lfpcalc.calc_lfp_linesource_octree
+        else:
+            lfp_method = lfpcalc.calc_lfp_linesource_multipole_factored
+        return lfp_method(self.cell, x = x, y = y, z = z, sigma = self.sigma,
+                          r_limit = self.r_limit, **kwargs)
 
 
     def _test_imem_sum(self, tolerance=1E-8):
@@ -330,9 +482,13 @@ class RecExtElectrode:
         at each electrode contact point of the RexExtElectrode object. Sets
         the class attribute "mapping", which is a shape (n_contact, n_segs)
         ndarray, such that the extracellular potential at the contacts
-        phi = np.dot(mapping, I_mem)
+        phi = mapping.dot(I_mem)
         where I_mem is a shape (n_segs, n_tsteps) ndarray with transmembrane
-        currents for each time step of the simulation.
+        currents for each time step of the simulation. If either of the
+        class attributes cutoff_distance or cutoff_rtol is not None, mapping
+        is a scipy.sparse.csr_matrix of the same shape. If method is
+        'linesource+octree', or 'linesource+multipole' without cutoff,
+        mapping is an OctreeMapping instance.
 
         Parameters
         ----------
@@ -345,6 +501,16 @@ class RecExtElectrode:
         """
         if cell is not None:
             self.set_cell(cell)
+        elif (not isinstance(self.mapping, np.ndarray) and
+              not self._use_cutoff()):
+            self.mapping = np.zeros(self.mapping.shape)
+
+        key = self._get_mapping_key()
+        if key is not None:
+            mapping = self.mapping_cache.get(key)
+            if mapping is not None:
+                self.mapping = mapping
+                return
 
         if self.n is not None and self.N is not None and self.r is not None:
             if self.n <= 1:
@@ -352,16 +518,21 @@ class RecExtElectrode:
             else:
                 pass
 
-            self._lfp_el_pos_calc_dist()
+        # one pool of processes for all blocks of contacts
+        self._open_mapping_pool()
+        try:
+            if self.n is not None and self.N is not None and self.r is not None:
+                self._lfp_el_pos_calc_dist(**self.lfp_method_kwargs)
+            else:
+                self._loop_over_contacts(**self.lfp_method_kwargs)
+        finally:
+            self._close_mapping_pool()
+        if self.verbose:
+            print('calculations finished, %s, %s' % (str(self),
+                                                     str(self.cell)))
 
-            if self.verbose:
-                print('calculations finished, %s, %s' % (str(self),
-                                                         str(self.cell)))
-        else:
-            self._loop_over_contacts()
-            if self.verbose:
-                print('calculations finished, %s, %s' % (str(self),
-                                                         str(self.cell)))
+        if key is not None:
+            self.mapping_cache.put(key, self.mapping)
 
     def calc_lfp(self, t_indices=None, cell=None):
         """Calculate LFP on electrode geometry from all cell instances.
@@ -386,165 +557,277 @@ class RecExtElectrode:
             currmem = self.cell.imem
 
         self._test_imem_sum()
-        self.LFP = np.dot(self.mapping, currmem)
+        self.LFP = self.mapping.dot(currmem)
         # del self.mapping
 
 
+    def _get_mapping_key(self):
+        """Return key of the mapping in mapping_cache, computed from the cell
+        geometry and the electrode parameters, or None if the mapping
+        should not be cached"""
+        if self.mapping_cache is None or self._use_factored_mapping():
+            return None
+        if self.n is not None and self.N is not None and self.r is not None:
+            if self.quadrature == 'random' and self.seedvalue is None:
+                return None
+            N = np.array(self.N)
+        else:
+            N = None
+        return self.mapping_cache.get_key(
+            self.__class__.__name__, self.method,
+            np.array(self.sigma) if self.sigma is not None else None,
+            self.cell.xstart, self.cell.ystart, self.cell.zstart,
+            self.cell.xend, self.cell.yend, self.cell.zend,
+            np.array(self.r_limit), self.x, self.y, self.z,
+            N, self.r, self.n, self.contact_shape, self.quadrature,
+            self.seedvalue,
+            self.cutoff_distance, self.cutoff_rtol,
+            sorted(self.lfp_method_kwargs.items()),
+            sorted(getattr(self, 'moi_param_kwargs', {}).items()))
+
+    def _get_segment_distances(self, rows=slice(None)):
+        """Return shape (n_rows, n_segs) array with the shortest distance
+        between the center of each contact in rows and each segment of the
+        cell"""
+        start = np.c_[self.cell.xstart, self.cell.ystart, self.cell.zstart]
+        dr = np.c_[self.cell.xend, self.cell.yend, self.cell.zend] - start
+        dr2 = (dr**2).sum(axis=1)
+        dr2[dr2 == 0] = 1. # avoid division by zero for zero-length segments
+        r = (np.c_[self.x[rows], self.y[rows], self.z[rows]][:, np.newaxis, :]
+             - start[np.newaxis, :, :])
+        # closest point along each segment
+        u = np.clip(np.einsum('ijk,jk->ij', r, dr) / dr2, 0, 1)
+        return np.sqrt(((r - u[:, :, np.newaxis] * dr)**2).sum(axis=2))
+
+    def _get_contact_radius(self):
+        """Return the radius of the circle circumscribing each contact
+        surface, or 0 for point contacts"""
+        if self.n is None or self.N is None or self.r is None:
+            return 0.
+        if self.contact_shape == 'circle':
+            return self.r
+        return self.r * np.sqrt(2) / 2
+
+    def _calc_mapping_blocks(self, calc_rows, **kwargs):
+        """Set the attribute mapping from the rows computed by
+        calc_rows(rows, **kwargs) for contacts rows. If cutoff_distance or
+        cutoff_rtol is not None, the mapping is computed for blocks of
+        contacts, and only the contributions within cutoff_distance of the
+        contact surface and/or larger than cutoff_rtol times the largest
+        contribution to the contact are kept, in a scipy.sparse.csr_matrix.
+        The full dense mapping is then never stored"""
+        if not self._use_cutoff():
+            self.mapping[:] = calc_rows(slice(None), **kwargs)
+            return
+
+        # blocks of contacts are computed in parallel if n_workers > 1
+        block_size = 64 * max(1, self.n_workers or 1)
+        contact_radius = self._get_contact_radius()
+        rows = [np.zeros(0, dtype=int)]
+        cols = [np.zeros(0, dtype=int)]
+        data = [np.zeros(0)]
+        for start in range(0, self.x.size, block_size):
+            block = slice(start, start + block_size)
+            mapping = calc_rows(block, **kwargs)
+            mask = mapping != 0
+            if self.cutoff_distance is not None:
+                mask &= (self._get_segment_distances(block) - contact_radius
+                         <= self.cutoff_distance)
+            if self.cutoff_rtol is not None:
+                abs_mapping = abs(mapping)
+                mask &= abs_mapping >= (self.cutoff_rtol *
+                                        abs_mapping.max(axis=1)[:, np.newaxis])
+            i, j = np.nonzero(mask)
+            rows.append(i + start)
+            cols.append(j)
+            data.append(mapping[i, j])
+        self.mapping = sp.csr_matrix((np.concatenate(data),
+                                      (np.concatenate(rows),
+                                       np.concatenate(cols))),
+                                     shape=(self.x.size, self.cell.totnsegs))
+
     def _loop_over_contacts(self, **kwargs):
         """Loop over electrode contacts, and return LFPs across channels"""
 
-        for i in range(self.x.size):
-            self.mapping[i, :] = self.lfp_method(self.cell,
-                                             x = self.x[i],
-                                             y = self.y[i],
-                                             z = self.z[i],
-                                             sigma = self.sigma,
-                                             r_limit = self.r_limit,
-                                             **kwargs)
-
+        if self._use_factored_mapping():
+            self.mapping = OctreeMapping(*self._calc_factored_mapping(
+                self.x, self.y, self.z, **kwargs))
+            return
+
+        self._calc_mapping_blocks(self._calc_contact_rows, **kwargs)
+
+    def _calc_contact_rows(self, rows, **kwargs):
+        """Return the mapping of point contacts rows"""
+        x = self.x[rows]
+        y = self.y[rows]
+        z = self.z[rows]
+        if self.lfp_method_batch is not None:
+            return self._calc_batch(x, y, z, **kwargs)
+
+        mapping = np.empty((x.size, self.cell.totnsegs))
+        for i in range(x.size):
+            mapping[i, :] = self.lfp_method(self.cell,
+                                            x = x[i],
+                                            y = y[i],
+                                            z = z[i],
+                                            sigma = self.sigma,
+                                            r_limit = self.r_limit,
+                                            **kwargs)
+        return mapping
+
+
+    def _calc_batch(self, x, y, z, n_average=1, **kwargs):
+        """Return the mapping of positions x, y, z computed with
+        lfp_method_batch, in a pool of n_workers processes if n_workers is
+        larger than 1. Rows of n_average consecutive positions are
+        averaged"""
+        if self.n_workers is None or self.n_workers <= 1:
+            mapping = self.lfp_method_batch(self.cell, x = x, y = y, z = z,
+                                            sigma = self.sigma,
+                                            r_limit = self.r_limit, **kwargs)
+            return mapping.reshape(-1, n_average, mapping.shape[-1]
+                                   ).mean(axis=1)
+        if getattr(self, '_mapping_pool', None) is not None:
+            return self._mapping_pool.calc(x, y, z, n_average=n_average,
+                                           **kwargs)
+        return _calc_batch_parallel(self.lfp_method_batch, self.cell, x, y, z,
+                                    self.sigma, self.r_limit, self.n_workers,
+                                    n_average=n_average, **kwargs)
+
+    def _get_contact_basis(self):
+        """Return two shape (n_contacts, 3) arrays with orthonormal vectors
+        spanning the plane of each contact surface, perpendicular to the
+        normal vectors N"""
+        N = np.array(self.N, dtype=float).reshape(-1, 3)
+        N = N / np.sqrt((N**2).sum(axis=1))[:, np.newaxis]
+        if N.shape[0] == 1:
+            N = np.repeat(N, self.x.size, axis=0)
+        # cross normal vectors with the least parallel coordinate axis
+        axes = np.eye(3)[abs(N).argmin(axis=1)]
+        e1 = np.cross(N, axes)
+        e1 /= np.sqrt((e1**2).sum(axis=1))[:, np.newaxis]
+        e2 = np.cross(N, e1)
+        return e1, e2
+
+    def _get_contact_points(self):
+        """Return shape (n_contacts, n, 2) array with in-plane coordinates
+        (um) of the n points on each contact surface used for the n-point
+        average, placed according to the attribute quadrature"""
+        if self.quadrature == 'fibonacci':
+            j = np.arange(self.n) + 0.5
+            if self.contact_shape == 'circle':
+                # sunflower spiral with equal area per point
+                rho = self.r * np.sqrt(j / self.n)
+                theta = 2 * np.pi * j / _golden_ratio
+                uv = np.c_[rho * np.cos(theta), rho * np.sin(theta)]
+            else:
+                # Fibonacci lattice on the square
+                uv = np.c_[j / self.n, (j / _golden_ratio) % 1] - 0.5
+                uv *= self.r
+            return np.repeat(uv[np.newaxis], self.x.size, axis=0)
+
+        # uniformly distributed random points. The same points are used for
+        # every contact if seedvalue is not None
+        if self.seedvalue is not None:
+            rand = np.random.RandomState(self.seedvalue).rand(1, self.n, 2)
+            rand = np.repeat(rand, self.x.size, axis=0)
+        else:
+            rand = np.random.rand(self.x.size, self.n, 2)
+        if self.contact_shape == 'circle':
+            rho = self.r * np.sqrt(rand[:, :, 0])
+            theta = 2 * np.pi * rand[:, :, 1]
+            return np.concatenate([(rho * np.cos(theta))[:, :, np.newaxis],
+                                   (rho * np.sin(theta))[:, :, np.newaxis]],
+                                  axis=2)
+        else:
+            return (rand - 0.5) * self.r
 
     def _lfp_el_pos_calc_dist(self, **kwargs):
-
         """
         Calc. of LFP over an n-point integral approximation over flat
         electrode surface: circle of radius r or square of side r. The
-        locations of these n points on the electrode surface are random,
-        within the given surface. """
-        # lfp_el_pos = np.zeros(self.LFP.shape)
+        locations of these n points on the electrode surface are given by
+        the attribute quadrature. The potential at all n points of each
+        contact is computed in one call to the batched lfp method. """
+        e1, e2 = self._get_contact_basis()
+        uv = self._get_contact_points()
+        # shape (n_contacts, n, 3) positions of points on contact surfaces
+        xyz_n = (np.c_[self.x, self.y, self.z][:, np.newaxis, :] +
+                 uv[:, :, :1] * e1[:, np.newaxis, :] +
+                 uv[:, :, 1:] * e2[:, np.newaxis, :])
+
+        # circumscribed circle around each contact
+        if self.contact_shape == 'circle':
+            r_circ = self.r
+        else:
+            r_circ = self.r * np.sqrt(2) / 2
+        theta = 2 * np.pi * np.arange(self.n) / self.n
+        crcl = (np.c_[self.x, self.y, self.z][:, np.newaxis, :] +
+                r_circ * np.cos(theta)[np.newaxis, :, np.newaxis] *
+                e1[:, np.newaxis, :] +
+                r_circ * np.sin(theta)[np.newaxis, :, np.newaxis] *
+                e2[:, np.newaxis, :])
+
+        if self._use_factored_mapping():
+            near, far, moments = self._calc_factored_mapping(
+                xyz_n[:, :, 0], xyz_n[:, :, 1], xyz_n[:, :, 2], **kwargs)
+            # average over the n points of each contact
+            average = sp.kron(sp.eye(self.x.size),
+                              np.ones((1, self.n)) / self.n, format='csr')
+            self.mapping = OctreeMapping(average.dot(near), average.dot(far),
+                                         moments)
+        else:
+            self._calc_mapping_blocks(self._calc_contact_rows_n, xyz_n=xyz_n,
+                                      **kwargs)
+
         self.offsets = {}
         self.circle_circ = {}
-
-        def create_crcl(i):
-            """make circumsize of contact point"""
-            crcl = np.zeros((self.n, 3))
-            for j in range(self.n):
-                B = [(np.random.rand()-0.5),
-                    (np.random.rand()-0.5),
-                    (np.random.rand()-0.5)]
-                crcl[j, ] = np.cross(self.N[i, ], B)
-                crcl[j, ] = crcl[j, ]/np.sqrt(crcl[j, 0]**2 +
-                                           crcl[j, 1]**2 +
-                                           crcl[j, 2]**2)*self.r
-
-            crclx = crcl[:, 0] + self.x[i]
-            crcly = crcl[:, 1] + self.y[i]
-            crclz = crcl[:, 2] + self.z[i]
-
-            return crclx, crcly, crclz
-
-        def create_sqr(i):
-            """make circle in which square contact is circumscribed"""
-            sqr = np.zeros((self.n, 3))
-            for j in range(self.n):
-                B = [(np.random.rand() - 0.5),
-                     (np.random.rand() - 0.5),
-                     (np.random.rand() - 0.5)]
-                sqr[j,] = np.cross(self.N[i,], B)/np.linalg.norm(np.cross(self.N[i,], B)) * self.r * np.sqrt(2)/2
-
-            sqrx = sqr[:, 0] + self.x[i]
-            sqry = sqr[:, 1] + self.y[i]
-            sqrz = sqr[:, 2] + self.z[i]
-
-            return sqrx, sqry, sqrz
-
-        def calc_xyz_n(i):
-            """calculate some offsets"""
-            #offsets and radii init
-            offs = np.zeros((self.n, 3))
-            r2 = np.zeros(self.n)
-
-            #assert the same random numbers are drawn every time
-            if self.seedvalue is not None:
-                np.random.seed(self.seedvalue)
-
-            if self.contact_shape is 'circle':
-                for j in range(self.n):
-                    A = [(np.random.rand()-0.5)*self.r*2,
-                        (np.random.rand()-0.5)*self.r*2,
-                        (np.random.rand()-0.5)*self.r*2]
-                    offs[j, ] = np.cross(self.N[i, ], A)
-                    r2[j] = offs[j, 0]**2 + offs[j, 1]**2 + offs[j, 2]**2
-                    while r2[j] > self.r**2:
-                        A = [(np.random.rand()-0.5)*self.r*2,
-                            (np.random.rand()-0.5)*self.r*2,
-                            (np.random.rand()-0.5)*self.r*2]
-                        offs[j, ] = np.cross(self.N[i, ], A)
-                        r2[j] = offs[j, 0]**2 + offs[j, 1]**2 + offs[j, 2]**2
-            elif self.contact_shape is 'square':
-                for j in range(self.n):
-                    A = [(np.random.rand()-0.5),
-                        (np.random.rand()-0.5),
-                        (np.random.rand()-0.5)]
-                    offs[j, ] = np.cross(self.N[i, ], A)*self.r
-                    r2[j] = offs[j, 0]**2 + offs[j, 1]**2 + offs[j, 2]**2
-
-            x_n = offs[:, 0] + self.x[i]
-            y_n = offs[:, 1] + self.y[i]
-            z_n = offs[:, 2] + self.z[i]
-
-            return x_n, y_n, z_n
-
-        def loop_over_points(x_n, y_n, z_n):
-
-            #loop over points on contact
-            for j in range(self.n):
-                tmp = self.lfp_method(self.cell,
+        for i in range(self.x.size):
+            self.offsets[i] = {'x_n' : xyz_n[i, :, 0],
+                               'y_n' : xyz_n[i, :, 1],
+                               'z_n' : xyz_n[i, :, 2]}
+            self.circle_circ[i] = {'x' : crcl[i, :, 0],
+                                   'y' : crcl[i, :, 1],
+                                   'z' : crcl[i, :, 2]}
+
+    def _calc_contact_rows_n(self, rows, xyz_n, **kwargs):
+        """Return the mapping of contacts rows averaged over the n points
+        xyz_n on each contact surface"""
+        xyz_n = xyz_n[rows]
+        if self.lfp_method_batch is not None:
+            if self.n_workers is not None and self.n_workers > 1:
+                # all points at once, such that they are split across
+                # processes which each average the n points of their blocks
+                # of contacts
+                step = xyz_n.shape[0]
+            else:
+                # all points of blocks of contacts in one call each, as in
+                # _mapping_worker
+                step = max(1, 64 // self.n)
+            mapping = np.empty((xyz_n.shape[0], self.cell.totnsegs))
+            for i in range(0, xyz_n.shape[0], step):
+                points = xyz_n[i:i + step].reshape(-1, 3)
+                mapping[i:i + step] = self._calc_batch(points[:, 0],
+                                                       points[:, 1],
+                                                       points[:, 2],
+                                                       n_average=self.n,
+                                                       **kwargs)
+            return mapping
+
+        mapping = np.empty((xyz_n.shape[0], self.cell.totnsegs))
+        for i in range(xyz_n.shape[0]):
+            x_n, y_n, z_n = xyz_n[i].T
+            lfp_e = np.array([self.lfp_method(self.cell,
                                               x = x_n[j],
                                               y = y_n[j],
                                               z = z_n[j],
                                               r_limit = self.r_limit,
                                               sigma = self.sigma,
-                                              **kwargs
-                                              )
-
-                if j == 0:
-                    lfp_e = tmp
-                else:
-                    lfp_e = np.r_['0,2', lfp_e, tmp]
-
-                #no longer needed
-                del tmp
-
-            return lfp_e.mean(axis=0)
-
-        #loop over contacts
-        for i in range(len(self.x)):
-            if self.n > 1:
-
-                #fetch offsets:
-                x_n, y_n, z_n = calc_xyz_n(i)
-
-                #fill in with contact average
-                self.mapping[i] = loop_over_points(x_n, y_n, z_n) #lfp_e.mean(axis=0)
-
-            else:
-                self.mapping[i] = self.lfp_method(self.cell,
-                                              x=self.x[i],
-                                              y=self.y[i],
-                                              z=self.z[i],
-                                              r_limit = self.r_limit,
-                                              sigma=self.sigma,
                                               **kwargs)
-
-            self.offsets[i] = {'x_n' : x_n,
-                               'y_n' : y_n,
-                               'z_n' : z_n}
-
-            #fetch circumscribed circle around contact
-            if self.contact_shape is 'circle':
-                crcl = create_crcl(i)
-                self.circle_circ[i] = {
-                    'x' : crcl[0],
-                    'y' : crcl[1],
-                    'z' : crcl[2],
-                }
-            elif self.contact_shape is 'square':
-                sqr = create_sqr(i)
-                self.circle_circ[i] = {
-                    'x': sqr[0],
-                    'y': sqr[1],
-                    'z': sqr[2],
-                }
+                              for j in range(self.n)])
+            #fill in with contact average
+            mapping[i] = lfp_e.mean(axis=0)
+        return mapping
 
 
 class RecMEAElectrode(RecExtElectrode):
@@ -579,6 +862,19 @@ class RecMEAElectrode(RecExtElectrode):
     sigma_G : float
         conductivity of MEA glass electrode plate. Most commonly
         assumed non-conducting [0.0] (S/m)
+    h : float
+        slice thickness (um)
+    steps : int
+        maximum number of terms in the method of images series
+    tolerance : None or float
+        if not None, terminate the method of images series once the estimated
+        truncation error of every element of the mapping is below tolerance
+        relative to the element. The estimated truncation error of each
+        contact is stored in the attribute truncation_error
+    accelerate : bool
+        if True, apply Aitken's delta-squared extrapolation to the method of
+        images series, typically reducing the number of terms needed for a
+        given tolerance
     squeeze_cell_factor : float or None
         Factor to squeeze the cell in the z-direction. This is
         needed for large cells that are thicker than the slice, since no part
@@ -599,6 +895,12 @@ class RecMEAElectrode(RecExtElectrode):
     contact_shape : str
         'circle'/'square' (default 'circle') defines the contact point shape
         If 'circle' r is the radius, if 'square' r is the side length
+    quadrature : str
+        'random'/'fibonacci' (default 'random') defines the placement of the
+        n points on each contact surface. If 'random', points are uniformly
+        distributed at random, see seedvalue. If 'fibonacci', points are
+        placed deterministically and evenly on a Fibonacci (sunflower)
+        spiral for circles or a Fibonacci lattice for squares
     method : str
         switch between the assumption of 'linesource', 'pointsource',
         'soma_as_point' to represent each compartment when computing
@@ -610,7 +912,22 @@ class RecMEAElectrode(RecExtElectrode):
     verbose : bool
         Flag for verbose output, i.e., print more information
     seedvalue : int
-        random seed when finding random position on contact with r > 0
+        random seed when finding random position on contact with r > 0.
+        If not None, the same points are used for every contact
+    cutoff_distance : None or float
+        if not None, discard the contributions of segments further away than
+        cutoff_distance (um) from each contact point, see RecExtElectrode
+    cutoff_rtol : None or float
+        if not None, discard contributions to each contact that are smaller
+        in magnitude than cutoff_rtol times the largest contribution to the
+        same contact, see RecExtElectrode
+    mapping_cache : None or LFPy.tools.MappingCache
+        if not None, reuse mappings stored in mapping_cache for identical
+        cell geometries and electrode parameters, see RecExtElectrode. The
+        attribute truncation_error is None for cached mappings
+    n_workers : None or int
+        not supported, the mapping is computed in this process. A
+        ValueError is raised if larger than 1
 
     Examples
     See also examples/example_MEA.py
@@ -666,19 +983,24 @@ class RecMEAElectrode(RecExtElectrode):
 
     """
     def __init__(self, cell=None, sigma_T=0.3, sigma_S=1.5, sigma_G=0.0,
-                 h=300., steps=20,
+                 h=300., steps=20, tolerance=None, accelerate=False,
                  x=np.array([0]), y=np.array([0]), z=np.array([0]),
-                 N=None, r=None, n=None, r_z=None,
+                 N=None, r=None, n=None, contact_shape='circle',
+                 quadrature='random', r_z=None,
                  perCellLFP=False, method='linesource',
                  from_file=False, cellfile=None, verbose=False,
                  seedvalue=None, squeeze_cell_factor=None, **kwargs):
 
         RecExtElectrode.__init__(self, cell=cell,
                      x=x, y=y, z=z,
-                     N=N, r=r, n=n, r_z=r_z,
+                     N=N, r=r, n=n, contact_shape=contact_shape,
+                     quadrature=quadrature, r_z=r_z,
                      perCellLFP=perCellLFP, method=method,
                      from_file=from_file, cellfile=cellfile, verbose=verbose,
                      seedvalue=seedvalue, **kwargs)
+        if self.n_workers is not None and self.n_workers > 1:
+            raise ValueError("n_workers > 1 is not supported by "
+                             "RecMEAElectrode")
 
         self.sigma_G = sigma_G
         self.sigma_T = sigma_T
@@ -686,12 +1008,17 @@ class RecMEAElectrode(RecExtElectrode):
         self.sigma = None
         self.h = h
         self.steps = steps
+        self.tolerance = tolerance
+        self.accelerate = accelerate
+        self.truncation_error = None
         self.squeeze_cell_factor = squeeze_cell_factor
         self.moi_param_kwargs = {"h": self.h,
                                  "steps": self.steps,
                                  "sigma_G": self.sigma_G,
                                  "sigma_T": self.sigma_T,
                                  "sigma_S": self.sigma_S,
+                                 "tolerance": self.tolerance,
+                                 "accelerate": self.accelerate,
                                  }
 
         if cell is not None:
@@ -699,6 +1026,7 @@ class RecMEAElectrode(RecExtElectrode):
 
         if method == 'pointsource':
             self.lfp_method = lfpcalc.calc_lfp_pointsource_moi
+            self.lfp_method_batch = lfpcalc.calc_lfp_pointsource_moi_batch
         elif method == "linesource":
             if (np.abs(z) > 1e-9).any():
                 raise NotImplementedError("The method 'linesource' is only "
@@ -711,6 +1039,7 @@ class RecMEAElectrode(RecExtElectrode):
                                           "sigma_G=0 or method "
                                           "'pointsource'.")
             self.lfp_method = lfpcalc.calc_lfp_linesource_moi
+            self.lfp_method_batch = lfpcalc.calc_lfp_linesource_moi_batch
         elif method == "soma_as_point":
             if (np.abs(z) > 1e-9).any():
                 raise NotImplementedError("The method 'soma_as_point' is only "
@@ -723,12 +1052,34 @@ class RecMEAElectrode(RecExtElectrode):
                                           "sigma_G=0 or method "
                                           "'pointsource'.")
             self.lfp_method = lfpcalc.calc_lfp_soma_as_point_moi
+            self.lfp_method_batch = lfpcalc.calc_lfp_soma_as_point_moi_batch
         else:
             raise ValueError("LFP method not recognized. "
                              "Should be 'soma_as_point', 'linesource' "
                              "or 'pointsource'")
 
 
+    def _loop_over_contacts(self, **kwargs):
+        """Compute the mapping for all electrode contacts at once (or in
+        blocks of contacts if cutoff_distance or cutoff_rtol is set), and
+        store the estimated truncation error of the method of images series
+        for each contact"""
+        self.truncation_error = np.zeros(self.x.size)
+        self._calc_mapping_blocks(self._calc_contact_rows, **kwargs)
+
+    def _calc_contact_rows(self, rows, **kwargs):
+        """Return the mapping of point contacts rows, and store the
+        truncation error of each contact"""
+        mapping, error = self.lfp_method_batch(self.cell,
+                                               x = self.x[rows],
+                                               y = self.y[rows],
+                                               z = self.z[rows],
+                                               r_limit = self.r_limit,
+                                               return_error = True,
+                                               **kwargs)
+        self.truncation_error[rows] = np.abs(error).max(axis=1)
+        return mapping
+
     def _squeeze_cell_in_depth_direction(self):
         """Will squeeze self.cell centered around the soma by a scaling factor,
         so that it fits inside the slice. If scaling factor is not big enough,
@@ -779,9 +1130,11 @@ class RecMEAElectrode(RecExtElectrode):
         at each electrode contact point of the RexExtElectrode object. Sets
         the class attribute "mapping", which is a shape (n_contact, n_segs)
         ndarray, such that the extracellular potential at the contacts
-        phi = np.dot(mapping, I_mem)
+        phi = mapping.dot(I_mem)
         where I_mem is a shape (n_segs, n_tsteps) ndarray with transmembrane
-        currents for each time step of the simulation.
+        currents for each time step of the simulation. If either of the
+        class attributes cutoff_distance or cutoff_rtol is not None, mapping
+        is a scipy.sparse.csr_matrix of the same shape.
 
         Parameters
         ----------
@@ -794,8 +1147,19 @@ class RecMEAElectrode(RecExtElectrode):
         """
         if cell is not None:
             self.set_cell(cell)
+        elif (not isinstance(self.mapping, np.ndarray) and
+              not self._use_cutoff()):
+            self.mapping = np.zeros(self.mapping.shape)
         self.test_cell_extent()
 
+        key = self._get_mapping_key()
+        if key is not None:
+            mapping = self.mapping_cache.get(key)
+            if mapping is not None:
+                self.mapping = mapping
+                self.truncation_error = None
+                return
+
         if self.n is not None and self.N is not None and self.r is not None:
             if self.n <= 1:
                 raise ValueError("n = %i must be larger that 1" % self.n)
@@ -813,6 +1177,9 @@ class RecMEAElectrode(RecExtElectrode):
                 print('calculations finished, %s, %s' % (str(self),
                                                          str(self.cell)))
 
+        if key is not None:
+            self.mapping_cache.put(key, self.mapping)
+
     def calc_lfp(self, t_indices=None, cell=None):
         """Calculate LFP on electrode geometry from all cell instances.
         Will chose distributed calculated if electrode contain 'n', 'N', and 'r'
@@ -836,5 +1203,222 @@ class RecMEAElectrode(RecExtElectrode):
             currmem = self.cell.imem
 
         self._test_imem_sum()
-        self.LFP = np.dot(self.mapping, currmem)
+        self.LFP = self.mapping.dot(currmem)
         # del self.mapping
+
+
+class OctreeMapping(object):
+    """
+    Linear mapping of transmembrane currents I of segments to extracellular
+    potentials at electrode contacts in the factored form
+    near.dot(I) + far.dot(moments.dot(I)), as computed by
+    lfpcalc.calc_lfp_linesource_octree and
+    lfpcalc.calc_lfp_linesource_multipole_factored. Supports the subset of the
+    numpy.ndarray interface used for mappings: the attribute shape, the
+    methods dot and toarray, and slicing of columns (segments) as
+    mapping[:, start:stop].
+
+    Parameters
+    ----------
+    near : scipy.sparse.csr_matrix
+        shape (n_contacts, n_segs) mapping of nearby segments
+    far : scipy.sparse.csr_matrix
+        shape (n_contacts, n_moments) mapping from multipole moments of
+        clusters of segments to potential
+    moments : scipy.sparse.csr_matrix
+        shape (n_moments, n_segs) mapping from transmembrane currents to
+        multipole moments of clusters of segments
+    """
+    def __init__(self, near, far, moments):
+        """Initialize OctreeMapping object"""
+        self.near = near
+        self.far = far
+        self.moments = moments
+
+    @property
+    def shape(self):
+        return self.near.shape
+
+    def dot(self, currents):
+        """
+        Return extracellular potentials
+
+        Parameters
+        ----------
+        currents : np.ndarray
+            shape (n_segs, ) or (n_segs, n_timesteps) array of transmembrane
+            currents (nA)
+
+        Returns
+        -------
+        np.ndarray
+            shape (n_contacts, ) or (n_contacts, n_timesteps) array of
+            extracellular potentials (mV)
+        """
+        return self.near.dot(currents) + self.far.dot(
+            self.moments.dot(currents))
+
+    def toarray(self):
+        """Return mapping as shape (n_contacts, n_segs) np.ndarray"""
+        return self.near.toarray() + self.far.dot(self.moments).toarray()
+
+    def __getitem__(self, key):
+        rows, cols = key
+        return OctreeMapping(self.near[rows, cols], self.far[rows, :],
+                             self.moments[:, cols])
+
+
+# cell attributes used by the lfpcalc methods
+_cell_attrs = ['xstart', 'ystart', 'zstart', 'xmid', 'ymid', 'zmid',
+               'xend', 'yend', 'zend', 'diam', 'cellidx']
+
+
+def _calc_batch_parallel(lfp_method_batch, cell, x, y, z, sigma, r_limit,
+                         n_workers, n_average=1, **kwargs):
+    """Compute the mapping of positions x, y, z with lfp_method_batch in a
+    pool of n_workers processes, each handling blocks of positions, see
+    _MappingPool. The pool is created for this call only.
+
+    Parameters
+    ----------
+    lfp_method_batch : function
+        batched method of LFPy.lfpcalc
+    cell : obj
+        LFPy.Cell or LFPy.TemplateCell like instance
+    x, y, z : np.ndarray
+        extracellular positions
+    sigma : float or np.ndarray
+        extracellular conductivity
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    n_workers : int
+        number of processes
+    n_average : int
+        number of consecutive positions averaged into each row of the
+        mapping, see _MappingPool.calc
+    **kwargs
+        additional keyword arguments to lfp_method_batch
+
+    Returns
+    -------
+    mapping : np.ndarray
+        shape (n_positions // n_average, n_segs) array
+    """
+    pool = _MappingPool(lfp_method_batch, cell, sigma, r_limit, n_workers)
+    try:
+        return pool.calc(x, y, z, n_average=n_average, **kwargs)
+    finally:
+        pool.close()
+
+
+class _MappingPool(object):
+    """Pool of n_workers processes computing mappings of the geometry of
+    one cell with lfp_method_batch. The cell geometry and r_limit are
+    stored once in memory-mapped .npy files in a temporary directory, and
+    the processes are started once, such that both are reused by every
+    call to calc, e.g., for each block of contacts of
+    RecExtElectrode.calc_mapping. The positions of each call are stored in
+    the same directory, into which the processes also write their blocks
+    of the mapping, such that only file names and block bounds are passed
+    between processes. close must be called to stop the processes and
+    remove the directory.
+
+    Parameters
+    ----------
+    lfp_method_batch : function
+        batched method of LFPy.lfpcalc
+    cell : obj
+        LFPy.Cell or LFPy.TemplateCell like instance
+    sigma : float or np.ndarray
+        extracellular conductivity
+    r_limit : np.ndarray
+        minimum distance to source current for each compartment
+    n_workers : int
+        number of processes
+    """
+    def __init__(self, lfp_method_batch, cell, sigma, r_limit, n_workers):
+        """Initialize _MappingPool object"""
+        self.lfp_method_batch = lfp_method_batch
+        self.sigma = sigma
+        self.n_workers = n_workers
+        self.totnsegs = cell.totnsegs
+        self.dirname = tempfile.mkdtemp()
+        try:
+            arrays = dict([(attr, getattr(cell, attr))
+                           for attr in _cell_attrs
+                           if getattr(cell, attr, None) is not None])
+            arrays['r_limit'] = np.ones(cell.totnsegs) * r_limit
+            for name, array in arrays.items():
+                np.save(os.path.join(self.dirname, name + '.npy'), array)
+            self.names = sorted(arrays.keys()) + ['x', 'y', 'z']
+            self.pool = multiprocessing.Pool(n_workers)
+        except:
+            shutil.rmtree(self.dirname)
+            raise
+
+    def calc(self, x, y, z, n_average=1, **kwargs):
+        """Return shape (n_positions // n_average, n_segs) mapping of
+        positions x, y, z, where each process averages n_average
+        consecutive positions (e.g., the points of an n-point contact
+        average) per row of its blocks, so that only the averaged mapping
+        is stored. kwargs are passed to lfp_method_batch"""
+        for name, values in zip(['x', 'y', 'z'], [x, y, z]):
+            np.save(os.path.join(self.dirname, name + '.npy'),
+                    np.asarray(values, dtype=float).ravel())
+        n_rows = np.size(x) // n_average
+        mapping = np.lib.format.open_memmap(
+            os.path.join(self.dirname, 'mapping.npy'), mode='w+',
+            shape=(n_rows, self.totnsegs))
+        del mapping
+
+        # several blocks of rows per process balance the load
+        bounds = np.linspace(0, n_rows, min(4 * self.n_workers, n_rows) + 1
+                             ).astype(int)
+        tasks = [(self.lfp_method_batch, self.dirname, self.names,
+                  self.sigma, start, stop, n_average, kwargs)
+                 for start, stop in zip(bounds[:-1], bounds[1:])]
+        self.pool.map(_mapping_worker, tasks)
+        return np.load(os.path.join(self.dirname, 'mapping.npy'))
+
+    def close(self):
+        """Stop the processes and remove the temporary directory"""
+        try:
+            self.pool.close()
+            self.pool.join()
+        finally:
+            shutil.rmtree(self.dirname)
+
+
+def _mapping_worker(task):
+    """Compute one block of rows of the mapping in _MappingPool.calc,
+    averaging n_average consecutive positions per row in sub-blocks of rows
+    to bound the memory use"""
+    (lfp_method_batch, dirname, names, sigma, start, stop, n_average,
+     kwargs) = task
+    arrays = dict([(name, np.load(os.path.join(dirname, name + '.npy'),
+                                  mmap_mode='r')) for name in names])
+    cell = _MemmapCell(**dict([(attr, arrays[attr]) for attr in _cell_attrs
+                               if attr in arrays]))
+    mapping = np.load(os.path.join(dirname, 'mapping.npy'), mmap_mode='r+')
+    rows = max(1, 64 // n_average)
+    for i in range(start, stop, rows):
+        j = min(i + rows, stop)
+        points = slice(i * n_average, j * n_average)
+        lfp_e = lfp_method_batch(cell,
+                                 x = arrays['x'][points],
+                                 y = arrays['y'][points],
+                                 z = arrays['z'][points],
+                                 sigma = sigma,
+                                 r_limit = arrays['r_limit'],
+                                 **kwargs)
+        mapping[i:j] = lfp_e.reshape(j - i, n_average, -1).mean(axis=1)
+    mapping.flush()
+
+
+class _MemmapCell(object):
+    """Cell like object with the geometry of a cell as memory-mapped
+    arrays, used by _mapping_worker"""
+    def __init__(self, **geometry):
+        for attr, value in geometry.items():
+            setattr(self, attr, value)
+        self.totnsegs = self.xmid.size
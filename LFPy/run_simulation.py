@@ -18,6 +18,7 @@ from __future__ import division
 from time import time
 import numpy as np
 import neuron
+from .tools import StreamWriter
 
 
 def _run_simulation(cell, cvode, variable_dt=False, atol=0.001):
@@ -74,11 +75,20 @@ def _run_simulation_with_electrode(cell, cvode, electrode=None,
                                    atol=0.001,
                                    to_memory=True, to_file=False,
                                    file_name=None, dotprodcoeffs=None,
-                                   rec_current_dipole_moment=False):
+                                   rec_current_dipole_moment=False,
+                                   block_size=1,
+                                   file_chunk_size=1024, file_compression=None):
     '''
     Running the actual simulation in NEURON.
     electrode argument used to determine coefficient
     matrix, and calculate the LFP on every time step.
+
+    Transmembrane currents of block_size consecutive timesteps are buffered
+    and multiplied with the coefficient matrices as one matrix-matrix product.
+
+    If to_file is True, the results are streamed to the HDF5 file file_name
+    in chunks of file_chunk_size timesteps, optionally compressed using
+    the HDF5 filter file_compression (e.g., 'gzip' or 'lzf').
     '''
     try:
         import h5py
@@ -149,25 +159,39 @@ def _run_simulation_with_electrode(cell, cvode, electrode=None,
     else:
         interval = 100. / cell.dt
     
-    #temp vector to store membrane currents at each timestep
-    imem = np.zeros(cell.totnsegs)
+    #number of timesteps for which LFPs etc. are computed
+    ntsteps = int(cell.tstop / cell.dt) + 1
+
+    #temp vector to store membrane currents at each timestep, filled in by
+    #gathering from pointers to i_membrane_ of every segment
+    imem_ptrvec, imem_vec = _get_segment_ptrvector([cell], '_ref_i_membrane_')
+    imem = imem_vec.as_numpy()
+    #membrane currents of block_size consecutive timesteps are buffered here,
+    #so that each mapping can be applied to all of them using a single
+    #matrix-matrix product
+    imem_block = np.zeros((cell.totnsegs, block_size))
+    k = 0
+    
     #LFPs for each electrode will be put here during simulation
     if to_memory:
         electrodesLFP = []
         for coeffs in dotprodcoeffs:
-            electrodesLFP.append(np.zeros((coeffs.shape[0],
-                                int(cell.tstop / cell.dt) + 1)))
+            electrodesLFP.append(np.zeros((coeffs.shape[0], ntsteps)))
     #LFPs for each electrode will be put here during simulations
     if to_file:
-        #ensure right ending:
-        if file_name.split('.')[-1] != 'h5':
-            file_name += '.h5'
-        el_LFP_file = h5py.File(file_name, 'w')
-        i = 0
-        for coeffs in dotprodcoeffs:
-            el_LFP_file['electrode{:03d}'.format(i)] = np.zeros((coeffs.shape[0],
-                                    int(cell.tstop / cell.dt + 1)))
-            i += 1
+        el_LFP_file = StreamWriter(file_name, ntsteps, cell.dt,
+                                   chunk_size=file_chunk_size,
+                                   compression=file_compression)
+        for i, coeffs in enumerate(dotprodcoeffs):
+            #store contact locations etc. of electrode objects as metadata
+            attrs = dict()
+            if i >= lendotprodcoeffs0:
+                el = electrodes[i-lendotprodcoeffs0]
+                attrs.update(x=el.x, y=el.y, z=el.z, method=el.method)
+                if el.sigma is not None:
+                    attrs.update(sigma=el.sigma)
+            el_LFP_file.create_dataset('electrode{:03d}'.format(i),
+                                       coeffs.shape[0], **attrs)
 
     # create a 2D array representation of segment midpoints for dot product
     # with transmembrane currents when computing dipole moment
@@ -175,28 +199,33 @@ def _run_simulation_with_electrode(cell, cvode, electrode=None,
         midpoints = np.c_[cell.xmid, cell.ymid, cell.zmid]
 
     
-    #run fadvance until time limit, and calculate LFPs for each timestep
-    while neuron.h.t < cell.tstop:
-        if neuron.h.t >= 0:
-            i = 0
-            for sec in cell.allseclist:
-                for seg in sec:
-                    imem[i] = seg.i_membrane_
-                    i += 1
+    #run fadvance until time limit, and calculate LFPs for each timestep,
+    #including the timestep after the final fadvance()
+    while True:
+        if neuron.h.t >= 0 and tstep < ntsteps:
+            imem_ptrvec.gather(imem_vec)
+            imem_block[:, k] = imem
+            k += 1
+            tstep += 1
 
+        final = neuron.h.t >= cell.tstop
+        
+        #compute LFPs etc. for all buffered timesteps
+        if k == block_size or (final and k > 0):
             if rec_current_dipole_moment:
-                cell.current_dipole_moment[tstep, ] = np.dot(imem, midpoints)
-            
-            if to_memory:
-                for j, coeffs in enumerate(dotprodcoeffs):
-                    electrodesLFP[j][:, tstep] = np.dot(coeffs, imem)
-                    
-            if to_file:
-                for j, coeffs in enumerate(dotprodcoeffs):
-                    el_LFP_file['electrode{:03d}'.format(j)
-                                ][:, tstep] = np.dot(coeffs, imem)
-            
-            tstep += 1
+                cell.current_dipole_moment[tstep-k:tstep, ] = np.dot(
+                    imem_block[:, :k].T, midpoints)
+
+            for j, coeffs in enumerate(dotprodcoeffs):
+                LFP = coeffs.dot(imem_block[:, :k])
+                if to_memory:
+                    electrodesLFP[j][:, tstep-k:tstep] = LFP
+                if to_file:
+                    el_LFP_file.write('electrode{:03d}'.format(j), LFP)
+            k = 0
+        
+        if final:
+            break
 
         neuron.h.fadvance()
         counter += 1.
@@ -208,28 +237,6 @@ def _run_simulation_with_electrode(cell, cvode, electrode=None,
             t0 = time()
             ti = neuron.h.t
     
-    try:
-        #calculate LFP after final fadvance()
-        i = 0
-        for sec in cell.allseclist:
-            for seg in sec:
-                imem[i] = seg.i_membrane_
-                i += 1
-
-        if rec_current_dipole_moment:
-            cell.current_dipole_moment[tstep, ] = np.dot(imem, midpoints)
-            
-        if to_memory:
-            for j, coeffs in enumerate(dotprodcoeffs):
-                electrodesLFP[j][:, tstep] = np.dot(coeffs, imem)
-        if to_file:
-            for j, coeffs in enumerate(dotprodcoeffs):
-                el_LFP_file['electrode{:03d}'.format(j)
-                            ][:, tstep] = np.dot(coeffs, imem)
-
-    except:
-        pass
-    
     # Final step, put LFPs in the electrode object, superimpose if necessary
     # If electrode.perCellLFP, store individual LFPs
     if to_memory:
@@ -254,6 +261,44 @@ def _run_simulation_with_electrode(cell, cvode, electrode=None,
         el_LFP_file.close()
 
 
+def _get_segment_ptrvector(cells, ref='_ref_i_membrane_'):
+    '''Bind pointers to the variable ref of every segment of every cell
+    object in cells to a NEURON PtrVector, so that the values for all segments
+    can be copied into a NEURON Vector by a single call to PtrVector.gather()
+    on each timestep rather than by iterating over segments in Python.
+
+    Pointers may be invalidated by changes to the model structure, so this
+    function must be called after neuron.h.finitialize().
+
+    Parameters
+    ----------
+    cells : list
+        list of LFPy.Cell like objects
+    ref : str
+        name of segment pointer attribute, e.g., '_ref_i_membrane_'
+
+    Returns
+    -------
+    ptrvec : neuron.h.PtrVector
+        pointers to the variable ref of all segments
+    vec : neuron.h.Vector
+        vector of length equal to the total number of segments which
+        values are filled in using ptrvec.gather(vec)
+    '''
+    totnsegs = 0
+    for cell in cells:
+        totnsegs += cell.totnsegs
+    ptrvec = neuron.h.PtrVector(totnsegs)
+    i = 0
+    for cell in cells:
+        for sec in cell.allseclist:
+            for seg in sec:
+                ptrvec.pset(i, getattr(seg, ref))
+                i += 1
+    vec = neuron.h.Vector(totnsegs)
+    return ptrvec, vec
+
+
 def _collect_geometry_neuron(cell):
     '''Loop over allseclist to determine area, diam, xyz-start- and
     endpoints, embed geometry to cell object'''
@@ -19,6 +19,7 @@ from time import time
 import numpy as np
 cimport numpy as np
 import neuron
+from .tools import StreamWriter
 
 DTYPE = np.float64
 ctypedef np.float64_t DTYPE_t
@@ -82,15 +83,24 @@ def _run_simulation_with_electrode(cell, cvode, electrode=None,
                                    variable_dt=False, atol=0.001,
                                    to_memory=True, to_file=False,
                                    file_name=None, dotprodcoeffs=None,
-                                   rec_current_dipole_moment=False):
+                                   rec_current_dipole_moment=False,
+                                   int block_size=1,
+                                   file_chunk_size=1024, file_compression=None):
     """
     Running the actual simulation in NEURON.
     electrode argument used to determine coefficient
     matrix, and calculate the LFP on every time step.
+
+    Transmembrane currents of block_size consecutive timesteps are buffered
+    and multiplied with the coefficient matrices as one matrix-matrix product.
+
+    If to_file is True, the results are streamed to the HDF5 file file_name
+    in chunks of file_chunk_size timesteps, optionally compressed using
+    the HDF5 filter file_compression (e.g., 'gzip' or 'lzf').
     """
     
     #c-declare some variables
-    cdef int i, j, tstep#, ncoeffs
+    cdef int i, j, k, tstep, ntsteps#, ncoeffs
     #cdef int totnsegs = cell.totnsegs
     cdef double tstop = cell.tstop
     cdef int counter
@@ -100,9 +110,9 @@ def _run_simulation_with_electrode(cell, cvode, electrode=None,
     cdef double ti
     cdef double rtfactor
     cdef double dt = cell.dt
-    cdef np.ndarray[DTYPE_t, ndim=2, negative_indices=False] coeffs
     cdef np.ndarray[DTYPE_t, ndim=2, negative_indices=False] current_dipole_moment
     cdef np.ndarray[DTYPE_t, ndim=2, negative_indices=False] midpoints
+    cdef np.ndarray[DTYPE_t, ndim=2, negative_indices=False] imem_block
     
     #check if h5py exist and saving is possible
     try:
@@ -174,25 +184,39 @@ def _run_simulation_with_electrode(cell, cvode, electrode=None,
     else:
         interval = 100. / dt
         
-    #temp vector to store membrane currents at each timestep
-    imem = np.zeros(cell.totnsegs)
+    #number of timesteps for which LFPs etc. are computed
+    ntsteps = int(tstop / dt + 1)
+
+    #temp vector to store membrane currents at each timestep, filled in by
+    #gathering from pointers to i_membrane_ of every segment
+    imem_ptrvec, imem_vec = _get_segment_ptrvector([cell], '_ref_i_membrane_')
+    imem = imem_vec.as_numpy()
+    #membrane currents of block_size consecutive timesteps are buffered here,
+    #so that each mapping can be applied to all of them using a single
+    #matrix-matrix product
+    imem_block = np.zeros((cell.totnsegs, block_size))
+    k = 0
+
     #LFPs for each electrode will be put here during simulation
     if to_memory:
         electrodesLFP = []
         for coeffs in dotprodcoeffs:
-            electrodesLFP.append(np.zeros((coeffs.shape[0],
-                                    int(tstop / dt + 1))))
+            electrodesLFP.append(np.zeros((coeffs.shape[0], ntsteps)))
     #LFPs for each electrode will be put here during simulations
     if to_file:
-        #ensure right ending:
-        if file_name.split('.')[-1] != 'h5':
-            file_name += '.h5'
-        el_LFP_file = h5py.File(file_name, 'w')
-        i = 0
-        for coeffs in dotprodcoeffs:
-            el_LFP_file['electrode{:03d}'.format(i)] = np.zeros((coeffs.shape[0],
-                                            int(tstop / dt + 1)))
-            i += 1
+        el_LFP_file = StreamWriter(file_name, ntsteps, cell.dt,
+                                   chunk_size=file_chunk_size,
+                                   compression=file_compression)
+        for i, coeffs in enumerate(dotprodcoeffs):
+            #store contact locations etc. of electrode objects as metadata
+            attrs = dict()
+            if i >= lendotprodcoeffs0:
+                el = electrodes[i-lendotprodcoeffs0]
+                attrs.update(x=el.x, y=el.y, z=el.z, method=el.method)
+                if el.sigma is not None:
+                    attrs.update(sigma=el.sigma)
+            el_LFP_file.create_dataset('electrode{:03d}'.format(i),
+                                       coeffs.shape[0], **attrs)
 
     # create a 2D array representation of segment midpoints for dot product
     # with transmembrane currents when computing dipole moment
@@ -201,28 +225,34 @@ def _run_simulation_with_electrode(cell, cvode, electrode=None,
         cell.current_dipole_moment = np.array([[]])
         midpoints = np.c_[cell.xmid, cell.ymid, cell.zmid]
         
-    #run fadvance until time limit, and calculate LFPs for each timestep
-    while neuron.h.t < tstop:
-        if neuron.h.t >= 0:
-            i = 0
-            for sec in cell.allseclist:
-                for seg in sec:
-                    imem[i] = seg.i_membrane_
-                    i += 1
+    #run fadvance until time limit, and calculate LFPs for each timestep,
+    #including the timestep after the final fadvance()
+    while True:
+        if neuron.h.t >= 0 and tstep < ntsteps:
+            imem_ptrvec.gather(imem_vec)
+            imem_block[:, k] = imem
+            k += 1
+            tstep += 1
 
+        final = neuron.h.t >= tstop
+
+        #compute LFPs etc. for all buffered timesteps
+        if k == block_size or (final and k > 0):
             if rec_current_dipole_moment:
-                current_dipole_moment[tstep, ] = np.dot(imem, midpoints)
+                current_dipole_moment[tstep-k:tstep, ] = np.dot(
+                    imem_block[:, :k].T, midpoints)
+
+            for j, coeffs in enumerate(dotprodcoeffs):
+                LFP = coeffs.dot(imem_block[:, :k])
+                if to_memory:
+                    electrodesLFP[j][:, tstep-k:tstep] = LFP
+                if to_file:
+                    el_LFP_file.write('electrode{:03d}'.format(j), LFP)
+            k = 0
 
-            if to_memory:
-                for j, coeffs in enumerate(dotprodcoeffs):
-                    electrodesLFP[j][:, tstep] = np.dot(coeffs, imem)
-                    
-            if to_file:
-                for j, coeffs in enumerate(dotprodcoeffs):
-                    el_LFP_file['electrode{:03d}'.format(j)
-                                ][:, tstep] = np.dot(coeffs, imem)
+        if final:
+            break
 
-            tstep += 1
         neuron.h.fadvance()
         counter += 1
         if counter % interval == 0:
@@ -233,28 +263,6 @@ def _run_simulation_with_electrode(cell, cvode, electrode=None,
             t0 = time()
             ti = neuron.h.t
     
-    try:
-        #calculate LFP after final fadvance()
-        i = 0
-        for sec in cell.allseclist:
-            for seg in sec:
-                imem[i] = seg.i_membrane_
-                i += 1
-
-        if rec_current_dipole_moment:
-            current_dipole_moment[tstep, ] = np.dot(imem, midpoints)
-
-        if to_memory:
-            for j, coeffs in enumerate(dotprodcoeffs):
-                electrodesLFP[j][:, tstep] = np.dot(coeffs, imem)
-        if to_file:
-            for j, coeffs in enumerate(dotprodcoeffs):
-                el_LFP_file['electrode{:03d}'.format(j)
-                            ][:, tstep] = np.dot(coeffs, imem)
-
-    except:
-        pass
-    
     # update current dipole moment values
     if rec_current_dipole_moment:
         cell.current_dipole_moment = current_dipole_moment
@@ -283,6 +291,44 @@ def _run_simulation_with_electrode(cell, cvode, electrode=None,
         el_LFP_file.close()
 
 
+def _get_segment_ptrvector(cells, ref='_ref_i_membrane_'):
+    """Bind pointers to the variable ref of every segment of every cell
+    object in cells to a NEURON PtrVector, so that the values for all segments
+    can be copied into a NEURON Vector by a single call to PtrVector.gather()
+    on each timestep rather than by iterating over segments in Python.
+
+    Pointers may be invalidated by changes to the model structure, so this
+    function must be called after neuron.h.finitialize().
+
+    Parameters
+    ----------
+    cells : list
+        list of LFPy.Cell like objects
+    ref : str
+        name of segment pointer attribute, e.g., '_ref_i_membrane_'
+
+    Returns
+    -------
+    ptrvec : neuron.h.PtrVector
+        pointers to the variable ref of all segments
+    vec : neuron.h.Vector
+        vector of length equal to the total number of segments which
+        values are filled in using ptrvec.gather(vec)
+    """
+    totnsegs = 0
+    for cell in cells:
+        totnsegs += cell.totnsegs
+    ptrvec = neuron.h.PtrVector(totnsegs)
+    i = 0
+    for cell in cells:
+        for sec in cell.allseclist:
+            for seg in sec:
+                ptrvec.pset(i, getattr(seg, ref))
+                i += 1
+    vec = neuron.h.Vector(totnsegs)
+    return ptrvec, vec
+
+
 cpdef _collect_geometry_neuron(cell):
     """Loop over allseclist to determine area, diam, xyz-start- and
     endpoints, embed geometry to cell object"""
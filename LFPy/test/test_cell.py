@@ -622,6 +622,37 @@ class testCell(unittest.TestCase):
                                                          dtype=object))
 
 
+    def test_cell_get_idx_name_01(self):
+        cell = LFPy.Cell(morphology=os.path.join(LFPy.__path__[0], 'test',
+                                                  'ball_and_sticks.hoc' ))
+        names = cell.get_idx_name(idx=np.arange(cell.totnsegs))
+        self.assertEqual(names.shape, (cell.totnsegs, 3))
+        np.testing.assert_equal(names[:, 0].astype(int),
+                                np.arange(cell.totnsegs))
+        for idx in cell.get_idx('dend'):
+            self.assertTrue('dend' in cell.get_idx_name(idx)[1])
+        self.assertEqual(cell.get_idx_name(2)[0], 2)
+
+
+    def test_cell_get_segment_index_00(self):
+        cell = LFPy.Cell(morphology=os.path.join(LFPy.__path__[0], 'test',
+                                                  'ball_and_sticks.hoc' ))
+        index = cell._get_segment_index()
+        self.assertTrue(cell._get_segment_index() is index)
+        self.assertEqual(index['x'].size, cell.totnsegs)
+        np.testing.assert_equal(index['secname'], cell.allsecnames)
+        for i, (sec, (start, stop)) in enumerate(zip(index['sec'],
+                                                     index['sec_range'])):
+            self.assertEqual(stop - start, sec.nseg)
+            np.testing.assert_equal(index['sec_idx'][start:stop], i)
+            np.testing.assert_equal(index['x'][start:stop],
+                                    [seg.x for seg in sec])
+        np.testing.assert_equal(index['sec_range'][1:, 0],
+                                index['sec_range'][:-1, 1])
+        cell.strip_hoc_objects()
+        self.assertTrue(cell._segment_index is None)
+
+
     def test_cell_get_rand_idx_area_norm_00(self):
         cell = LFPy.Cell(morphology=os.path.join(LFPy.__path__[0], 'test',
                                                   'ball_and_sticks.hoc' ))
@@ -641,6 +672,28 @@ class testCell(unittest.TestCase):
         self.assertEqual(idx.max(), cell.totnsegs-1)
 
 
+    def test_cell_get_rand_idx_area_and_distribution_prob_00(self):
+        import scipy.stats as ss
+        cell = LFPy.Cell(morphology=os.path.join(LFPy.__path__[0], 'test',
+                                                  'ball_and_sticks.hoc' ))
+        poss_idx, p = cell.get_rand_idx_area_and_distribution_prob(
+            section='allsec', fun=ss.norm, funargs=dict(loc=0, scale=100))
+        np.testing.assert_equal(poss_idx, np.arange(cell.totnsegs))
+        self.assertAlmostEqual(p.sum(), 1.)
+        p_ref = cell.area * ss.norm(loc=0, scale=100).pdf(cell.zmid)
+        np.testing.assert_allclose(p, p_ref / p_ref.sum())
+
+        poss_idx, p = cell.get_rand_idx_area_and_distribution_prob(
+            section='soma', fun=ss.norm, funargs=dict(loc=0, scale=100))
+        np.testing.assert_equal(poss_idx, cell.get_idx('soma'))
+        np.testing.assert_equal(p, np.ones(poss_idx.size) / poss_idx.size)
+
+        poss_idx, p = cell.get_rand_idx_area_and_distribution_prob(
+            section='foo')
+        self.assertEqual(poss_idx.size, 0)
+        self.assertEqual(p.size, 0)
+
+
     def test_cell_set_synapse_00(self):
         cell = LFPy.Cell(morphology=os.path.join(LFPy.__path__[0], 'test',
                                                   'ball_and_sticks.hoc' ))
@@ -1098,6 +1151,116 @@ class testCell(unittest.TestCase):
         np.testing.assert_allclose(electrode.LFP, electrode1.LFP)
 
 
+    def test_cell_simulate_block_size_00(self):
+        stickParams = {
+            'morphology' : os.path.join(LFPy.__path__[0], 'test', 'stick.hoc'),
+            'cm' : 1,
+            'Ra' : 150,
+            'v_init' : -65,
+            'passive' : True,
+            'passive_parameters' : {'g_pas' : 1./30000, 'e_pas' : -65},
+            'tstart' : -100,
+            'tstop' : 100,
+            'dt' : 2**-4,
+            'nsegs_method' : 'lambda_f',
+            'lambda_f' : 100,
+
+        }
+
+        electrodeParams = {
+            'sigma' : 0.3,
+            'x' : np.ones(11) * 100.,
+            'y' : np.zeros(11),
+            'z' : np.linspace(1000, 0, 11),
+            'method' : 'linesource'
+        }
+
+        stimParams = {
+            'pptype' : 'SinSyn',
+            'delay' : -100.,
+            'dur' : 1000.,
+            'pkamp' : 1.,
+            'freq' : 100.,
+            'phase' : 0,
+            'bias' : 0.,
+            'record_current' : False
+        }
+
+        LFPs = []
+        Ps = []
+        for block_size in [1, 7, 10000]:
+            stick = LFPy.Cell(**stickParams)
+            synapse = LFPy.StimIntElectrode(stick,
+                                            stick.get_closest_idx(0, 0, 1000),
+                                            **stimParams)
+            electrode = LFPy.RecExtElectrode(**electrodeParams)
+            stick.simulate(electrode, rec_imem=True,
+                           rec_current_dipole_moment=True,
+                           block_size=block_size)
+            LFPs.append(electrode.LFP)
+            Ps.append(stick.current_dipole_moment)
+
+            np.testing.assert_allclose(electrode.LFP,
+                                       np.dot(electrode.mapping, stick.imem))
+
+        for LFP, P in zip(LFPs[1:], Ps[1:]):
+            np.testing.assert_allclose(LFP, LFPs[0])
+            np.testing.assert_allclose(P, Ps[0])
+
+
+    def test_cell_simulate_to_file_00(self):
+        import h5py
+        stickParams = {
+            'morphology' : os.path.join(LFPy.__path__[0], 'test', 'stick.hoc'),
+            'cm' : 1,
+            'Ra' : 150,
+            'v_init' : -65,
+            'passive' : True,
+            'passive_parameters' : {'g_pas' : 1./30000, 'e_pas' : -65},
+            'tstart' : 0,
+            'tstop' : 100,
+            'dt' : 2**-4,
+            'nsegs_method' : 'lambda_f',
+            'lambda_f' : 100,
+
+        }
+
+        electrodeParams = {
+            'sigma' : 0.3,
+            'x' : np.ones(11) * 100.,
+            'y' : np.zeros(11),
+            'z' : np.linspace(1000, 0, 11),
+            'method' : 'pointsource'
+        }
+
+        stimParams = {
+            'pptype' : 'SinSyn',
+            'delay' : 0.,
+            'dur' : 1000.,
+            'pkamp' : 1.,
+            'freq' : 100.,
+            'phase' : 0,
+            'bias' : 0.,
+            'record_current' : False
+        }
+
+        stick = LFPy.Cell(**stickParams)
+        synapse = LFPy.StimIntElectrode(stick, stick.get_closest_idx(0, 0, 1000),
+                               **stimParams)
+        electrode = LFPy.RecExtElectrode(**electrodeParams)
+        stick.simulate(electrode, rec_imem=True, to_memory=True, to_file=True,
+                       file_name='test_cell_simulate_to_file',
+                       block_size=10, file_chunk_size=128,
+                       file_compression='gzip')
+
+        f = h5py.File('test_cell_simulate_to_file.h5', 'r')
+        np.testing.assert_allclose(f['electrode000'][()], electrode.LFP)
+        np.testing.assert_allclose(f['t'][()], stick.tvec)
+        np.testing.assert_equal(f['electrode000'].attrs['z'], electrode.z)
+        f.close()
+        os.remove('test_cell_simulate_to_file.h5')
+
+
     ######## Functions used by tests: ##########################################
 def stickSimulationTesttvec(**kwargs):
     stick = LFPy.Cell(morphology = os.path.join(LFPy.__path__[0], 'test',
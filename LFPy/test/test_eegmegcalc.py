@@ -133,6 +133,33 @@ class testMEG(unittest.TestCase):
         meg = LFPy.MEG(sensor_locations)
         np.testing.assert_equal(gt, meg.calculate_H(current_dipole_moment,
                                                     dipole_location))
+
+
+    def test_MEG_06(self):
+        '''test LFPy.MEG.calculate_H_multi()'''
+        current_dipole_moments = np.random.randn(5, 21, 3)
+        dipole_locations = np.random.randn(5, 3) * 100
+        sensor_locations = np.random.randn(4, 3) * 1000
+
+        meg = LFPy.MEG(sensor_locations)
+        gt = np.array([meg.calculate_H(p, location) for p, location in
+                       zip(current_dipole_moments, dipole_locations)])
+        gt = gt.transpose(1, 0, 2, 3)
+
+        kernel = meg.get_kernel(dipole_locations)
+        self.assertEqual(kernel.shape, (4, 5, 3))
+        for chunk_size in [None, 1, 8]:
+            H = meg.calculate_H_multi(current_dipole_moments,
+                                      dipole_locations, chunk_size=chunk_size)
+            np.testing.assert_allclose(H, gt.sum(axis=1), rtol=1E-10)
+            H = meg.calculate_H_multi(current_dipole_moments, kernel=kernel,
+                                      summed=False, chunk_size=chunk_size)
+            np.testing.assert_allclose(H, gt, rtol=1E-10)
+
+        np.testing.assert_raises(AssertionError, meg.calculate_H_multi,
+                                 current_dipole_moments[0], dipole_locations)
+        np.testing.assert_raises(AssertionError, meg.get_kernel,
+                                 sensor_locations)
         
         
 class testFourSphereVolumeConductor(unittest.TestCase):
@@ -184,6 +211,114 @@ class testFourSphereVolumeConductor(unittest.TestCase):
         s_vector = fs._sign_rad_dipole(P1)
         np.testing.assert_almost_equal(s_vector, np.array([1., -1.]))
 
+    def test_legendre(self):
+        '''Test Legendre functions computed with recurrences'''
+        from scipy.special import eval_legendre, lpmv
+        x = np.linspace(-1, 1, 21)
+        P, P1 = LFPy.eegmegcalc._legendre(50, x)
+        for n in range(1, 51):
+            np.testing.assert_allclose(P[n - 1], eval_legendre(n, x),
+                                       atol=1E-12)
+            np.testing.assert_allclose(P1[n - 1], lpmv(1, n, x),
+                                       rtol=1E-10, atol=1E-10 * n**2)
+
+    def test_series_terms(self):
+        '''Test series sums against term-wise evaluation in each shell'''
+        from scipy.special import lpmv
+        rz1 = np.array([0., 0., 70.])
+        r_el = np.array([[0., 30., 72.], [0., 79.5, 5.], [10., 0., 84.],
+                         [0., -50., 70.], [0., 0., 60.], [0., 0., 95.]])
+        fs = make_class_object(rz1, r_el)
+        n = np.arange(1, 100)
+        theta = fs.calc_theta()
+        c2n = fs._calc_c2n(n)
+        c3n = fs._calc_c3n(n)
+        c4n = fs._calc_c4n(n)
+        shells = [(fs._calc_c1n(n), np.ones(n.size), fs.r1, fs.rz),
+                  (c2n, fs._calc_d2n(n, c2n), fs.r2, fs.r2),
+                  (c3n, fs._calc_d3n(n, c3n), fs.r3, fs.r3),
+                  (c4n, fs._calc_d4n(n, c4n), fs.r4, fs.r4)]
+        for i, (c, d, r_i, r_j) in enumerate(shells):
+            consts = c * (fs.r[i] / r_i)**n + d * (r_j / fs.r[i])**(n + 1)
+            rad = np.sum(n * consts * [lpmv(0, k, np.cos(theta[i]))
+                                       for k in n])
+            tan = np.sum(consts * [lpmv(1, k, np.cos(theta[i])) for k in n])
+            np.testing.assert_allclose(fs._rad_terms[i], rad, rtol=1E-10)
+            np.testing.assert_allclose(fs._tan_terms[i], tan, rtol=1E-10)
+        self.assertTrue(np.isnan(fs._rad_terms[4]))
+        self.assertTrue(np.isnan(fs._tan_terms[4]))
+        self.assertEqual(fs._rad_terms[5], 0.)
+        self.assertEqual(fs._tan_terms[5], 0.)
+
+    def test_truncation(self):
+        '''Test tolerance-driven truncation of the series'''
+        radii = [79000., 80000., 85000., 90000.]
+        sigmas = [0.3, 1.5, 0.015, 0.3]
+        r = np.array([[0., 0., 90000.], [0., 85000., 0.], [0., 0., 78500.],
+                      [0., 0., 70000.]])
+        rz = np.array([0., 0., 78000.])
+        p = np.array([[10., 10., 10.], [-10., 0., 5.], [0., 0., 1.]])
+        reference = LFPy.FourSphereVolumeConductor(radii, sigmas, r, rz,
+                                                   tolerance=1E-14,
+                                                   max_terms=6000)
+        fs = LFPy.FourSphereVolumeConductor(radii, sigmas, r, rz,
+                                            tolerance=1E-6, max_terms=6000)
+        # many terms close to the dipole, few on the scalp for moderate
+        # tolerances
+        self.assertTrue(fs.n_terms[2] > 1000)
+        self.assertTrue(LFPy.FourSphereVolumeConductor(
+            radii, sigmas, r, rz, tolerance=1E-3).n_terms[0] < 99)
+        phi = fs.calc_potential(p)
+        phi_ref = reference.calc_potential(p)
+        error = abs(phi - phi_ref).max(axis=1)
+        bound = fs.truncation_error * 2 * np.linalg.norm(p, axis=1).max()
+        self.assertTrue(np.all(error[:3] <= bound[:3]))
+        self.assertTrue(np.all(error[:3] <= 1E-5 * abs(phi_ref).max()))
+        self.assertTrue(np.isnan(fs.truncation_error[3]))
+        np.testing.assert_equal(phi.mask, phi_ref.mask)
+
+        # the default 99 terms are not sufficient close to the dipole
+        fs = LFPy.FourSphereVolumeConductor(radii, sigmas, r, rz)
+        self.assertTrue(fs.truncation_error is None)
+        np.testing.assert_equal(fs.n_terms[:3], 99)
+        error_99 = abs(fs.calc_potential(p) - phi_ref).max(axis=1)
+        self.assertTrue(error_99[2] > 100 * error[2])
+
+    def test_calc_potential_chunks(self):
+        '''Test that potentials computed in chunks of timesteps are equal'''
+        rz1 = np.array([0., 0., 70.])
+        r_el = np.array([[0., 0., 90.], [0., 50., 70.], [0., 0., 60.]])
+        fs = make_class_object(rz1, r_el)
+        p = np.random.randn(101, 3)
+        p[:5] = 0.
+        p[5:10, :2] = 0.
+        phi = fs.calc_potential(p)
+        for chunk_size in [1, 10, 1000]:
+            phi_chunks = fs.calc_potential(p, chunk_size=chunk_size)
+            np.testing.assert_allclose(phi_chunks, phi, rtol=1E-12)
+            np.testing.assert_equal(phi_chunks.mask, phi.mask)
+
+    def test_lead_field(self):
+        '''Test lead field of many dipole locations against calc_potential'''
+        r_el = np.array([[0., 0., 90.], [0., 50., 70.], [30., -30., 75.],
+                         [0., 0., 60.], [0., 0., 95.]])
+        locations = np.array([[0., 0., 70.], [10., 0., 65.], [0., -5., 50.],
+                              [30., 30., 40.]])
+        fs = make_class_object(locations[0], r_el)
+        p = np.random.randn(4, 11, 3)
+        for block_size in [None, 1, 3]:
+            lead_field = fs.calc_lead_field(locations, block_size=block_size)
+            self.assertEqual(lead_field.shape, (5, 4, 3))
+            for i, location in enumerate(locations):
+                phi = make_class_object(location, r_el).calc_potential(p[i])
+                np.testing.assert_allclose(np.dot(lead_field[:, i], p[i].T),
+                                           phi.filled(np.nan), rtol=1E-9,
+                                           atol=1E-12 * abs(phi).max())
+        # contacts closer to the center than the dipole
+        self.assertTrue(np.all(np.isnan(lead_field[3, [0, 1]])))
+        self.assertFalse(np.any(np.isnan(lead_field[3, [2, 3]])))
+        np.testing.assert_equal(lead_field[4], 0.)
+
 
 class testInfiniteVolumeConductor(unittest.TestCase):
     """
@@ -507,6 +507,196 @@ class testLfpCalc(unittest.TestCase):
                                 r_limit=cell.diam/2))
 
 
+    def test_calc_lfp_batch(self):
+        """Test that batched functions reproduce the single-position
+        functions for all positions"""
+        cell = RandomTestCell()
+        # random positions, and positions at segment midpoints
+        x = np.r_[np.random.randn(50) * 50, cell.xmid[:10]]
+        y = np.r_[np.random.randn(50) * 50, cell.ymid[:10]]
+        z = np.r_[np.random.randn(50) * 50, cell.zmid[:10]]
+        for method in ['linesource', 'soma_as_point', 'pointsource']:
+            single = getattr(lfpcalc, 'calc_lfp_' + method)
+            batch = getattr(lfpcalc, 'calc_lfp_{}_batch'.format(method))
+            mapping = np.array([single(cell, x=x[i], y=y[i], z=z[i],
+                                       sigma=0.3, r_limit=cell.diam/2)
+                                for i in range(x.size)])
+            for contact_block_size in [1, 7, 64]:
+                np.testing.assert_allclose(mapping,
+                    batch(cell, x=x, y=y, z=z, sigma=0.3,
+                          r_limit=cell.diam/2,
+                          contact_block_size=contact_block_size),
+                    rtol=1E-10)
+
+    def test_calc_lfp_anisotropic_batch(self):
+        """Test that anisotropic batched functions reproduce the
+        single-position functions for all positions, including positions
+        within r_limit of segments"""
+        cell = RandomTestCell()
+        sigma = [0.3, 0.2, 0.45]
+        # random positions, and positions at and close to segment midpoints
+        x = np.r_[np.random.randn(50) * 50, cell.xmid[:10], cell.xmid[:10] + .1]
+        y = np.r_[np.random.randn(50) * 50, cell.ymid[:10], cell.ymid[:10]]
+        z = np.r_[np.random.randn(50) * 50, cell.zmid[:10], cell.zmid[:10]]
+        for method in ['linesource', 'soma_as_point', 'pointsource']:
+            single = getattr(lfpcalc, 'calc_lfp_{}_anisotropic'.format(method))
+            batch = getattr(lfpcalc,
+                            'calc_lfp_{}_anisotropic_batch'.format(method))
+            mapping = np.array([single(cell, x=x[i], y=y[i], z=z[i],
+                                       sigma=sigma, r_limit=cell.diam/2)
+                                for i in range(x.size)])
+            for contact_block_size in [1, 7, 64]:
+                np.testing.assert_allclose(mapping,
+                    batch(cell, x=x, y=y, z=z, sigma=sigma,
+                          r_limit=cell.diam/2,
+                          contact_block_size=contact_block_size),
+                    rtol=1E-10)
+            # no positions
+            self.assertEqual(batch(cell, x=x[:0], y=y[:0], z=z[:0],
+                                   sigma=sigma, r_limit=cell.diam/2).shape,
+                             (0, cell.totnsegs))
+
+    def test_calc_lfp_linesource_anisotropic_too_close(self):
+        """Test that positions within r_limit of a segment are displaced
+        to r_limit from the segment"""
+        cell = TestCell()
+        sigma = [0.3, 0.3, 0.3]
+        r_limit = np.array([0.5])
+        # on the segment, and inside of r_limit
+        for y in [0., 0.2]:
+            np.testing.assert_allclose(
+                lfpcalc.calc_lfp_linesource_anisotropic(cell, x=0.5, y=y, z=0,
+                    sigma=sigma, r_limit=r_limit),
+                lfpcalc.calc_lfp_linesource_anisotropic(cell, x=0.5, y=0.5,
+                    z=0, sigma=sigma, r_limit=r_limit))
+
+    def test_calc_lfp_moi_batch(self):
+        """Test that batched MoI functions reproduce the single-position
+        functions, and that the image series with tolerance and acceleration
+        converges to the series with many terms"""
+        cell = RandomTestCell()
+        # confine cell to slice
+        for attr in ['zstart', 'zend']:
+            setattr(cell, attr, np.abs(getattr(cell, attr)) + 5)
+        cell.zmid = (cell.zstart + cell.zend) / 2
+        h = cell.zend.max() + 50
+        x = np.random.randn(20) * 50
+        y = np.random.randn(20) * 50
+        z = np.zeros(20)
+        for sigma_S in [0.3, 0.35, 1.5]:
+            kwargs = dict(sigma_T=0.3, sigma_S=sigma_S, sigma_G=0., h=h,
+                          r_limit=cell.diam/2)
+            for method in ['pointsource', 'linesource', 'soma_as_point']:
+                single = getattr(lfpcalc, 'calc_lfp_{}_moi'.format(method))
+                batch = getattr(lfpcalc, 'calc_lfp_{}_moi_batch'.format(method))
+                mapping = np.array([single(cell, x=x[i], y=y[i], z=z[i],
+                                           steps=20, **kwargs)
+                                    for i in range(x.size)])
+                np.testing.assert_allclose(mapping,
+                    batch(cell, x=x, y=y, z=z, steps=20,
+                          contact_block_size=7, **kwargs),
+                    rtol=1E-12)
+
+                reference = batch(cell, x=x, y=y, z=z, steps=1000, **kwargs)
+                for accelerate in [False, True]:
+                    mapping, error = batch(cell, x=x, y=y, z=z, steps=1000,
+                                           tolerance=1E-6,
+                                           accelerate=accelerate,
+                                           return_error=True, **kwargs)
+                    self.assertTrue(np.all(error <= 1E-6 * abs(mapping)))
+                    np.testing.assert_allclose(mapping, reference, rtol=1E-5)
+
+    def test_calc_lfp_linesource_multipole(self):
+        """Test that the multipole expansion is used far away from each cell
+        with truncation error within its bound, and that the line-source
+        method is used close to it"""
+        cell = RandomTestCell(nsegs=100, seed=1234)
+        r_limit = cell.diam / 2
+        r = np.random.RandomState(1234).randn(200, 3)
+        r *= (np.logspace(1, 4, 200) / np.sqrt((r**2).sum(axis=1)))[:, None]
+        x, y, z = r.T
+        linesource = lfpcalc.calc_lfp_linesource_batch(cell, x, y, z, 0.3,
+                                                       r_limit)
+        for cellidx in [None, np.arange(101) * 4 // 101]:
+            cell.cellidx = cellidx
+            for tolerance in [1E-1, 1E-3]:
+                mapping = lfpcalc.calc_lfp_linesource_multipole_batch(
+                    cell, x, y, z, 0.3, r_limit,
+                    multipole_tolerance=tolerance)
+                np.testing.assert_equal(mapping[0],
+                    lfpcalc.calc_lfp_linesource_multipole(
+                        cell, x[0], y[0], z[0], 0.3, r_limit,
+                        multipole_tolerance=tolerance))
+
+                groups = [np.arange(101)] if cellidx is None else \
+                    [np.where(cellidx == i)[0] for i in range(4)]
+                nfar = 0
+                for idx in groups:
+                    points = np.r_[np.c_[cell.xstart, cell.ystart,
+                                         cell.zstart][idx],
+                                   np.c_[cell.xend, cell.yend,
+                                         cell.zend][idx]]
+                    center = (points.min(axis=0) + points.max(axis=0)) / 2
+                    a = np.sqrt(((points - center)**2).sum(axis=1)).max()
+                    R = np.sqrt(((r - center)**2).sum(axis=1))
+                    far = (a < R) & ((a / R)**2 / (1 - a / R) <= tolerance)
+                    nfar += far.sum()
+                    np.testing.assert_equal(mapping[~far][:, idx],
+                                            linesource[~far][:, idx])
+                    error = abs(mapping - linesource)[far][:, idx]
+                    bound = tolerance * a / (4 * np.pi * 0.3 * R[far]**2)
+                    self.assertTrue(np.all(error <= bound[:, None]))
+                self.assertTrue(nfar > 0)
+        del cell.cellidx
+
+    def test_calc_lfp_linesource_octree(self):
+        """Test that the octree mapping approximates the line-source mapping
+        of a population of cells, and reproduces it when no multipole
+        expansions are used"""
+        cell = RandomTestPopulation()
+        r_limit = cell.diam / 2
+        x = np.zeros(32) + 50
+        y = np.zeros(32)
+        z = np.linspace(-1000, 1000, 32)
+        linesource = lfpcalc.calc_lfp_linesource_batch(cell, x, y, z, 0.3,
+                                                       r_limit)
+
+        near, far, moments = lfpcalc.calc_lfp_linesource_octree(
+            cell, x, y, z, 0.3, r_limit, multipole_tolerance=1E-2,
+            leaf_size=16)
+        self.assertEqual(near.shape, linesource.shape)
+        self.assertEqual(far.shape, (32, moments.shape[0]))
+        self.assertTrue(near.nnz < linesource.size)
+        mapping = near.toarray() + far.dot(moments).toarray()
+        np.testing.assert_allclose(mapping, linesource,
+            atol=1E-2 * abs(linesource).max())
+        currents = np.random.randn(cell.totnsegs, 3)
+        np.testing.assert_allclose(near.dot(currents) +
+                                   far.dot(moments.dot(currents)),
+                                   mapping.dot(currents))
+
+        near, far, moments = lfpcalc.calc_lfp_linesource_octree(
+            cell, x, y, z, 0.3, r_limit, multipole_tolerance=0.)
+        self.assertEqual(far.nnz, 0)
+        np.testing.assert_allclose(near.toarray(), linesource, rtol=1E-12)
+
+    def test_sum_image_series(self):
+        """Test early termination and acceleration of a geometric series"""
+        ratio = -0.5
+        first = np.ones(3)
+        term = lambda n: ratio**n * np.ones(3)
+        mapping, error = lfpcalc._sum_image_series(first, term, steps=1000,
+                                                   ratio=abs(ratio),
+                                                   tolerance=1E-8)
+        np.testing.assert_allclose(mapping, 1 / (1 - ratio), rtol=1E-7)
+        self.assertTrue(np.all(error <= 1E-8 * abs(mapping)))
+
+        # Aitken's extrapolation is exact for geometric series
+        mapping, error = lfpcalc._sum_image_series(first, term, steps=3,
+                                                   ratio=abs(ratio),
+                                                   accelerate=True)
+        np.testing.assert_allclose(mapping, 1 / (1 - ratio))
+
     def test_deltaS_calc(self):
         cell = TestCell()
         cell.yend[0] = 5
@@ -540,3 +730,39 @@ class TestCell(object):
         self.zend = np.array([0.])
         self.diam = np.array([1.])
         self.totnsegs = len(self.xmid)
+
+
+class RandomTestPopulation(object):
+    """Cell like object with the segments of 20 RandomTestCell objects
+    with somas at random positions"""
+    def __init__(self, ncells=20, nsegs=100, seed=1234):
+        cells = [RandomTestCell(nsegs=nsegs, seed=seed + i)
+                 for i in range(ncells)]
+        offsets = np.random.RandomState(seed).uniform(-1000, 1000,
+                                                      size=(ncells, 3))
+        for i, attr in enumerate(['x', 'y', 'z']):
+            for pos in ['start', 'mid', 'end']:
+                setattr(self, attr + pos, np.concatenate(
+                    [getattr(cell, attr + pos) + offset[i]
+                     for cell, offset in zip(cells, offsets)]))
+        self.diam = np.concatenate([cell.diam for cell in cells])
+        self.totnsegs = self.diam.size
+
+
+class RandomTestCell(object):
+    """Cell like object with attributes for predicting extracellular potentials,
+    with a spherical soma and 100 connected dendrite compartments with random
+    orientation and length"""
+    def __init__(self, nsegs=100, seed=1234):
+        np.random.seed(seed)
+        start = np.zeros((nsegs + 1, 3))
+        end = np.zeros((nsegs + 1, 3))
+        end[0] = [0., 0., 10.]
+        for i in range(1, nsegs + 1):
+            start[i] = end[np.random.randint(i)]
+            end[i] = start[i] + np.random.randn(3) * 10
+        self.xstart, self.ystart, self.zstart = start.T
+        self.xend, self.yend, self.zend = end.T
+        self.xmid, self.ymid, self.zmid = ((start + end) / 2).T
+        self.diam = np.r_[10., np.random.rand(nsegs) + 0.5]
+        self.totnsegs = nsegs + 1
@@ -18,6 +18,7 @@ from __future__ import division
 import os
 import unittest
 import numpy as np
+import h5py
 import LFPy
 import neuron
 
@@ -128,12 +129,16 @@ class testNetwork(unittest.TestCase):
 
         # connect and run sim
         network.connect(pre='test', post='test', connectivity=connectivity)
-        network.simulate()
+        SPIKES = network.simulate()
 
         # test output
         for population in network.populations.values():
             for cell in population.cells:
                 self.assertTrue(np.all(cell.somav == network.v_init))
+        self.assertEqual(SPIKES['gids'], [list(range(4))])
+        np.testing.assert_equal(SPIKES['offsets'][0], np.zeros(5))
+        self.assertEqual(SPIKES['flat_times'][0].size, 0)
+        self.assertEqual(len(SPIKES['times'][0]), 4)
 
         network.pc.gid_clear()
         os.system('rm -r tmp_testNetworkPopulation')
@@ -268,3 +273,556 @@ class testNetwork(unittest.TestCase):
         network.pc.gid_clear()
         os.system('rm -r tmp_testNetworkPopulation')
         neuron.h('forall delete_section()')
+
+
+    def test_Network_03(self):
+        cellParameters = dict(
+            morphology=os.path.join(LFPy.__path__[0], 'test', 'ball_and_sticks_w_lists.hoc'),
+            templatefile=os.path.join(LFPy.__path__[0], 'test', 'ball_and_stick_template.hoc'),
+            templatename='ball_and_stick_template',
+            templateargs=None,
+            passive=True,
+            dt=2**-3,
+            tstop=100,
+            delete_sections=False,
+        )
+
+        populationParameters = dict(
+            CWD=None,
+            CELLPATH=None,
+            Cell=LFPy.NetworkCell,
+            cell_args = cellParameters,
+            pop_args = dict(
+                radius=100,
+                loc=0.,
+                scale=20.),
+            rotation_args = dict(x=0, y=0),
+            POP_SIZE = 4,
+            name = 'test',
+        )
+        networkParameters = dict(
+            dt=2**-3,
+            tstart=0.,
+            tstop=100.,
+            v_init=-65.,
+            celsius=6.3,
+            OUTPUTPATH='tmp_testNetworkPopulation'
+            )
+        clampParams = {
+            'idx' : 0,
+            'pptype' : 'VClamp',
+            'amp[0]' : -65,
+            'dur[0]' : 10,
+            'amp[1]' : 0,
+            'dur[1]' : 1,
+            'amp[2]' : -65,
+            'dur[2]' : 1E8,
+        }
+        electrodeParameters = dict(
+            sigma=0.3,
+            x = np.zeros(11),
+            y = np.zeros(11),
+            z = np.linspace(-500, 500, 11),
+            method = 'linesource',
+        )
+
+        # set up
+        network = LFPy.Network(**networkParameters)
+        network.create_population(**populationParameters)
+
+        # create synthetic AP in cell with gid == 0
+        for population in network.populations.values():
+            for cell in population.cells:
+                if cell.gid == 0:
+                    vclamp = LFPy.StimIntElectrode(cell=cell, **clampParams)
+
+        # simulate, buffering 7 timesteps of currents at the time
+        electrode = LFPy.RecExtElectrode(**electrodeParameters)
+        SPIKES, LFP, P = network.simulate(electrode=electrode, rec_imem=True,
+                                          rec_current_dipole_moment=True,
+                                          block_size=7)
+
+        # compare with single-cell contributions
+        LFP_ref = np.zeros(LFP[0].shape)
+        P_ref = np.zeros(P.shape)
+        for population in network.populations.values():
+            for cell in population.cells:
+                el = LFPy.RecExtElectrode(cell=cell, **electrodeParameters)
+                el.calc_lfp()
+                LFP_ref += el.LFP
+                P_ref += np.dot(cell.imem.T, np.c_[cell.xmid, cell.ymid, cell.zmid])
+
+        self.assertFalse(np.all(LFP_ref == 0.))
+        np.testing.assert_allclose(LFP[0]['imem'], LFP_ref)
+        np.testing.assert_allclose(P['test'], P_ref)
+
+        # contributions of passive and capacitive currents do not depend
+        # on the number of buffered timesteps
+        LFP = [network.simulate(electrode=electrode, use_ipas=True,
+                                use_icap=True, block_size=block_size)[1][0]
+               for block_size in [1, 7]]
+        for name in ['ipas', 'icap']:
+            self.assertFalse(np.all(LFP[0][name] == 0.))
+            np.testing.assert_allclose(LFP[1][name], LFP[0][name])
+
+        network.pc.gid_clear()
+        os.system('rm -r tmp_testNetworkPopulation')
+        neuron.h('forall delete_section()')
+
+    def test_Network_04(self):
+        cellParameters = dict(
+            morphology=os.path.join(LFPy.__path__[0], 'test', 'ball_and_sticks_w_lists.hoc'),
+            templatefile=os.path.join(LFPy.__path__[0], 'test', 'ball_and_stick_template.hoc'),
+            templatename='ball_and_stick_template',
+            templateargs=None,
+            passive=True,
+            dt=2**-3,
+            tstop=100,
+            delete_sections=False,
+        )
+
+        populationParameters = dict(
+            CWD=None,
+            CELLPATH=None,
+            Cell=LFPy.NetworkCell,
+            cell_args = cellParameters,
+            pop_args = dict(
+                radius=100,
+                loc=0.,
+                scale=20.),
+            rotation_args = dict(x=0, y=0),
+            POP_SIZE = 4,
+            name = 'test',
+        )
+        networkParameters = dict(
+            dt=2**-3,
+            tstart=0.,
+            tstop=100.,
+            v_init=-65.,
+            celsius=6.3,
+            OUTPUTPATH='tmp_testNetworkPopulation'
+            )
+        clampParams = {
+            'idx' : 0,
+            'pptype' : 'VClamp',
+            'amp[0]' : -65,
+            'dur[0]' : 10,
+            'amp[1]' : 0,
+            'dur[1]' : 1,
+            'amp[2]' : -65,
+            'dur[2]' : 1E8,
+        }
+        electrodeParameters = dict(
+            sigma=0.3,
+            x = np.zeros(11),
+            y = np.zeros(11),
+            z = np.linspace(-500, 500, 11),
+            method = 'linesource',
+        )
+
+        # set up
+        network = LFPy.Network(**networkParameters)
+        network.create_population(**populationParameters)
+
+        # create synthetic AP in cell with gid == 0
+        for population in network.populations.values():
+            for cell in population.cells:
+                if cell.gid == 0:
+                    vclamp = LFPy.StimIntElectrode(cell=cell, **clampParams)
+
+        # simulate, storing output both in memory and to file
+        electrode = LFPy.RecExtElectrode(**electrodeParameters)
+        SPIKES, LFP, P = network.simulate(electrode=electrode,
+                                          rec_current_dipole_moment=True,
+                                          rec_pop_contributions=True,
+                                          to_file=True,
+                                          file_name='tmp_testNetwork_04',
+                                          file_chunk_size=64,
+                                          block_size=7)
+
+        f = h5py.File('tmp_testNetwork_04.h5', 'r')
+        for name in ['imem', 'test']:
+            np.testing.assert_allclose(f['electrode000'][name][()],
+                                       LFP[0][name])
+        np.testing.assert_allclose(f['current_dipole_moment']['test'][()],
+                                   P['test'].T)
+        np.testing.assert_allclose(f['t'][()],
+                                   np.arange(LFP[0].shape[1]) * network.dt)
+        f.close()
+
+        # streaming to file requires a file name
+        np.testing.assert_raises(ValueError, network.simulate,
+                                 electrode=electrode, to_file=True)
+
+        network.pc.gid_clear()
+        os.remove('tmp_testNetwork_04.h5')
+        os.system('rm -r tmp_testNetworkPopulation')
+        neuron.h('forall delete_section()')
+
+    def test_Network_05(self):
+        # contributions streamed to file by each RANK are summed up
+        data = np.random.randn(3, 4, 101)
+        file_names = []
+        for i in range(3):
+            writer = LFPy.tools.StreamWriter('tmp_testNetwork_05_RANK{:03d}'.format(i),
+                                             ntsteps=101, dt=0.1, chunk_size=16)
+            writer.create_dataset('electrode000/imem', 4, x=np.arange(4))
+            writer.write('electrode000/imem', data[i])
+            writer.close()
+            file_names.append(writer.file_name)
+        LFPy.network._merge_rank_files(file_names, 'tmp_testNetwork_05.h5')
+
+        f = h5py.File('tmp_testNetwork_05.h5', 'r')
+        np.testing.assert_allclose(f['electrode000/imem'][()], data.sum(axis=0))
+        np.testing.assert_equal(f['electrode000/imem'].attrs['x'], np.arange(4))
+        self.assertEqual(f['electrode000/imem'].chunks, (4, 16))
+        np.testing.assert_allclose(f['t'][()], np.arange(101) * 0.1)
+        f.close()
+        for file_name in file_names:
+            self.assertFalse(os.path.isfile(file_name))
+        os.remove('tmp_testNetwork_05.h5')
+
+    def test_Network_06(self):
+        cellParameters = dict(
+            morphology=os.path.join(LFPy.__path__[0], 'test', 'ball_and_sticks_w_lists.hoc'),
+            templatefile=os.path.join(LFPy.__path__[0], 'test', 'ball_and_stick_template.hoc'),
+            templatename='ball_and_stick_template',
+            templateargs=None,
+            passive=True,
+            dt=2**-3,
+            tstop=100,
+            delete_sections=False,
+        )
+
+        populationParameters = dict(
+            CWD=None,
+            CELLPATH=None,
+            Cell=LFPy.NetworkCell,
+            cell_args = cellParameters,
+            pop_args = dict(
+                radius=100,
+                loc=0.,
+                scale=20.),
+            rotation_args = dict(x=0, y=0),
+            POP_SIZE = 4,
+        )
+        networkParameters = dict(
+            dt=2**-3,
+            tstart=0.,
+            tstop=100.,
+            v_init=-65.,
+            celsius=6.3,
+            OUTPUTPATH='tmp_testNetworkPopulation'
+            )
+
+        # set up
+        network = LFPy.Network(**networkParameters)
+        network.create_population(name='E', **populationParameters)
+        network.create_population(name='I', **populationParameters)
+
+        nsegs, dummycell = network._create_network_dummycell()
+
+        cells = network.populations['E'].cells + network.populations['I'].cells
+        np.testing.assert_equal(nsegs,
+            [sum([cell.totnsegs for cell in network.populations[name].cells])
+             for name in ['E', 'I']])
+        self.assertEqual(dummycell.totnsegs, sum([cell.totnsegs for cell in cells]))
+        for attr in ['xstart', 'xmid', 'xend', 'ystart', 'ymid', 'yend',
+                     'zstart', 'zmid', 'zend', 'diam', 'area']:
+            np.testing.assert_equal(getattr(dummycell, attr),
+                np.concatenate([getattr(cell, attr) for cell in cells]))
+        self.assertTrue(dummycell.imem.size == 0)
+        np.testing.assert_equal(dummycell.cellidx,
+            np.concatenate([np.ones(cell.totnsegs, dtype=int) * i
+                            for i, cell in enumerate(cells)]))
+
+        # multipole expansion of each cell far away from the cells
+        electrodeParameters = dict(x=np.zeros(3), y=np.zeros(3),
+                                   z=np.array([1E4, 2E4, 4E4]))
+        electrode = LFPy.RecExtElectrode(method='linesource',
+                                         **electrodeParameters)
+        electrode.calc_mapping(dummycell)
+        mapping = electrode.mapping
+        electrode = LFPy.RecExtElectrode(method='linesource+multipole',
+                                         **electrodeParameters)
+        electrode.calc_mapping(dummycell)
+        # far field of each cell in factored form
+        self.assertTrue(isinstance(electrode.mapping,
+                                   LFPy.recextelectrode.OctreeMapping))
+        self.assertEqual(electrode.mapping.far.shape, (3, 10 * len(cells)))
+        self.assertEqual(electrode.mapping.near.nnz, 0)
+        multipole = electrode.mapping.toarray()
+        # the line-source method gives nan for zero-length segments
+        finite = np.isfinite(mapping)
+        self.assertFalse(np.all(multipole[finite] == mapping[finite]))
+        np.testing.assert_allclose(multipole[finite], mapping[finite],
+                                   rtol=1E-3)
+
+        network.pc.gid_clear()
+        os.system('rm -r tmp_testNetworkPopulation')
+        neuron.h('forall delete_section()')
+
+    def test_Network_07(self):
+        cellParameters = dict(
+            morphology=os.path.join(LFPy.__path__[0], 'test', 'ball_and_sticks_w_lists.hoc'),
+            templatefile=os.path.join(LFPy.__path__[0], 'test', 'ball_and_stick_template.hoc'),
+            templatename='ball_and_stick_template',
+            templateargs=None,
+            passive=True,
+            dt=2**-3,
+            tstop=100,
+            delete_sections=False,
+        )
+
+        populationParameters = dict(
+            CWD=None,
+            CELLPATH=None,
+            Cell=LFPy.NetworkCell,
+            cell_args = cellParameters,
+            pop_args = dict(
+                radius=100,
+                loc=0.,
+                scale=20.),
+            rotation_args = dict(x=0, y=0),
+            POP_SIZE = 4,
+        )
+        networkParameters = dict(
+            dt=2**-3,
+            tstart=0.,
+            tstop=100.,
+            v_init=-65.,
+            celsius=6.3,
+            OUTPUTPATH='tmp_testNetworkPopulation'
+            )
+        clampParams = {
+            'idx' : 0,
+            'pptype' : 'VClamp',
+            'amp[0]' : -65,
+            'dur[0]' : 10,
+            'amp[1]' : 0,
+            'dur[1]' : 1,
+            'amp[2]' : -65,
+            'dur[2]' : 1E8,
+        }
+        electrodeParameters = dict(
+            sigma=0.3,
+            x = np.zeros(11),
+            y = np.zeros(11),
+            z = np.linspace(-500, 5000, 11),
+        )
+
+        # set up
+        network = LFPy.Network(**networkParameters)
+        network.create_population(name='E', **populationParameters)
+        network.create_population(name='I', **populationParameters)
+
+        # create synthetic AP in cell with gid == 0
+        for population in network.populations.values():
+            for cell in population.cells:
+                if cell.gid == 0:
+                    vclamp = LFPy.StimIntElectrode(cell=cell, **clampParams)
+
+        # compare with octree mapping of recorded currents
+        electrode = LFPy.RecExtElectrode(method='linesource+octree',
+                                         octree_leaf_size=8,
+                                         **electrodeParameters)
+        SPIKES, LFP, P = network.simulate(electrode=electrode, rec_imem=True,
+                                          rec_pop_contributions=True)
+        nsegs, dummycell = network._create_network_dummycell()
+        electrode.calc_mapping(dummycell)
+        self.assertTrue(electrode.mapping.far.nnz > 0)
+        imem = np.concatenate([cell.imem for name in ['E', 'I']
+                               for cell in network.populations[name].cells])
+        self.assertFalse(np.all(LFP[0]['imem'] == 0.))
+        np.testing.assert_allclose(LFP[0]['imem'],
+                                   electrode.mapping.dot(imem))
+        np.testing.assert_allclose(LFP[0]['E'],
+            electrode.mapping[:, :nsegs[0]].dot(imem[:nsegs[0]]))
+        np.testing.assert_allclose(LFP[0]['E'] + LFP[0]['I'],
+                                   LFP[0]['imem'])
+
+        network.pc.gid_clear()
+        os.system('rm -r tmp_testNetworkPopulation')
+        neuron.h('forall delete_section()')
+
+
+    def test_Network_08(self):
+        gids = np.arange(5) + 10
+        spike_vectors = [np.arange(i) * 10. + gid
+                         for i, gid in enumerate(gids)]
+        gids_all, offsets, times = LFPy.network._gather_spikes(gids,
+                                                               spike_vectors)
+        np.testing.assert_equal(gids_all, gids)
+        np.testing.assert_equal(offsets, [0, 0, 1, 3, 6, 10])
+        self.assertEqual(gids_all.dtype, np.int64)
+        self.assertEqual(offsets.dtype, np.int64)
+        self.assertEqual(times.dtype, np.float64)
+        for j, x in enumerate(spike_vectors):
+            np.testing.assert_equal(times[offsets[j]:offsets[j+1]], x)
+
+        gids_all, offsets, times = LFPy.network._gather_spikes([], [])
+        self.assertEqual(gids_all.size, 0)
+        np.testing.assert_equal(offsets, [0])
+        self.assertEqual(times.size, 0)
+
+
+    def test_Network_09(self):
+        sendbuf = np.zeros((4, 11), dtype=[('imem', 'f8'), ('E', 'f4')])
+        sendbuf['imem'] = np.random.randn(4, 11)
+        sendbuf['E'] = np.random.randn(4, 11)
+        for mode in ['Reduce', 'Allreduce', 'Reduce_scatter']:
+            for chunk_size in [3, 2**26]:
+                reduced = LFPy.network.ReduceStructArray(
+                    sendbuf, mode=mode, chunk_size=chunk_size)
+                self.assertEqual(reduced.shape, sendbuf.shape)
+                self.assertEqual(reduced.dtype['E'], np.float64)
+                for name in sendbuf.dtype.names:
+                    np.testing.assert_equal(reduced[name], sendbuf[name])
+
+        # packed float64 fields are reduced in place if requested
+        sendbuf = np.zeros((4, 11), dtype=[('imem', 'f8'), ('E', 'f8')])
+        reduced = LFPy.network.ReduceStructArray(sendbuf)
+        self.assertFalse(np.shares_memory(reduced, sendbuf))
+        reduced = LFPy.network.ReduceStructArray(sendbuf, in_place=True)
+        self.assertTrue(np.shares_memory(reduced, sendbuf))
+
+        np.testing.assert_raises(AssertionError,
+                                 LFPy.network.ReduceStructArray, sendbuf,
+                                 mode='Gather')
+
+
+    def test_Network_10(self):
+        # greedy bin packing accumulates loads across calls
+        balancer = LFPy.GreedyLoadBalancer(size=3)
+        ranks = balancer.assign(np.arange(4), [1., 5., 2., 2.])
+        np.testing.assert_equal(ranks, [1, 0, 1, 2])
+        np.testing.assert_equal(balancer.loads, [5., 3., 2.])
+        ranks = balancer.assign(np.arange(4, 8), 1.)
+        np.testing.assert_equal(ranks, [2, 1, 2, 1])
+        np.testing.assert_equal(balancer.loads, [5., 5., 4.])
+        np.testing.assert_equal(
+            LFPy.RoundRobinLoadBalancer(size=3).assign(np.arange(5)),
+            [0, 1, 2, 0, 1])
+        np.testing.assert_raises(AssertionError, LFPy.GreedyLoadBalancer,
+                                 weight='nseg')
+        np.testing.assert_raises(AssertionError, LFPy.GreedyLoadBalancer,
+                                 weight='time')
+
+        cellParameters = dict(
+            morphology=os.path.join(LFPy.__path__[0], 'test', 'ball_and_sticks_w_lists.hoc'),
+            templatefile=os.path.join(LFPy.__path__[0], 'test', 'ball_and_stick_template.hoc'),
+            templatename='ball_and_stick_template',
+            templateargs=None,
+            passive=False,
+            dt=2**-3,
+            tstop=100,
+            delete_sections=False,
+        )
+        populationParameters = dict(
+            CWD=None,
+            CELLPATH=None,
+            Cell=LFPy.NetworkCell,
+            cell_args = cellParameters,
+            pop_args = dict(
+                radius=100,
+                loc=0.,
+                scale=20.),
+            rotation_args = dict(x=0, y=0),
+            POP_SIZE = 4,
+        )
+        # sections created by the user are left untouched
+        neuron.h('create user_section')
+        network = LFPy.Network(
+            dt=0.1, tstop=100., OUTPUTPATH='tmp_testNetworkPopulation',
+            load_balancer=LFPy.GreedyLoadBalancer())
+        network.create_population(name='E', **populationParameters)
+        network.create_population(name='I', cell_weight=np.arange(4) + 1,
+                                  **populationParameters)
+        np.testing.assert_equal(network.populations['E'].gids, np.arange(4))
+        np.testing.assert_equal(network.populations['I'].gids,
+                                np.arange(4) + 4)
+        # no temporary cells are created to compute weights
+        self.assertEqual(len(list(neuron.h.allsec())), 8 * 4 + 1)
+        self.assertEqual(neuron.h.user_section.name(), 'user_section')
+        self.assertEqual(network.load_balancer.loads.sum(),
+                         4 * network.populations['E'].cells[0].totnsegs + 10)
+        network.pc.gid_clear()
+        neuron.h('forall delete_section()')
+        os.system('rm -r tmp_testNetworkPopulation')
+
+
+    def test_Network_11(self):
+        cellParameters = dict(
+            morphology=os.path.join(LFPy.__path__[0], 'test', 'ball_and_sticks_w_lists.hoc'),
+            templatefile=os.path.join(LFPy.__path__[0], 'test', 'ball_and_stick_template.hoc'),
+            templatename='ball_and_stick_template',
+            templateargs=None,
+            passive=False,
+            dt=2**-3,
+            tstop=100,
+            delete_sections=False,
+        )
+        populationParameters = dict(
+            CWD=None,
+            CELLPATH=None,
+            Cell=LFPy.NetworkCell,
+            cell_args = cellParameters,
+            pop_args = dict(
+                radius=100,
+                loc=0.,
+                scale=20.),
+            rotation_args = dict(x=0, y=0),
+            POP_SIZE = 4,
+            name = 'test',
+        )
+        network = LFPy.Network(dt=0.1, tstop=100.,
+                               OUTPUTPATH='tmp_testNetworkPopulation')
+        network.create_population(**populationParameters)
+        connectivity = np.ones((4, 4), dtype=bool)
+        conncount, syncount = network.connect(
+            pre='test', post='test', connectivity=connectivity,
+            weightargs=dict(loc=0.1, scale=0.1), minweight=0.05,
+            delayargs=dict(loc=1., scale=1.), mindelay=0.5,
+            multapseargs=dict(loc=2, scale=2),
+            syn_pos_args=dict(section=['dend'],
+                              fun=[LFPy.network.stats.norm],
+                              funargs=[dict(loc=0, scale=100)],
+                              funweights=[1.]))
+
+        self.assertEqual(conncount, 16)
+        self.assertEqual(len(network.netconlist), syncount)
+
+        # multapse functions without size argument are called per connection
+        def multapsefun(loc, scale):
+            return np.random.normal(loc=loc, scale=scale)
+        nidx = LFPy.network._draw_multapses(multapsefun,
+                                            dict(loc=3.5, scale=0.1), 5)
+        np.testing.assert_equal(nidx, [3] * 5)
+        nidx = LFPy.network._draw_multapses(np.random.normal,
+                                            dict(loc=3.5, scale=0.1), 5)
+        np.testing.assert_equal(nidx, [3] * 5)
+        self.assertTrue(syncount >= 16)
+        weights = np.array([nc.weight[0] for nc in network.netconlist])
+        delays = np.array([nc.delay for nc in network.netconlist])
+        self.assertTrue(np.all(weights >= 0.05))
+        self.assertTrue(np.all(delays >= 0.5))
+
+        f = h5py.File(os.path.join('tmp_testNetworkPopulation',
+                                   'synapse_positions.h5'), 'r')
+        synData = f['test:test'][()]
+        f.close()
+        self.assertEqual(synData.size, syncount)
+        for cell in network.populations['test'].cells:
+            self.assertEqual(len(cell.netconsynapses), len(cell.synidx))
+            idx = np.array(cell.synidx)
+            self.assertTrue(np.all(np.in1d(idx, cell.get_idx('dend'))))
+            np.testing.assert_equal(synData['z'][synData['gid'] == cell.gid],
+                                    cell.zmid[idx])
+            for syn, i in zip(cell.netconsynapses, idx):
+                _, secname, x = cell.get_idx_name(i)
+                self.assertEqual(syn.get_segment().sec.name(), secname)
+                self.assertEqual(syn.get_segment().x, x)
+
+        network.pc.gid_clear()
+        os.system('rm -r tmp_testNetworkPopulation')
+        neuron.h('forall delete_section()')
@@ -720,6 +720,26 @@ class testNetworkCell(unittest.TestCase):
                                                          dtype=object))
     
     
+    def test_cell_create_synapse_00(self):
+        cell = LFPy.NetworkCell(morphology=os.path.join(LFPy.__path__[0], 'test',
+                                                  'ball_and_sticks_w_lists.hoc' ),
+                        templatefile=os.path.join(LFPy.__path__[0], 'test', 'ball_and_stick_template.hoc'),
+                        templatename='ball_and_stick_template',
+                        templateargs=None,
+                        )
+        for idx in range(cell.totnsegs):
+            cell.create_synapse(cell, idx=idx)
+            _, secname, x = cell.get_idx_name(idx)
+            seg = cell.netconsynapses[-1].get_segment()
+            self.assertEqual(seg.sec.name(), secname)
+            self.assertEqual(seg.x, x)
+        sec = list(cell.allseclist)[-1]
+        cell.create_synapse(cell, sec=sec, x=0.1)
+        self.assertEqual(cell.netconsynapses[-1].get_segment().sec.name(),
+                         sec.name())
+        np.testing.assert_raises(AssertionError, cell.create_synapse, cell)
+
+
     def test_cell_get_rand_idx_area_norm_00(self):
         cell = LFPy.NetworkCell(morphology=os.path.join(LFPy.__path__[0], 'test',
                                                   'ball_and_sticks_w_lists.hoc' ),
@@ -18,6 +18,7 @@ from __future__ import division
 import os
 import unittest
 import numpy as np
+import scipy.sparse
 from scipy.integrate import quad
 from scipy import real, imag
 import LFPy
@@ -77,6 +78,116 @@ class testRecExtElectrode(unittest.TestCase):
                                                     electrodeZ=Z[i])
         np.testing.assert_allclose(LFP_analytic, LFP_LFPy, atol=1E-4)
 
+
+    def test_method_linesource_multipole(self):
+        #create LFPs using LFPy-model
+        LFP_LFPy = stickSimulation(method='linesource+multipole')
+
+        #create LFPs using the analytical approach
+        time = np.linspace(0, 100, 100*2**6+1)
+        R = np.ones(11)*100
+        Z = np.linspace(1000, 0, 11)
+
+        LFP_analytic = np.empty((R.size, time.size))
+        for i in range(R.size):
+            LFP_analytic[i, ] = analytical_LFP(time, electrodeR=R[i],
+                                                    electrodeZ=Z[i])
+        np.testing.assert_allclose(LFP_analytic, LFP_LFPy, atol=1E-4)
+
+        np.testing.assert_raises(NotImplementedError, LFPy.RecExtElectrode,
+                                 sigma=[0.3, 0.3, 0.3],
+                                 method='linesource+multipole')
+
+        # mapping in factored form, compared with the dense mapping
+        cell = LFPy.Cell(morphology=os.path.join(LFPy.__path__[0], 'test',
+                                                 'stick.hoc'))
+        electrodeParams = {
+            'x' : np.ones(11) * 100.,
+            'y' : np.zeros(11),
+            'z' : np.linspace(10000, 0, 11),
+        }
+        for params in [{}, {'N' : [[1, 0, 0]] * 11, 'r' : 10, 'n' : 10,
+                             'quadrature' : 'fibonacci'}]:
+            electrode = LFPy.RecExtElectrode(cell,
+                                             method='linesource+multipole',
+                                             **dict(electrodeParams,
+                                                    **params))
+            electrode.calc_mapping(cell)
+            self.assertTrue(isinstance(electrode.mapping,
+                                       LFPy.recextelectrode.OctreeMapping))
+            self.assertEqual(electrode.mapping.far.shape, (11, 10))
+            self.assertTrue(electrode.mapping.far.nnz > 0)
+            self.assertTrue(electrode.mapping.near.nnz > 0)
+            if params:
+                # average over the n points of each contact
+                mapping = np.array([
+                    LFPy.lfpcalc.calc_lfp_linesource_multipole_batch(
+                        cell, electrode.offsets[i]['x_n'],
+                        electrode.offsets[i]['y_n'],
+                        electrode.offsets[i]['z_n'], 0.3,
+                        cell.diam / 2).mean(axis=0) for i in range(11)])
+            else:
+                mapping = LFPy.lfpcalc.calc_lfp_linesource_multipole_batch(
+                    cell, electrodeParams['x'], electrodeParams['y'],
+                    electrodeParams['z'], 0.3, cell.diam / 2)
+            np.testing.assert_allclose(electrode.mapping.toarray(), mapping,
+                                       rtol=1E-12)
+            currents = np.random.randn(cell.totnsegs, 3)
+            np.testing.assert_allclose(electrode.mapping.dot(currents),
+                                       mapping.dot(currents))
+
+        # with cutoff, the mapping is a sparse matrix
+        electrode = LFPy.RecExtElectrode(cell, method='linesource+multipole',
+                                         cutoff_rtol=1E-3, **electrodeParams)
+        electrode.calc_mapping(cell)
+        self.assertTrue(scipy.sparse.issparse(electrode.mapping))
+
+    def test_method_linesource_octree(self):
+        #create LFPs using LFPy-model
+        LFP_LFPy = stickSimulation(method='linesource+octree')
+
+        #create LFPs using the analytical approach
+        time = np.linspace(0, 100, 100*2**6+1)
+        R = np.ones(11)*100
+        Z = np.linspace(1000, 0, 11)
+
+        LFP_analytic = np.empty((R.size, time.size))
+        for i in range(R.size):
+            LFP_analytic[i, ] = analytical_LFP(time, electrodeR=R[i],
+                                                    electrodeZ=Z[i])
+        np.testing.assert_allclose(LFP_analytic, LFP_LFPy, atol=1E-4)
+
+        # compare with line-source mapping of contacts with n-point average
+        cell = LFPy.Cell(morphology=os.path.join(LFPy.__path__[0], 'test',
+                                                 'stick.hoc'))
+        electrodeParams = {
+            'x' : np.ones(11) * 100.,
+            'y' : np.zeros(11),
+            'z' : np.linspace(5000, 0, 11),
+            'N' : [[1, 0, 0]] * 11,
+            'r' : 10,
+            'n' : 10,
+            'quadrature' : 'fibonacci',
+        }
+        electrode = LFPy.RecExtElectrode(cell, method='linesource',
+                                         **electrodeParams)
+        electrode.calc_mapping(cell)
+        mapping = electrode.mapping
+        electrode = LFPy.RecExtElectrode(cell, method='linesource+octree',
+                                         octree_leaf_size=4,
+                                         **electrodeParams)
+        electrode.calc_mapping(cell)
+        self.assertTrue(isinstance(electrode.mapping, LFPy.recextelectrode.OctreeMapping))
+        self.assertTrue(electrode.mapping.far.nnz > 0)
+        np.testing.assert_allclose(electrode.mapping.toarray(), mapping,
+                                   atol=1E-2 * abs(mapping).max())
+        currents = np.random.randn(cell.totnsegs, 3)
+        np.testing.assert_allclose(electrode.mapping[:, 5:10].dot(currents[5:10]),
+                                   electrode.mapping.toarray()[:, 5:10].dot(currents[5:10]))
+
+        np.testing.assert_raises(ValueError, LFPy.RecExtElectrode,
+                                 method='linesource+octree',
+                                 cutoff_distance=100.)
     
     
     def test_method_pointsource_dotprodcoeffs(self):
@@ -416,6 +527,311 @@ class testRecExtElectrode(unittest.TestCase):
         np.testing.assert_raises(AssertionError, np.testing.assert_array_equal,
                                  electrode_ps.LFP[0,:], electrode_sap.LFP[0,:])
 
+    def test_mapping_cutoff(self):
+        stickParams = {
+            'morphology' : os.path.join(LFPy.__path__[0], 'test', 'stick.hoc'),
+            'passive_parameters' : {'g_pas' : 1./30000, 'e_pas' : -65},
+            'passive': True,
+            'tstart' : 0,
+            'tstop' : 20,
+            'dt' : 2**-4,
+            'nsegs_method' : 'lambda_f',
+            'lambda_f' : 100,
+        }
+        stick = LFPy.Cell(**stickParams)
+        stick.set_pos(z=-stick.zstart[0])
+
+        electrodeParams = {
+            'x' : np.ones(11) * 100,
+            'y' : np.zeros(11),
+            'z' : np.linspace(-500, 1500, 11),
+        }
+        for sigma in [0.3, [0.3, 0.3, 0.45]]:
+            for method in ['pointsource', 'linesource', 'soma_as_point']:
+                electrode = LFPy.RecExtElectrode(stick, sigma=sigma,
+                                                 method=method,
+                                                 **electrodeParams)
+                electrode.calc_mapping(stick)
+                mapping = electrode.mapping
+
+                # distance cutoff, segments span z in [0, 1000]
+                electrode = LFPy.RecExtElectrode(stick, sigma=sigma,
+                                                 method=method,
+                                                 cutoff_distance=300.,
+                                                 **electrodeParams)
+                electrode.calc_mapping(stick)
+                self.assertTrue(scipy.sparse.isspmatrix_csr(electrode.mapping))
+                distances = np.sqrt(
+                    100**2 + np.maximum(0, np.maximum(
+                        stick.zstart[np.newaxis, :] - electrode.z[:, np.newaxis],
+                        electrode.z[:, np.newaxis] - stick.zend[np.newaxis, :]))**2)
+                np.testing.assert_allclose(electrode.mapping.toarray(),
+                                           np.where(distances <= 300., mapping, 0))
+                self.assertEqual(electrode.mapping[0].nnz, 0)
+
+                # relative magnitude cutoff
+                electrode = LFPy.RecExtElectrode(stick, sigma=sigma,
+                                                 method=method,
+                                                 cutoff_rtol=0.5,
+                                                 **electrodeParams)
+                electrode.calc_mapping(stick)
+                self.assertTrue(scipy.sparse.isspmatrix_csr(electrode.mapping))
+                rmax = abs(mapping).max(axis=1)[:, np.newaxis]
+                np.testing.assert_allclose(electrode.mapping.toarray(),
+                                           np.where(abs(mapping) >= 0.5 * rmax,
+                                                    mapping, 0))
+                self.assertTrue(electrode.mapping.nnz < mapping.size)
+
+        # distance from the edge of contact surfaces, computed in blocks
+        pointParams = dict(electrodeParams, N=[[1, 0, 0]] * 11, r=50, n=10,
+                           quadrature='fibonacci')
+        electrode = LFPy.RecExtElectrode(stick, **pointParams)
+        electrode.calc_mapping(stick)
+        mapping = electrode.mapping
+        for n_workers in [None, 2]:
+            electrode = LFPy.RecExtElectrode(stick, cutoff_distance=300.,
+                                             n_workers=n_workers,
+                                             **pointParams)
+            electrode.calc_mapping(stick)
+            self.assertTrue(scipy.sparse.isspmatrix_csr(electrode.mapping))
+            np.testing.assert_allclose(electrode.mapping.toarray(),
+                                       np.where(distances - 50 <= 300.,
+                                                mapping, 0))
+
+    def test_mapping_cutoff_simulate(self):
+        electrodeParams = {
+            'sigma' : 0.3,
+            'x' : np.ones(11) * 100.,
+            'y' : np.zeros(11),
+            'z' : np.linspace(1000, 0, 11),
+            'method' : 'linesource',
+            'cutoff_distance' : 250.,
+        }
+        LFP_LFPy, LFP_mapping = stickSimulationSparseMapping(electrodeParams)
+        np.testing.assert_allclose(LFP_LFPy, LFP_mapping)
+
+    def test_MEA_tolerance(self):
+        stickParams = {
+            'morphology' : os.path.join(LFPy.__path__[0], 'test', 'ball_and_sticks.hoc'),
+            'passive_parameters' : {'g_pas' : 1./30000, 'e_pas' : -65},
+            'passive': True,
+            'tstart' : 0,
+            'tstop' : 20,
+            'dt' : 2**-4,
+            'nsegs_method' : 'lambda_f',
+            'lambda_f' : 1000,
+        }
+        stick = LFPy.Cell(**stickParams)
+        stick.set_rotation(y=np.pi/2)
+        stick.set_pos(z=100)
+
+        electrodeParams = {
+            'sigma_T' : 0.3,
+            'sigma_S' : 1.5,
+            'sigma_G' : 0.0,
+            'h': 200,
+            'x' : np.linspace(0, 1000, 11),
+            'y' : np.zeros(11),
+            'z' : np.zeros(11),
+        }
+        MEA = LFPy.RecMEAElectrode(stick, method='pointsource', steps=1000,
+                                   **electrodeParams)
+        MEA.calc_mapping(stick)
+        reference = MEA.mapping
+        MEA = LFPy.RecMEAElectrode(stick, method='pointsource', steps=1000,
+                                   tolerance=1E-6, accelerate=True,
+                                   **electrodeParams)
+        MEA.calc_mapping(stick)
+        np.testing.assert_allclose(MEA.mapping, reference, rtol=1E-5)
+        self.assertEqual(MEA.truncation_error.shape, (11, ))
+        self.assertTrue(np.all(MEA.truncation_error <=
+                               1E-6 * abs(MEA.mapping).max(axis=1)))
+
+    def test_mapping_cache(self):
+        cell = LFPy.Cell(morphology=os.path.join(LFPy.__path__[0], 'test',
+                                                 'ball_and_sticks.hoc'))
+        cache = LFPy.tools.MappingCache(maxsize=4)
+        electrodeParams = {
+            'sigma' : 0.3,
+            'x' : np.ones(11) * 100.,
+            'y' : np.zeros(11),
+            'z' : np.linspace(1000, 0, 11),
+            'method' : 'linesource',
+        }
+        electrode = LFPy.RecExtElectrode(cell, **electrodeParams)
+        electrode.calc_mapping(cell)
+        reference = electrode.mapping
+
+        electrode = LFPy.RecExtElectrode(cell, mapping_cache=cache,
+                                         **electrodeParams)
+        electrode.calc_mapping(cell)
+        np.testing.assert_equal(electrode.mapping, reference)
+        self.assertEqual(len(cache), 1)
+
+        # reuse cached mapping with new electrode instance
+        electrode = LFPy.RecExtElectrode(cell, mapping_cache=cache,
+                                         **electrodeParams)
+        electrode.lfp_method_batch = None
+        electrode.lfp_method = None
+        electrode.calc_mapping(cell)
+        np.testing.assert_equal(electrode.mapping, reference)
+        self.assertEqual(len(cache), 1)
+
+        # changes to geometry or electrode parameters give new mappings
+        cell.set_pos(x=10)
+        electrode = LFPy.RecExtElectrode(cell, mapping_cache=cache,
+                                         **electrodeParams)
+        electrode.calc_mapping(cell)
+        self.assertEqual(len(cache), 2)
+        electrode = LFPy.RecExtElectrode(cell, mapping_cache=cache,
+                                         cutoff_distance=200.,
+                                         **electrodeParams)
+        electrode.calc_mapping(cell)
+        self.assertTrue(scipy.sparse.issparse(electrode.mapping))
+        self.assertEqual(len(cache), 3)
+
+        # contacts with random points are not cached
+        electrode = LFPy.RecExtElectrode(cell, mapping_cache=cache,
+                                         N=np.array([[1, 0, 0]] * 11),
+                                         r=5, n=10, **electrodeParams)
+        electrode.calc_mapping(cell)
+        self.assertEqual(len(cache), 3)
+
+        # Cell.simulate uses cached mapping
+        cell.simulate(rec_imem=True)
+        electrode = LFPy.RecExtElectrode(cell, mapping_cache=cache,
+                                         **electrodeParams)
+        electrode.lfp_method_batch = None
+        electrode.lfp_method = None
+        cell.simulate(electrode=electrode)
+        np.testing.assert_allclose(electrode.LFP,
+            cache.get(electrode._get_mapping_key()).dot(cell.imem))
+
+    def test_contact_quadrature(self):
+        cell = LFPy.Cell(morphology=os.path.join(LFPy.__path__[0], 'test',
+                                                 'stick.hoc'))
+        N = np.array([[1, 0, 0], [0, 1, 1], [1, 2, 3]] * 4)
+        electrodeParams = {
+            'x' : np.ones(12) * 20.,
+            'y' : np.zeros(12),
+            'z' : np.linspace(1000, 0, 12),
+            'N' : N,
+            'r' : 10,
+            'method' : 'linesource',
+        }
+        reference = LFPy.RecExtElectrode(cell, n=2000,
+                                         quadrature='fibonacci',
+                                         **electrodeParams)
+        reference.calc_mapping(cell)
+        for contact_shape in ['circle', 'square']:
+            for quadrature in ['random', 'fibonacci']:
+                electrode = LFPy.RecExtElectrode(cell, n=50, seedvalue=1234,
+                                                 contact_shape=contact_shape,
+                                                 quadrature=quadrature,
+                                                 **electrodeParams)
+                electrode.calc_mapping(cell)
+                mapping = electrode.mapping.copy()
+                electrode.calc_mapping(cell)
+                np.testing.assert_equal(electrode.mapping, mapping)
+
+                # points are on contact surfaces
+                for i in range(12):
+                    offsets = np.c_[electrode.offsets[i]['x_n'] - 20.,
+                                    electrode.offsets[i]['y_n'],
+                                    electrode.offsets[i]['z_n'] -
+                                    electrodeParams['z'][i]]
+                    np.testing.assert_allclose(np.dot(offsets, N[i]), 0,
+                                               atol=1E-12)
+                    if contact_shape == 'circle':
+                        self.assertTrue(np.all(
+                            np.sqrt((offsets**2).sum(axis=1)) <= 10))
+                    else:
+                        self.assertTrue(np.all(
+                            np.sqrt((offsets**2).sum(axis=1)) <=
+                            10 * np.sqrt(2) / 2))
+                if contact_shape == 'circle':
+                    rtol = 1E-2 if quadrature == 'fibonacci' else 1E-1
+                    np.testing.assert_allclose(mapping, reference.mapping,
+                                               rtol=rtol)
+
+        np.testing.assert_raises(ValueError, LFPy.RecExtElectrode,
+                                 quadrature='gauss')
+
+    def test_n_workers(self):
+        cell = LFPy.Cell(morphology=os.path.join(LFPy.__path__[0], 'test',
+                                                 'stick.hoc'))
+        electrodeParams = {
+            'x' : np.ones(11) * 20.,
+            'y' : np.zeros(11),
+            'z' : np.linspace(1000, 0, 11),
+        }
+        pointParams = {
+            'N' : [[1, 0, 0]] * 11,
+            'r' : 10,
+            'n' : 10,
+            'quadrature' : 'fibonacci',
+        }
+        for method in ['linesource', 'soma_as_point', 'pointsource']:
+            for params in [electrodeParams,
+                           dict(electrodeParams, **pointParams)]:
+                electrode = LFPy.RecExtElectrode(cell, method=method,
+                                                 **params)
+                electrode.calc_mapping(cell)
+                reference = electrode.mapping
+                electrode = LFPy.RecExtElectrode(cell, method=method,
+                                                 n_workers=3, **params)
+                electrode.calc_mapping(cell)
+                np.testing.assert_allclose(electrode.mapping, reference,
+                                           rtol=1E-12)
+
+        # with cutoff, one pool of processes is used for all blocks of
+        # contacts
+        params = dict(x=np.ones(400) * 20., y=np.zeros(400),
+                      z=np.linspace(1000, 0, 400), cutoff_rtol=1E-3)
+        electrode = LFPy.RecExtElectrode(cell, **params)
+        electrode.calc_mapping(cell)
+        reference = electrode.mapping.toarray()
+        pools = []
+        Pool = LFPy.recextelectrode.multiprocessing.Pool
+        def counting_pool(*args, **kwargs):
+            pools.append(args)
+            return Pool(*args, **kwargs)
+        LFPy.recextelectrode.multiprocessing.Pool = counting_pool
+        try:
+            electrode = LFPy.RecExtElectrode(cell, n_workers=3, **params)
+            electrode.calc_mapping(cell)
+        finally:
+            LFPy.recextelectrode.multiprocessing.Pool = Pool
+        self.assertEqual(len(pools), 1)
+        self.assertTrue(electrode._mapping_pool is None)
+        np.testing.assert_allclose(electrode.mapping.toarray(), reference,
+                                   rtol=1E-12)
+
+        np.testing.assert_raises(ValueError, LFPy.RecMEAElectrode, cell,
+                                 n_workers=2)
+
+        # the serial n-point average calls the batch method once per block
+        # of 64 // n contacts with all their points
+        electrode = LFPy.RecExtElectrode(cell, method='linesource',
+                                         n_workers=3,
+                                         **dict(electrodeParams,
+                                                **pointParams))
+        electrode.calc_mapping(cell)
+        reference = electrode.mapping
+        electrode = LFPy.RecExtElectrode(cell, method='linesource',
+                                         **dict(electrodeParams,
+                                                **pointParams))
+        calls = []
+        lfp_method_batch = electrode.lfp_method_batch
+        def counting_batch(cell, x, y, z, **kwargs):
+            calls.append(x.size)
+            return lfp_method_batch(cell, x=x, y=y, z=z, **kwargs)
+        electrode.lfp_method_batch = counting_batch
+        electrode.calc_mapping(cell)
+        self.assertEqual(calls, [60, 50])
+        np.testing.assert_allclose(electrode.mapping, reference, rtol=1E-12)
+
+
 ######## Functions used by tests: ##############################################
 
 
@@ -575,6 +991,42 @@ def stickSimulationDotprodcoeffs(method):
     return stick.dotprodresults[0]
 
 
+def stickSimulationSparseMapping(electrodeParams):
+    stickParams = {
+        'morphology' : os.path.join(LFPy.__path__[0], 'test', 'stick.hoc'),
+        'cm' : 1,
+        'Ra' : 150,
+        'v_init' : -65,
+        'passive' : True,
+        'passive_parameters' : {'g_pas' : 1./30000, 'e_pas' : -65},
+        'tstart' : 0,
+        'tstop' : 20,
+        'dt' : 2**-4,
+        'nsegs_method' : 'lambda_f',
+        'lambda_f' : 100,
+    }
+
+    stimParams = {
+        'pptype' : 'SinSyn',
+        'delay' : -100.,
+        'dur' : 1000.,
+        'pkamp' : 1.,
+        'freq' : 100.,
+        'phase' : -np.pi/2,
+        'bias' : 0.,
+        'record_current' : True
+    }
+
+    stick = LFPy.Cell(**stickParams)
+    stick.set_pos(z=-stick.zstart[0])
+    synapse = LFPy.StimIntElectrode(stick, stick.get_closest_idx(0, 0, 1000),
+                                    **stimParams)
+    electrode = LFPy.RecExtElectrode(**electrodeParams)
+    stick.simulate(electrode, rec_imem=True, block_size=16)
+
+    return electrode.LFP, electrode.electrodecoeff.dot(stick.imem)
+
+
 def analytical_LFP(time=np.linspace(0, 100, 1001),
                    stickLength=1000.,
                    stickDiam=2.,
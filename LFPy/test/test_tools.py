@@ -38,4 +38,78 @@ class testTools(unittest.TestCase):
     def test_tools_noise_brown(self):
         ncols=3
         nrows=2
-        self.assertEqual(LFPy.tools.noise_brown(ncols, nrows).shape, (nrows, ncols))
\ No newline at end of file
+        self.assertEqual(LFPy.tools.noise_brown(ncols, nrows).shape, (nrows, ncols))
+
+    def test_tools_StreamWriter_00(self):
+        import h5py
+        filename = 'test_StreamWriter'
+        data = np.random.randn(4, 1001)
+        for compression in [None, 'gzip', 'lzf']:
+            writer = LFPy.tools.StreamWriter(filename, ntsteps=1001, dt=0.1,
+                                             chunk_size=64,
+                                             compression=compression)
+            writer.create_dataset('electrode000', 4, x=np.arange(4))
+            writer.create_dataset('group/data', 4)
+            writer.create_dataset('empty', 0)
+            # write blocks of varying size
+            i = 0
+            for k in [1, 10, 100, 500, 390]:
+                writer.write('electrode000', data[:, i:i+k])
+                writer.write('group/data', 2*data[:, i:i+k])
+                writer.write('empty', data[:0, i:i+k])
+                i += k
+            writer.close()
+
+            f = h5py.File(filename + '.h5', 'r')
+            np.testing.assert_equal(f['electrode000'][()], data)
+            np.testing.assert_equal(f['group/data'][()], 2*data)
+            np.testing.assert_equal(f['electrode000'].attrs['x'], np.arange(4))
+            np.testing.assert_allclose(f['t'][()], np.arange(1001)*0.1)
+            self.assertEqual(f['electrode000'].chunks, (4, 64))
+            self.assertEqual(f['electrode000'].compression, compression)
+            self.assertEqual(f['empty'].shape, (0, 1001))
+            f.close()
+        os.remove(filename + '.h5')
+
+    def test_tools_MappingCache_00(self):
+        import shutil
+        import scipy.sparse as sp
+        cache_dir = 'test_MappingCache'
+        cache = LFPy.tools.MappingCache(maxsize=2, cache_dir=cache_dir)
+        keys = [cache.get_key(np.arange(i + 1), 'linesource', 0.3)
+                for i in range(3)]
+        self.assertEqual(len(set(keys)), 3)
+        self.assertEqual(keys[0], cache.get_key(np.arange(1.), 'linesource',
+                                                0.3))
+        mappings = [np.random.randn(4, 10), np.random.randn(4, 10),
+                    sp.csr_matrix(np.eye(4, 10))]
+        self.assertTrue(cache.get(keys[0]) is None)
+        for key, mapping in zip(keys, mappings):
+            cache.put(key, mapping)
+        # least recently used mapping is evicted from memory only
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(keys[0] in cache)
+
+        # mappings are restored from disk by new instances
+        cache = LFPy.tools.MappingCache(maxsize=2, cache_dir=cache_dir)
+        np.testing.assert_equal(cache.get(keys[0]), mappings[0])
+        np.testing.assert_equal(cache.get(keys[1]), mappings[1])
+        self.assertTrue(sp.issparse(cache.get(keys[2])))
+        np.testing.assert_equal(cache.get(keys[2]).toarray(),
+                                mappings[2].toarray())
+
+        # cached mappings are not modified by changing returned copies
+        mapping = cache.get(keys[1])
+        mapping[:] = 0
+        np.testing.assert_equal(cache.get(keys[1]), mappings[1])
+
+        # other files in cache_dir are not removed, overwriting works
+        user_file = os.path.join(cache_dir, 'user.npz')
+        np.savez(user_file, x=np.arange(3))
+        cache.put(keys[0], mappings[1])
+        np.testing.assert_equal(cache.get(keys[0]), mappings[1])
+        cache.clear()
+        self.assertTrue(cache.get(keys[0]) is None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(os.listdir(cache_dir), ['user.npz'])
+        shutil.rmtree(cache_dir)
@@ -15,8 +15,14 @@ GNU General Public License for more details.
 """
 
 from __future__ import division
+import os
+import re
+import hashlib
+import tempfile
+from collections import OrderedDict
 import numpy as np
 import scipy.signal as ss
+import scipy.sparse as sp
 
 def load(filename):
     """Generic loading of cPickled objects from file"""
@@ -57,3 +63,315 @@ def noise_brown(ncols, nrows=1, weight=1., filter=None, filterargs=None):
         noise[i, :] *= weight
     return noise
 
+
+
+class StreamWriter(object):
+    """
+    Buffered writer streaming 2D time series of shape (n, ntsteps) to an HDF5
+    file, block by block along the time axis.
+
+    Each dataset is created with HDF5 chunks spanning all rows and chunk_size
+    timesteps, and is written to whenever chunk_size timesteps have been
+    buffered in memory, so that each write to file covers whole chunks.
+
+    Parameters
+    ----------
+    file_name : str
+        path to HDF5 file. '.h5' is appended if it doesn't exist. Existing
+        files are overwritten
+    ntsteps : int
+        number of timesteps of each dataset
+    dt : float
+        timestep size (ms). A dataset 't' with the time of each timestep is
+        written to the file
+    chunk_size : int
+        number of timesteps per HDF5 chunk and per write to file
+    compression : None or str
+        HDF5 compression filter, e.g., 'gzip' or 'lzf'
+    compression_opts : None or int
+        compression settings, e.g., gzip compression level in [0, 9]
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from LFPy.tools import StreamWriter
+    >>> writer = StreamWriter('data.h5', ntsteps=1000, dt=0.1,
+    >>>                       chunk_size=256, compression='gzip')
+    >>> writer.create_dataset('electrode000', 16, x=np.zeros(16))
+    >>> for i in range(10):
+    >>>     writer.write('electrode000', np.random.randn(16, 100))
+    >>> writer.close()
+    """
+    def __init__(self, file_name, ntsteps, dt, chunk_size=1024,
+                 compression=None, compression_opts=None):
+        """
+        Initialize StreamWriter object
+        """
+        import h5py
+
+        if file_name.split('.')[-1] != 'h5':
+            file_name += '.h5'
+        self.file_name = file_name
+        self.ntsteps = int(ntsteps)
+        self.dt = dt
+        self.chunk_size = int(max(1, min(chunk_size, self.ntsteps)))
+        self.compression = compression
+        self.compression_opts = compression_opts
+
+        self.f = h5py.File(self.file_name, 'w')
+        self.f.attrs['dt'] = dt
+        self.f['t'] = np.arange(self.ntsteps) * dt
+
+        # in-memory buffers, number of buffered timesteps and number of
+        # timesteps written to file per dataset
+        self._buffers = dict()
+        self._nbuffered = dict()
+        self._nwritten = dict()
+
+    def create_dataset(self, name, n, **attrs):
+        """
+        Create chunked dataset name of shape (n, ntsteps)
+
+        Parameters
+        ----------
+        name : str
+            dataset name. Names on the form 'group/dataset' create groups
+        n : int
+            number of rows, e.g., electrode contacts
+        **attrs
+            metadata stored as attributes of the dataset, e.g., contact
+            positions
+        """
+        if n > 0:
+            dset = self.f.create_dataset(name, shape=(n, self.ntsteps),
+                                         dtype=float,
+                                         chunks=(n, self.chunk_size),
+                                         compression=self.compression,
+                                         compression_opts=self.compression_opts)
+        else:
+            # h5py does not allow chunking or compression of empty datasets
+            dset = self.f.create_dataset(name, shape=(n, self.ntsteps),
+                                         dtype=float)
+        for key, value in attrs.items():
+            dset.attrs[key] = value
+        self._buffers[name] = np.zeros((n, self.chunk_size))
+        self._nbuffered[name] = 0
+        self._nwritten[name] = 0
+
+    def write(self, name, data):
+        """
+        Append timesteps to dataset name
+
+        Parameters
+        ----------
+        name : str
+            dataset name
+        data : ndarray
+            array of shape (n, k) containing the values of the next k
+            timesteps
+        """
+        buf = self._buffers[name]
+        i = 0
+        while i < data.shape[1]:
+            j = self._nbuffered[name]
+            k = min(self.chunk_size - j, data.shape[1] - i)
+            buf[:, j:j+k] = data[:, i:i+k]
+            self._nbuffered[name] += k
+            i += k
+            if self._nbuffered[name] == self.chunk_size:
+                self._flush(name)
+
+    def _flush(self, name):
+        """Write buffered timesteps of dataset name to file"""
+        k = self._nbuffered[name]
+        if k > 0:
+            i = self._nwritten[name]
+            if self._buffers[name].shape[0] > 0:
+                self.f[name][:, i:i+k] = self._buffers[name][:, :k]
+            self._nwritten[name] += k
+            self._nbuffered[name] = 0
+
+    def flush(self):
+        """Write all buffered timesteps to file"""
+        for name in self._buffers.keys():
+            self._flush(name)
+        self.f.flush()
+
+    def close(self):
+        """Write all buffered timesteps to file and close it"""
+        self.flush()
+        self.f.close()
+
+
+def _replace_file(src, dst):
+    """Move file src to dst, replacing dst if it exists (also on Windows)"""
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2.7 has no os.replace, and os.rename fails on Windows if dst
+        # exists. Cached files with the same key hold the same mapping
+        try:
+            os.rename(src, dst)
+        except OSError:
+            if not os.path.isfile(dst):
+                raise
+            os.remove(src)
+
+
+class MappingCache(object):
+    """
+    Cache of electrode mappings between transmembrane currents and
+    extracellular potentials, keyed by a hash of the cell geometry and the
+    electrode parameters.
+
+    Mappings are kept in memory with least recently used (LRU) eviction, and
+    if cache_dir is not None, also stored on disk as .npz files which persist
+    across sessions and processes. Instances can be passed as the
+    mapping_cache argument of LFPy.RecExtElectrode and
+    LFPy.RecMEAElectrode, in which case the calc_mapping method (invoked by,
+    e.g., Cell.simulate and Network.simulate) reuses cached mappings.
+
+    Parameters
+    ----------
+    maxsize : int
+        maximum number of mappings kept in memory. If 0, mappings are only
+        stored on disk
+    cache_dir : None or str
+        path to directory for on-disk storage of mappings. Created if it
+        doesn't exist
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import LFPy
+    >>> cache = LFPy.tools.MappingCache(maxsize=8, cache_dir='mappings')
+    >>> cell = LFPy.Cell(morphology='examples/morphologies/L5_Mainen96_LFPy.hoc')
+    >>> for i in range(10):
+    >>>     electrode = LFPy.RecExtElectrode(x=np.zeros(16), y=np.zeros(16),
+    >>>                                      z=np.linspace(-500, 1000, 16),
+    >>>                                      mapping_cache=cache)
+    >>>     cell.simulate(electrode=electrode)
+    """
+    def __init__(self, maxsize=32, cache_dir=None):
+        """
+        Initialize MappingCache object
+        """
+        self.maxsize = int(maxsize)
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._mappings = OrderedDict()
+
+    @staticmethod
+    def get_key(*args):
+        """
+        Return hash of arguments, e.g., geometry arrays and parameters
+
+        Parameters
+        ----------
+        *args
+            ndarrays, or objects with deterministic repr, e.g., str, float,
+            None and tuples thereof
+
+        Returns
+        -------
+        key : str
+            hexadecimal SHA-1 digest
+        """
+        digest = hashlib.sha1()
+        for arg in args:
+            if isinstance(arg, np.ndarray):
+                arg = np.ascontiguousarray(arg, dtype=float)
+                digest.update(repr(arg.shape).encode())
+                digest.update(arg.tobytes())
+            else:
+                digest.update(repr(arg).encode())
+            digest.update(b'\x00')
+        return digest.hexdigest()
+
+    # on-disk file names of mappings, the cache never touches other files
+    _file_prefix = 'lfpy_mapping_'
+    _file_pattern = re.compile(r'^lfpy_mapping_[0-9a-f]{40}\.npz$')
+
+    def _get_file_name(self, key):
+        """Return path to on-disk storage of mapping with key"""
+        return os.path.join(self.cache_dir, self._file_prefix + key + '.npz')
+
+    def get(self, key):
+        """
+        Return copy of cached mapping, or None if key is not in cache
+
+        Parameters
+        ----------
+        key : str
+            key, see MappingCache.get_key
+
+        Returns
+        -------
+        mapping : None, ndarray or scipy.sparse.csr_matrix
+        """
+        if key in self._mappings:
+            self._mappings[key] = self._mappings.pop(key)
+            return self._mappings[key].copy()
+        if self.cache_dir is None:
+            return None
+        file_name = self._get_file_name(key)
+        if not os.path.isfile(file_name):
+            return None
+        f = np.load(file_name)
+        if 'format' in f.files:
+            f.close()
+            mapping = sp.load_npz(file_name).tocsr()
+        else:
+            mapping = f['mapping']
+            f.close()
+        self._add(key, mapping)
+        return mapping.copy()
+
+    def put(self, key, mapping):
+        """
+        Store copy of mapping in cache
+
+        Parameters
+        ----------
+        key : str
+            key, see MappingCache.get_key
+        mapping : ndarray or scipy.sparse.csr_matrix
+        """
+        mapping = mapping.copy()
+        self._add(key, mapping)
+        if self.cache_dir is not None:
+            # write to temporary file first, so that concurrent processes
+            # never read incomplete files
+            fd, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                if sp.issparse(mapping):
+                    sp.save_npz(f, mapping)
+                else:
+                    np.savez(f, mapping=mapping)
+            _replace_file(tmp_name, self._get_file_name(key))
+
+    def _add(self, key, mapping):
+        """Insert mapping in memory, evicting least recently used mappings"""
+        if self.maxsize <= 0:
+            return
+        self._mappings.pop(key, None)
+        self._mappings[key] = mapping
+        while len(self._mappings) > self.maxsize:
+            self._mappings.popitem(last=False)
+
+    def clear(self):
+        """Remove all mappings from memory and disk. Other files in
+        cache_dir are left untouched"""
+        self._mappings.clear()
+        if self.cache_dir is not None:
+            for fname in os.listdir(self.cache_dir):
+                if self._file_pattern.match(fname):
+                    os.remove(os.path.join(self.cache_dir, fname))
+
+    def __contains__(self, key):
+        return key in self._mappings or (self.cache_dir is not None and
+            os.path.isfile(self._get_file_name(key)))
+
+    def __len__(self):
+        return len(self._mappings)